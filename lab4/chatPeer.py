@@ -15,15 +15,28 @@ This chat client retains a list of peers so that it can send messages
 to each of them.
 """
 
+import os
 import sys
+import json
+import time
 import random
+import shutil
 import socket
 import argparse
+import tempfile
 sys.path.append("../modules")
 from Common import orb
+from Common import compression
+from Common import lanes
 from Common.nameServiceLocation import name_service_address
 from Common.objectType import object_type
 from Server.peerList import PeerList
+from Server.gossip import GossipPeerList
+from Server.outbox import Outbox, POLICIES, DROP_OLDEST
+from Server.multicast import CausalMulticast
+from Server.messageLog import MessageLog
+from Server.workload import Results, Workload, read_script, run_script, \
+    wait_for_peers, report
 
 # -----------------------------------------------------------------------------
 # Auxiliary classes
@@ -32,23 +45,78 @@ from Server.peerList import PeerList
 class Client(orb.Peer):
     """Chat client class."""
 
-    def __init__(self, local_address, ns_address, client_type):
+    # The messages wait while the liveness probes are answered, see
+    # lanes.
+    priorities = dict(orb.Peer.priorities)
+    priorities.update(dict.fromkeys(["ping", "ping_req"], lanes.CONTROL))
+    priorities.update(dict.fromkeys([
+        "print_message", "print_messages", "mcast_receive", "mcast_resend",
+        "history"
+    ], lanes.BULK))
+
+    def __init__(self, local_address, ns_address, client_type,
+                 membership="nameserver", queue_size=1000, batch=64,
+                 policy=DROP_OLDEST, history_file=None, host=None,
+                 identity_file=None):
         """Initialize the client."""
-        orb.Peer.__init__(self, local_address, ns_address, client_type)
-        self.peer_list = PeerList(self)
+        orb.Peer.__init__(self, local_address, ns_address, client_type, host,
+                          identity_file)
+        # Every message received is kept, see history.
+        self.history_dir = None
+        if history_file is None:
+            # chat-<PORT>.log, or chat-<PORT>-<OBJECT ID>.log if hosted,
+            # in a temporary directory removed when we leave.
+            self.history_dir = tempfile.mkdtemp(prefix="chat-")
+            history_file = os.path.join(self.history_dir, "chat-{}.log".format(
+                "-".join(str(a) for a in self.address[1:])))
+        self.message_log = MessageLog(history_file)
+        if membership == "gossip":
+            self.peer_list = GossipPeerList(self)
+        else:
+            self.peer_list = PeerList(self)
+        # Messages are sent in the background, see send_message.
+        self.outbox = Outbox(self, self.peer_list, capacity=queue_size,
+                             batch=batch, policy=policy,
+                             on_drop=self._messages_dropped)
+        # Group messages, delivered in causal order.
+        self.group = CausalMulticast(self, self.peer_list,
+                                     self.print_group_message,
+                                     capacity=queue_size, batch=batch,
+                                     policy=policy)
         self.dispatched_calls = {
             "register_peer":     self.peer_list.register_peer,
-            "unregister_peer":   self.peer_list.unregister_peer,
+            "register_peers":    self.peer_list.register_peers,
             "display_peers":     self.peer_list.display_peers
         }
+        self.dispatched_calls.update(self.group.remote_calls())
+        if membership == "gossip":
+            self.dispatched_calls.update(self.peer_list.gossip_calls())
         orb.Peer.start(self)
         self.peer_list.initialize()
+        self.group.initialize()
 
     # Public methods
 
     def destroy(self):
+        # Give the queued messages a chance to leave first.
+        self.outbox.flush(timeout=5.0)
+        self.outbox.close()
+        self.group.destroy()
         orb.Peer.destroy(self)
         self.peer_list.destroy()
+        self.message_log.close()
+        if self.history_dir is not None:
+            shutil.rmtree(self.history_dir, ignore_errors=True)
+
+    def suspend(self):
+        """Stop for a warm restart, staying in the group (see
+        orb.Peer.suspend). Our group messages go on being numbered from
+        the clock of the group when we come back."""
+        self.outbox.flush(timeout=5.0)
+        self.outbox.close()
+        self.group.destroy()
+        orb.Peer.suspend(self)
+        self.message_log.close()
 
     def __getattr__(self, attr):
         """Forward calls are dispatched here."""
@@ -58,16 +126,139 @@ class Client(orb.Peer):
             raise AttributeError(
                 "Client instance has no attribute '{}'".format(attr))
 
+    def unregister_peer(self, pid):
+        self.peer_list.unregister_peer(pid)
+        self.outbox.forget(pid)
+        self.group.outbox.forget(pid)
+
+    def unregister_peers(self, pids):
+        for pid in self.peer_list.unregister_peers(pids):
+            self.outbox.forget(pid)
+            self.group.outbox.forget(pid)
+
     def print_message(self, from_id, msg):
+        self.message_log.append([time.time(), from_id, "direct", msg])
         print("Received a message from {}: {}".format(from_id, msg))
 
+    def print_messages(self, from_id, msgs):
+        """Receive a batch of messages sent by the outbox of a peer."""
+        for msg in msgs:
+            self.print_message(from_id, msg)
+
     def send_message(self, to_id, msg):
-        try:
-            self.peer_list.peer(to_id).print_message(self.id, msg)
-        except Exception:
+        """Queue msg for peer to_id; it is sent in the background."""
+        if not self.outbox.send(to_id, msg):
             print(("Cannot send messages to {}."
                    "Make sure it is in the list of peers.").format(to_id))
 
+    def broadcast(self, msg):
+        """Send msg to every other peer, in parallel."""
+        sent_to = self.outbox.broadcast(msg)
+        if not sent_to:
+            print("There is nobody to send the message to.")
+
+    def multicast(self, msg):
+        """Send msg to the group; it is delivered in causal order."""
+        self.group.multicast(msg)
+
+    def print_group_message(self, from_id, msg):
+        self.message_log.append([time.time(), from_id, "group", msg])
+        print("Group message from {}: {}".format(from_id, msg))
+
+    def history(self, since, max_bytes=65536):
+        """Return the messages we received from number since on (negative:
+        from the end), in a chunk of at most max_bytes.
+
+        See MessageLog.read; the messages are [time, from id, kind,
+        message], kind being "direct" or "group".
+        """
+        return self.message_log.read(since, max_bytes)
+
+    def catch_up(self, pid, since=0):
+        """Display the messages peer pid received from number since on,
+        fetching them a chunk at a time."""
+
+        stub = self.peer_list.peer(pid)
+        count = 0
+        while True:
+            chunk = stub.history(since)
+            for sent, from_id, kind, msg in chunk["messages"]:
+                print("[{}] {} message from {}: {}".format(
+                    time.strftime("%H:%M:%S", time.localtime(sent)),
+                    kind.capitalize(), from_id, msg))
+            count += len(chunk["messages"])
+            since = chunk["next"]
+            if not chunk["messages"] or since >= chunk["end"]:
+                break
+        print("{} message(s) from the history of {}.".format(count, pid))
+        return count
+
+    def display_outbox(self):
+        self.outbox.display()
+        self.group.display()
+
+    # Private methods
+
+    def _messages_dropped(self, pid, msgs, error):
+        print("{} message(s) to {} could not be sent: {}".format(
+            len(msgs), pid, error))
+
+def execute(p, command):
+    """Run one command of the menu on p."""
+
+    if command == "l":
+        p.display_peers()
+    elif command == "o":
+        p.display_outbox()
+    elif command == "z":
+        print(json.dumps(p.compression_stats(), indent=2, sort_keys=True))
+    elif command == "h":
+        menu()
+    elif command.startswith("b "):
+        p.broadcast(command[2:].strip())
+    elif command.startswith("g "):
+        p.multicast(command[2:].strip())
+    elif command.startswith("y "):
+        args = command[2:].split()
+        p.catch_up(int(args[0]), int(args[1]) if len(args) > 1 else 0)
+    else:
+        pos = command.find(":")
+        if pos > -1 and command[0:pos].strip().isdigit():
+            # We have a command to send a message to someone.
+            to_id = int(command[0:pos])
+            msg = command[pos + 1:]
+            p.send_message(to_id, msg)
+
+def run_workload(p, workload, results, rate, size, mode):
+    """Send messages at the given rate until the workload is over.
+
+    mode is "direct" (to a peer chosen at random), "broadcast" or
+    "group".
+    """
+
+    def send(to_id, msg):
+        if not p.outbox.send(to_id, msg):
+            raise orb.ComunicationError(
+                "The message to {} was dropped.".format(to_id))
+
+    padding = "x" * size
+    while workload.running():
+        workload.pause(1.0 / rate)
+        msg = "{} {}".format(workload.done, padding)
+        if mode == "broadcast":
+            results.time("broadcast", p.outbox.broadcast, msg)
+        elif mode == "group":
+            results.time("multicast", p.multicast, msg)
+        else:
+            others = sorted(pid for pid in p.peer_list.get_peers()
+                            if pid != p.id)
+            if others:
+                results.time("send", send, workload.random.choice(others),
+                             msg)
+    # The messages are only queued above: time their way out too.
+    results.time("flush", p.outbox.flush, 30.0)
+    results.time("flush", p.group.outbox.flush, 30.0)
+
 def main():
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -87,11 +278,132 @@ def main():
         "-t", "--type", metavar="TYPE", dest="type", default=object_type,
         help="Set the type of the client."
     )
+    parser.add_argument(
+        "-m", "--membership", metavar="ENGINE", dest="membership",
+        default="nameserver", choices=["nameserver", "gossip"],
+        help="How the list of peers is maintained: 'nameserver' (default) "
+             "or 'gossip'."
+    )
+    parser.add_argument(
+        "--queue-size", metavar="N", dest="queue_size", type=int,
+        default=1000,
+        help="Messages queued per peer at most. The default value is 1000."
+    )
+    parser.add_argument(
+        "--batch", metavar="N", dest="batch", type=int, default=64,
+        help="Messages sent to a peer in a single call at most (64)."
+    )
+    parser.add_argument(
+        "--policy", metavar="POLICY", dest="policy", default=DROP_OLDEST,
+        choices=POLICIES,
+        help="What happens to a message for a full queue: 'drop-oldest' "
+             "(default), 'drop-newest' or 'block' until there is room."
+    )
+    parser.add_argument(
+        "--history", metavar="FILE", dest="history", default=None,
+        help="File keeping the messages received. The default value is "
+             "chat-<PORT>.log in the directory given by --history-dir."
+    )
+    parser.add_argument(
+        "--history-dir", metavar="DIR", dest="history_dir", default=None,
+        help="Directory of the default history file. A temporary one, "
+             "removed when the peer leaves, by default; give one to keep "
+             "the history across a warm restart."
+    )
+    parser.add_argument(
+        "--catch-up", metavar="N", dest="catch_up", type=int, default=0,
+        help="On start, display the last N messages received by the peer "
+             "with the lowest id."
+    )
+    parser.add_argument(
+        "--script", metavar="FILE", dest="script", default=None,
+        help="Run the commands of FILE, one per line, instead of reading "
+             "them from the terminal, then exit."
+    )
+    parser.add_argument(
+        "--workload", dest="workload", action="store_true",
+        help="Send messages at a given rate instead of reading commands, "
+             "then exit."
+    )
+    parser.add_argument(
+        "--rate", metavar="N", dest="rate", type=float, default=10.0,
+        help="Messages sent per second by the workload (10)."
+    )
+    parser.add_argument(
+        "--size", metavar="BYTES", dest="size", type=int, default=32,
+        help="Size of the messages of the workload (32)."
+    )
+    parser.add_argument(
+        "--mode", metavar="MODE", dest="mode", default="direct",
+        choices=["direct", "broadcast", "group"],
+        help="How the workload sends: 'direct' to a peer chosen at random "
+             "(default), 'broadcast' or 'group'."
+    )
+    parser.add_argument(
+        "--duration", metavar="SECONDS", dest="duration", type=float,
+        default=60.0, help="Length of the workload (60s)."
+    )
+    parser.add_argument(
+        "--operations", metavar="N", dest="operations", type=int,
+        default=None, help="Stop the workload after N messages."
+    )
+    parser.add_argument(
+        "--wait-peers", metavar="N", dest="wait_peers", type=int, default=0,
+        help="Before a headless run, wait until N peers (this one "
+             "included) have joined."
+    )
+    parser.add_argument(
+        "--seed", metavar="SEED", dest="seed", type=int, default=None,
+        help="Seed of the workload."
+    )
+    parser.add_argument(
+        "--results", metavar="FILE", dest="results", default=None,
+        help="Write the timing of every operation of a headless run to "
+             "FILE, one JSON record per line."
+    )
+    parser.add_argument(
+        "--compress-threshold", metavar="BYTES", dest="compress_threshold",
+        type=int, default=compression.threshold,
+        help="Compress TCP messages of at least BYTES; 0 turns compression "
+             "off ({}).".format(compression.threshold)
+    )
+    parser.add_argument(
+        "--compress-level", metavar="LEVEL", dest="compress_level", type=int,
+        default=compression.level, choices=range(1, 10),
+        help="zlib level of the compression, 1 to 9 ({}).".format(
+            compression.level)
+    )
+    parser.add_argument(
+        "--bulk-workers", metavar="N", dest="bulk_workers", type=int,
+        default=lanes.budgets[lanes.BULK],
+        help="Serve at most N bulk requests (chat messages) at a time; 0 for "
+             "no limit ({}).".format(lanes.budgets[lanes.BULK])
+    )
+    parser.add_argument(
+        "--identity", metavar="FILE", dest="identity", default=None,
+        help="Keep the id of the peer in FILE, and take it back from there "
+             "when restarted (see the 'qr' command)."
+    )
+    parser.add_argument(
+        "--keep-identity", dest="keep_identity", action="store_true",
+        help="End a headless run as 'qr' does instead of leaving."
+    )
     opts = parser.parse_args()
+    if opts.identity is not None and opts.membership == "gossip":
+        parser.error("--identity needs the name server membership.")
+    if opts.keep_identity and opts.identity is None:
+        parser.error("--keep-identity needs --identity.")
 
     local_port = opts.port
     client_type = opts.type
     assert client_type != "object", "Change the object type to something unique!"
+    compression.threshold = opts.compress_threshold or None
+    compression.level = opts.compress_level
+    lanes.budgets[lanes.BULK] = opts.bulk_workers or None
+    history = opts.history
+    if history is None and opts.history_dir is not None:
+        history = os.path.join(opts.history_dir,
+                               "chat-{}.log".format(local_port))
 
 # -----------------------------------------------------------------------------
 # The main program
@@ -99,40 +411,85 @@ def main():
 
     # Initialize the client object.
     local_address = (socket.gethostname(), local_port)
-    p = Client(local_address, name_service_address, client_type)
+    p = Client(local_address, name_service_address, client_type,
+               opts.membership, opts.queue_size, opts.batch, opts.policy,
+               history, identity_file=opts.identity)
+    others = sorted(pid for pid in p.peer_list.get_peers() if pid != p.id)
+    if opts.catch_up > 0 and others:
+        try:
+            p.catch_up(others[0], -opts.catch_up)
+        except Exception as e:
+            print("Cannot get the history of {}: {}".format(others[0], e))
+
+    if opts.script is not None or opts.workload:
+        # Headless run.
+        results = Results(opts.results)
+        try:
+            ready = not opts.wait_peers or \
+                wait_for_peers(p.peer_list, opts.wait_peers)
+            if not ready:
+                print("Only {} of the {} peers joined in time, the run is "
+                      "called off.".format(len(p.peer_list.get_peers()),
+                                           opts.wait_peers))
+            elif opts.script is not None:
+                run_script(read_script(opts.script),
+                           lambda words: execute(p, " ".join(words)),
+                           results, p.peer_list)
+            else:
+                workload = Workload(opts.seed, opts.duration,
+                                    opts.operations)
+                run_workload(p, workload, results, opts.rate, opts.size,
+                             opts.mode)
+        finally:
+            if opts.keep_identity:
+                p.suspend()
+            else:
+                p.destroy()
+            report(results)
+        sys.exit(1 if results.errors() or not ready else 0)
 
     command = ""
     cursor = "{}({})> ".format(p.type, p.id)
     menu()
-    while command != "q":
+    while command not in ("q", "qr"):
         try:
             sys.stdout.write(cursor)
             command = input()
-            if command == "l":
-                p.display_peers()
-            elif command == "h":
-                menu()
-            else:
-                pos = command.find(":")
-                if pos > -1 and command[0:pos].strip().isdigit():
-                    # We have a command to send a message to someone.
-                    to_id = int(command[0:pos])
-                    msg = command[pos + 1:]
-                    p.send_message(to_id, msg)
+            if command == "qr" and p.identity_file is None:
+                print("Start the peer with --identity to restart it warm.")
+                command = ""
+                continue
+            execute(p, command)
         except KeyboardInterrupt:
             break
+        except Exception as e:
+            print("An error has occurred: {}.".format(e))
 
     # Should we slap this in a finally block?
-    # Kill our peer object.
-    p.destroy()
+    # Kill our peer object, or only stop it for a warm restart.
+    if command == "qr":
+        p.suspend()
+    else:
+        p.destroy()
 
 def menu():
     print("""\
 Choose one of the following commands:
     l                       ::  display the peer list,
     <PEER_ID> : <MESSAGE>   ::  send <MESSAGE> to <PEER_ID>,
+    b <MESSAGE>             ::  broadcast <MESSAGE> to every peer,
+    g <MESSAGE>             ::  send <MESSAGE> to the group, in causal
+                                order,
+    o                       ::  display the outgoing message queues and
+                                the group,
+    z                       ::  display the compression statistics,
+    y <PEER_ID> [<SINCE>]   ::  display the messages <PEER_ID> received,
+                                from number <SINCE> on (negative: the
+                                last ones),
     h                       ::  print this menu,
-    q                       ::  exit.\
+    q                       ::  exit,
+    qr                      ::  exit, keeping our id to restart with
+                                (--identity).\
 """)
 
 if __name__ == "__main__": main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Benchmark the lock engines on a simulated network.
+
+Every engine is run on the same seeded workload, in this process and on a
+virtual clock, and the results are printed side by side.
+"""
+
+import sys
+import logging
+import argparse
+
+sys.path.append("../modules")
+from Server.Lock.engines import ENGINES
+from Server.Lock.simulator import Simulation, format_results
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+description = """Simulate N peers sharing a distributed lock."""
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-e", "--engine", metavar="ENGINE", dest="engines", action="append",
+    choices=sorted(ENGINES),
+    help="Engine to run, may be repeated. All of them by default."
+)
+parser.add_argument(
+    "-n", "--peers", metavar="N", dest="peers", type=int, default=5,
+    help="Number of peers. The default value is 5."
+)
+parser.add_argument(
+    "-s", "--seed", metavar="SEED", dest="seed", type=int, default=0,
+    help="Seed of the run; the same seed gives the same run."
+)
+parser.add_argument(
+    "-d", "--duration", metavar="SECONDS", dest="duration", type=float,
+    default=60.0, help="Simulated time. The default value is 60s."
+)
+parser.add_argument(
+    "--latency", metavar=("MIN", "MAX"), dest="latency", type=float,
+    nargs=2, default=[0.001, 0.005],
+    help="Range of the one way latency in seconds (1ms .. 5ms)."
+)
+parser.add_argument(
+    "--loss", metavar="P", dest="loss", type=float, default=0.0,
+    help="Probability for a message to be lost."
+)
+parser.add_argument(
+    "--think", metavar="SECONDS", dest="think", type=float, default=0.05,
+    help="Mean time between a release and the next request (50ms)."
+)
+parser.add_argument(
+    "--hold", metavar="SECONDS", dest="hold", type=float, default=0.01,
+    help="Mean time spent in the critical section (10ms)."
+)
+parser.add_argument(
+    "--read-ratio", metavar="P", dest="read_ratio", type=float, default=0.0,
+    help="Fraction of the accesses that only read (shared mode)."
+)
+parser.add_argument(
+    "--churn", metavar="RATE", dest="churn", type=float, default=0.0,
+    help="Mean number of peers leaving (and being replaced) per second."
+)
+parser.add_argument(
+    "--crash", metavar="P", dest="crash", type=float, default=0.0,
+    help="Fraction of the leaving peers that crash."
+)
+parser.add_argument(
+    "--timeout", metavar="SECONDS", dest="timeout", type=float, default=1.0,
+    help="Wait after which a peer suspects the token lost (1s)."
+)
+opts = parser.parse_args()
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+# The engines log every lost token; the summary is enough here.
+logging.getLogger().setLevel(logging.ERROR)
+
+results = []
+for engine in opts.engines or sorted(ENGINES):
+    simulation = Simulation(
+        engine, peers=opts.peers, seed=opts.seed, duration=opts.duration,
+        latency=tuple(opts.latency), loss=opts.loss, think=opts.think,
+        hold=opts.hold, read_ratio=opts.read_ratio, churn=opts.churn,
+        crash=opts.crash, token_timeout=opts.timeout)
+    results.append(simulation.run())
+print(format_results(results))
@@ -12,41 +12,26 @@
 """This is an implementation of mutual exclusion among a list of peers."""
 
 import sys
+import json
 import random
 import socket
 import argparse
 
 sys.path.append("../modules")
 from Common import orb
+from Common import compression
+from Common import lanes
 from Common.nameServiceLocation import name_service_address
 from Common.objectType import object_type
 
 from Server.peerList import PeerList
-from Server.Lock.distributedLock import DistributedLock
-
-# -----------------------------------------------------------------------------
-# Initialize and read the command line arguments
-# -----------------------------------------------------------------------------
-
-rand = random.Random()
-rand.seed()
-description = """Peer with access to a mutual exclusive component."""
-parser = argparse.ArgumentParser(description=description)
-parser.add_argument(
-    "-p", "--port", metavar="PORT", dest="port", type=int,
-    default=rand.randint(1, 10000) + 40000, choices=range(40001, 50000),
-    help="Set the port to listen to. Must be in the range 40001 .. 50000. "
-         "The default value is chosen at random."
-)
-parser.add_argument(
-    "-t", "--type", metavar="TYPE", dest="type", default=object_type,
-    help="Set the type of the client."
-)
-opts = parser.parse_args()
-
-local_port = opts.port
-client_type = opts.type
-assert client_type != "object", "Change the object type to something unique!"
+from Server.gossip import GossipPeerList
+from Server.Lock.engines import ENGINES, DEFAULT_ENGINE, create_engine
+from Server.Lock.distributedLock import HoldPolicy
+from Server.Lock.lockManager import LockManager
+from Server.Lock.lockMetrics import LockMetrics, MetricsDump
+from Server.workload import Results, Workload, read_script, run_script, \
+    wait_for_peers, report
 
 # -----------------------------------------------------------------------------
 # Auxiliary classes
@@ -57,30 +42,77 @@ class Client(orb.Peer):
 
     """Distributed mutual exclusion client class."""
 
-    def __init__(self, local_address, ns_address, cient_type):
+    # The token and the liveness probes go first, see lanes.
+    priorities = dict(orb.Peer.priorities)
+    priorities.update(dict.fromkeys([
+        "request_token", "obtain_token", "recover_token", "token_freeze",
+        "token_thaw", "raymond_request", "raymond_privilege",
+        "raymond_reparent", "raymond_recover", "raymond_freeze",
+        "raymond_thaw", "grant_shared", "return_shared", "lock_call",
+        "ping", "ping_req"
+    ], lanes.CONTROL))
+    # The clock of the lock is lost in a crash; see orb.Peer.suspend.
+    resume_after_crash = False
+
+    def __init__(self, local_address, ns_address, client_type,
+                 membership="nameserver", engine=DEFAULT_ENGINE, host=None,
+                 identity_file=None):
         """Initialize the client."""
-        orb.Peer.__init__(self, local_address, ns_address, client_type)
-        self.peer_list = PeerList(self)
-        self.distributed_lock = DistributedLock(self, self.peer_list)
+        orb.Peer.__init__(self, local_address, ns_address, client_type, host,
+                          identity_file)
+        if membership == "gossip":
+            self.peer_list = GossipPeerList(self)
+        else:
+            self.peer_list = PeerList(self)
+        self.distributed_lock = create_engine(engine, self, self.peer_list)
+        self.lock_manager = LockManager(self, self.peer_list, engine)
+        self.metrics = LockMetrics(self.distributed_lock)
         self.dispatched_calls = {
+            "lock_call":          self.lock_manager.lock_call,
+            "lock_metrics":       self.lock_metrics,
             "display_peers":      self.peer_list.display_peers,
             "acquire":            self.distributed_lock.acquire,
+            "try_acquire":        self.distributed_lock.try_acquire,
             "release":            self.distributed_lock.release,
-            "request_token":      self.distributed_lock.request_token,
-            "obtain_token":       self.distributed_lock.obtain_token,
             "display_status":     self.distributed_lock.display_status
         }
+        if hasattr(self.distributed_lock, "acquire_shared"):
+            self.dispatched_calls.update({
+                "acquire_shared":   self.distributed_lock.acquire_shared,
+                "release_shared":   self.distributed_lock.release_shared
+            })
+        self.dispatched_calls.update(self.distributed_lock.remote_calls())
+        if membership == "gossip":
+            self.dispatched_calls.update(self.peer_list.gossip_calls())
         orb.Peer.start(self)
         self.peer_list.initialize()
-        self.distributed_lock.initialize()
+        if self.resumed is None:
+            self.distributed_lock.initialize()
+        else:
+            # Back with our old id: the token is elsewhere, and our clocks
+            # go on from where they were.
+            self.distributed_lock.initialize(mint_token=False)
+            self.distributed_lock.set_state(self.resumed["lock"])
+            self.lock_manager.set_state(self.resumed["named"])
 
     # Public methods
 
     def destroy(self):
         orb.Peer.destroy(self)
         self.distributed_lock.destroy()
+        self.lock_manager.destroy()
         self.peer_list.destroy()
 
+    def suspend(self):
+        """Stop for a warm restart: hand the tokens over, but stay in the
+        group, and keep the state of the locks for the next start."""
+        self.distributed_lock.destroy()
+        self.lock_manager.destroy()
+        orb.Peer.suspend(self, {
+            "lock": self.distributed_lock.get_state(),
+            "named": self.lock_manager.get_state()
+        })
+
     def __getattr__(self, attr):
         """Forward calls are dispatched here."""
         if attr in self.dispatched_calls:
@@ -89,58 +121,337 @@ class Client(orb.Peer):
             raise AttributeError(
                 "Client instance has no attribute '{}'".format(attr))
 
+    def lock_metrics(self):
+        """Return the metrics of the lock and of the named locks."""
+        return {
+            "lock": self.metrics.snapshot(),
+            "named": self.lock_manager.lock_metrics()
+        }
+
     def register_peer(self, pid, paddr):
         self.peer_list.register_peer(pid, paddr)
         self.distributed_lock.register_peer(pid)
+        self.lock_manager.register_peer(pid)
 
     def unregister_peer(self, pid):
         self.peer_list.unregister_peer(pid)
         self.distributed_lock.unregister_peer(pid)
+        self.lock_manager.unregister_peer(pid)
 
-# -----------------------------------------------------------------------------
-# The main program
-# -----------------------------------------------------------------------------
+    def register_peers(self, peers):
+        for pid in self.peer_list.register_peers(peers):
+            self.distributed_lock.register_peer(pid)
+            self.lock_manager.register_peer(pid)
+
+    def unregister_peers(self, pids):
+        for pid in self.peer_list.unregister_peers(pids):
+            self.distributed_lock.unregister_peer(pid)
+            self.lock_manager.unregister_peer(pid)
 
-# Initialize the client object.
-local_address = (socket.gethostname(), local_port)
-p = Client(local_address, name_service_address, client_type)
+
+def execute(p, words):
+    """Run one command of the menu on p.
+
+    Returns the state of the lock to show in the cursor, if it changed.
+    """
+
+    command = words[0] if words else ""
+    name = words[1] if len(words) > 1 else None
+    if name is not None:
+        if command == "s":
+            p.lock_manager.display_status(name)
+        elif command == "a":
+            p.lock_manager.acquire(name)
+            print("Lock '{}' acquired.".format(name))
+        elif command == "t":
+            acquired = p.lock_manager.try_acquire(name)
+            print("Lock '{}' {}acquired.".format(
+                name, "" if acquired else "not "))
+        elif command == "r":
+            p.lock_manager.release(name)
+            print("Lock '{}' released.".format(name))
+        elif command == "sa":
+            p.lock_manager.acquire_shared(name)
+            print("Lock '{}' acquired in shared mode.".format(name))
+        elif command == "sr":
+            p.lock_manager.release_shared(name)
+            print("Shared lock '{}' released.".format(name))
+    elif command == "l":
+        p.display_peers()
+    elif command == "n":
+        p.lock_manager.display_status()
+    elif command == "m":
+        print(json.dumps(p.lock_metrics(), indent=2, sort_keys=True))
+    elif command == "z":
+        print(json.dumps(p.compression_stats(), indent=2, sort_keys=True))
+    elif command == "s":
+        p.display_status()
+    elif command == "a":
+        p.acquire()
+        print("Lock acquired after {:.3f}s.".format(
+            p.distributed_lock.wait_time))
+        return "LOCKED"
+    elif command == "t":
+        if p.try_acquire():
+            return "LOCKED"
+        print("The token is not here; the lock was not acquired.")
+    elif command == "r":
+        p.release()
+        return "RELEASED"
+    elif command == "sa":
+        p.acquire_shared()
+        print("Shared lock acquired after {:.3f}s.".format(
+            p.distributed_lock.wait_time))
+        return "SHARED"
+    elif command == "sr":
+        p.release_shared()
+        return "RELEASED"
+    elif command == "h":
+        menu()
+    elif command not in ("", "q", "qr"):
+        raise ValueError("Unknown command: '{}'".format(command))
+
+
+def run_workload(p, workload, results, think, hold, name=None):
+    """Acquire, hold, release and think until the workload is over."""
+
+    if name is None:
+        acquire, release = p.acquire, p.release
+    else:
+        acquire = lambda: p.lock_manager.acquire(name)
+        release = lambda: p.lock_manager.release(name)
+    while workload.running():
+        workload.pause(think)
+        results.time("acquire", acquire)
+        workload.pause(hold)
+        results.time("release", release)
 
 
 def menu():
     print("""\
 Choose one of the following commands:
-    l  ::  list peers,
-    s  ::  display status,
-    a  ::  acquire the lock,
-    r  ::  release the lock,
-    h  ::  print this menu,
-    q  ::  exit.\
+    l         ::  list peers,
+    s         ::  display status,
+    a         ::  acquire the lock,
+    t         ::  try to acquire the lock without waiting,
+    r         ::  release the lock,
+    sa        ::  acquire the lock in shared mode ('shared' engine),
+    sr        ::  release the shared lock,
+    n         ::  list the named locks hosted here,
+    m         ::  print the lock metrics,
+    z         ::  print the compression statistics,
+    s <NAME>  ::  display the status of the lock called <NAME>,
+    a <NAME>  ::  acquire the lock called <NAME>,
+    t <NAME>  ::  try to acquire the lock called <NAME>,
+    r <NAME>  ::  release the lock called <NAME>,
+    sa <NAME> ::  acquire the lock called <NAME> in shared mode,
+    sr <NAME> ::  release the shared lock called <NAME>,
+    h         ::  print this menu,
+    q         ::  exit,
+    qr        ::  exit, keeping our id to restart with (--identity).\
 """)
 
-command = ""
-cursor = "{}({}):{}> ".format(p.type, p.id, "RELEASED")
-menu()
-while command != "q":
-    try:
-        sys.stdout.write(cursor)
-        command = input()
-        if command == "l":
-            p.display_peers()
-        elif command == "s":
-            p.display_status()
-        elif command == "a":
-            p.acquire()
-            cursor = "{}({}):{}> ".format(p.type, p.id, "LOCKED")
-        elif command == "r":
-            p.release()
-            cursor = "{}({}):{}> ".format(p.type, p.id, "RELEASED")
-        elif command == "h":
-            menu()
-    except KeyboardInterrupt:
-        break
-    except Exception as e:
-        # Catch all errors to keep on running in spite of all errors.
-        print("An error has occurred: {}.".format(e))
-
-# Kill our peer object.
-p.destroy()
+
+def main():
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+    rand = random.Random()
+    rand.seed()
+    description = """Peer with access to a mutual exclusive component."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-p", "--port", metavar="PORT", dest="port", type=int,
+        default=rand.randint(1, 10000) + 40000, choices=range(40001, 50000),
+        help="Set the port to listen to. Must be in the range "
+             "40001 .. 50000. The default value is chosen at random."
+    )
+    parser.add_argument(
+        "-t", "--type", metavar="TYPE", dest="type", default=object_type,
+        help="Set the type of the client."
+    )
+    parser.add_argument(
+        "-m", "--membership", metavar="ENGINE", dest="membership",
+        default="nameserver", choices=["nameserver", "gossip"],
+        help="How the list of peers is maintained: 'nameserver' (default) "
+             "or 'gossip'."
+    )
+    parser.add_argument(
+        "-e", "--engine", metavar="ENGINE", dest="engine",
+        default=DEFAULT_ENGINE, choices=sorted(ENGINES),
+        help="The mutual exclusion algorithm: {}. The default value is '{}'."
+             .format(", ".join(sorted(ENGINES)), DEFAULT_ENGINE)
+    )
+    parser.add_argument(
+        "--hold-entries", metavar="N", dest="hold_entries", type=int,
+        default=8,
+        help="Critical sections the token may serve for local threads in a "
+             "row while remote peers wait (token engines). The default "
+             "value is 8."
+    )
+    parser.add_argument(
+        "--hold-time", metavar="SECONDS", dest="hold_time", type=float,
+        default=0.05,
+        help="Time the token may stay for local threads while remote peers "
+             "wait (token engines). The default value is 0.05."
+    )
+    parser.add_argument(
+        "--metrics-file", metavar="PATH", dest="metrics_file", default=None,
+        help="Write the lock metrics to PATH (JSON) periodically."
+    )
+    parser.add_argument(
+        "--metrics-interval", metavar="SECONDS", dest="metrics_interval",
+        type=float, default=10.0,
+        help="Seconds between two writes of the metrics file. The default "
+             "value is 10."
+    )
+    parser.add_argument(
+        "--script", metavar="FILE", dest="script", default=None,
+        help="Run the commands of FILE, one per line, instead of reading "
+             "them from the terminal, then exit."
+    )
+    parser.add_argument(
+        "--workload", dest="workload", action="store_true",
+        help="Run a synthetic workload instead of reading commands, then "
+             "exit: acquire, hold, release, think, over and over."
+    )
+    parser.add_argument(
+        "--think", metavar="SECONDS", dest="think", type=float, default=0.5,
+        help="Mean time between a release and the next acquire (0.5)."
+    )
+    parser.add_argument(
+        "--hold", metavar="SECONDS", dest="hold", type=float, default=0.05,
+        help="Mean time the lock is held (0.05)."
+    )
+    parser.add_argument(
+        "--lock-name", metavar="NAME", dest="lock_name", default=None,
+        help="Use the named lock NAME in the workload."
+    )
+    parser.add_argument(
+        "--duration", metavar="SECONDS", dest="duration", type=float,
+        default=60.0, help="Length of the workload (60s)."
+    )
+    parser.add_argument(
+        "--operations", metavar="N", dest="operations", type=int,
+        default=None, help="Stop the workload after N critical sections."
+    )
+    parser.add_argument(
+        "--wait-peers", metavar="N", dest="wait_peers", type=int, default=0,
+        help="Before a headless run, wait until N peers (this one "
+             "included) have joined."
+    )
+    parser.add_argument(
+        "--seed", metavar="SEED", dest="seed", type=int, default=None,
+        help="Seed of the workload."
+    )
+    parser.add_argument(
+        "--results", metavar="FILE", dest="results", default=None,
+        help="Write the timing of every operation of a headless run to "
+             "FILE, one JSON record per line."
+    )
+    parser.add_argument(
+        "--compress-threshold", metavar="BYTES", dest="compress_threshold",
+        type=int, default=compression.threshold,
+        help="Compress TCP messages of at least BYTES; 0 turns compression "
+             "off ({}).".format(compression.threshold)
+    )
+    parser.add_argument(
+        "--compress-level", metavar="LEVEL", dest="compress_level", type=int,
+        default=compression.level, choices=range(1, 10),
+        help="zlib level of the compression, 1 to 9 ({}).".format(
+            compression.level)
+    )
+    parser.add_argument(
+        "--identity", metavar="FILE", dest="identity", default=None,
+        help="Keep the id of the peer in FILE, and take it back from there "
+             "when restarted (see the 'qr' command)."
+    )
+    parser.add_argument(
+        "--keep-identity", dest="keep_identity", action="store_true",
+        help="End a headless run as 'qr' does instead of leaving."
+    )
+    opts = parser.parse_args()
+    if opts.identity is not None and opts.membership == "gossip":
+        parser.error("--identity needs the name server membership.")
+    if opts.identity is not None and opts.engine == "raymond":
+        parser.error("--identity needs the 'token' or 'shared' engine.")
+    if opts.keep_identity and opts.identity is None:
+        parser.error("--keep-identity needs --identity.")
+
+    local_port = opts.port
+    client_type = opts.type
+    assert client_type != "object", "Change the object type to something unique!"
+    compression.threshold = opts.compress_threshold or None
+    compression.level = opts.compress_level
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+    # Initialize the client object.
+    local_address = (socket.gethostname(), local_port)
+    p = Client(local_address, name_service_address, client_type,
+               opts.membership, opts.engine, identity_file=opts.identity)
+    if hasattr(p.distributed_lock, "policy"):
+        p.distributed_lock.policy = HoldPolicy(opts.hold_entries,
+                                               opts.hold_time)
+    if opts.metrics_file is not None:
+        MetricsDump(p.lock_metrics, opts.metrics_file,
+                    opts.metrics_interval).start()
+
+    if opts.script is not None or opts.workload:
+        # Headless run.
+        results = Results(opts.results)
+        try:
+            ready = not opts.wait_peers or \
+                wait_for_peers(p.peer_list, opts.wait_peers)
+            if not ready:
+                print("Only {} of the {} peers joined in time, the run is "
+                      "called off.".format(len(p.peer_list.get_peers()),
+                                           opts.wait_peers))
+            elif opts.script is not None:
+                run_script(read_script(opts.script),
+                           lambda words: execute(p, words), results,
+                           p.peer_list)
+            else:
+                workload = Workload(opts.seed, opts.duration,
+                                    opts.operations)
+                run_workload(p, workload, results, opts.think, opts.hold,
+                             opts.lock_name)
+        finally:
+            if opts.keep_identity:
+                p.suspend()
+            else:
+                p.destroy()
+            report(results)
+        sys.exit(1 if results.errors() or not ready else 0)
+
+    command = ""
+    cursor = "{}({}):{}> ".format(p.type, p.id, "RELEASED")
+    menu()
+    while command not in ("q", "qr"):
+        try:
+            sys.stdout.write(cursor)
+            words = input().split()
+            command = words[0] if words else ""
+            if command == "qr" and p.identity_file is None:
+                print("Start the peer with --identity to restart it warm.")
+                command = ""
+                continue
+            state = execute(p, words)
+            if state is not None:
+                cursor = "{}({}):{}> ".format(p.type, p.id, state)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            # Catch all errors to keep on running in spite of all errors.
+            print("An error has occurred: {}.".format(e))
+
+    # Kill our peer object, or only stop it for a warm restart.
+    if command == "qr":
+        p.suspend()
+    else:
+        p.destroy()
+
+if __name__ == "__main__": main()
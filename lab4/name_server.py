@@ -6,11 +6,14 @@ Created on Sep 28, 2015
 
 import multiprocessing.dummy as multiprocessing
 import copy
+import time
 import socket
 import logging
+import threading
 import sys
 sys.path.append("../modules")
 from Common import nameServiceLocation
+from Common import profiling
 from Common.orb import Request
 from Common.orb import Stub
 from Common.orb import ProtocolError
@@ -26,12 +29,24 @@ Name server for a group of peers. It allows peers to find each other by object_i
 
 server_address = nameServiceLocation.name_service_address
 
+# Peers joining (or leaving) within this many seconds of each other are
+# announced to the rest of the group together. A peer joining alone is
+# announced at once.
+batch_window = 0.2
+
 # -----------------------------------------------------------------------------
 # Auxiliary classes
 # -----------------------------------------------------------------------------
 
 logging.basicConfig(format="%(levelname)s:%(filename)s: %(message)s", level=logging.DEBUG)
 
+class Batch(object):
+    """Peers joining or leaving together, see NameServer.join."""
+
+    def __init__(self):
+        self.items = []
+        self.done = threading.Event()
+
 class NameServer(object):
     """Class that handles peers."""
 
@@ -52,6 +67,14 @@ class NameServer(object):
         self.peers = dict()         # Contains a set of peers for each object type
         self.responses = dict()
         self.next_id = 0
+        # The (type, hash) each id was given, for reclaim.
+        self.issued = dict()
+        # The batches being collected, by (kind, object type), and when
+        # the last peer of each kind and type came.
+        self.batch_lock = threading.Lock()
+        self.batches = dict()
+        self.last_arrival = dict()
+        self.profiler = profiling.Profiler("nameserver")
 
     # Public methods
 
@@ -65,6 +88,7 @@ class NameServer(object):
         obj_id = self.next_id
         self.next_id += 1
         t = (obj_id, obj_hash) 
+        self.issued[obj_id] = (obj_type, obj_hash)
         self.lock.write_release()
 
         # We're adding the address to the group
@@ -85,6 +109,9 @@ class NameServer(object):
 
         # Remove from the group (if it exists)
         self.lock.write_acquire()
+        if self.issued.get(obj_id) == (obj_type, t[1]):
+            # Gone for good: the id cannot be reclaimed any more.
+            del self.issued[obj_id]
         if t in group:
             group.remove(t)
         else:
@@ -101,7 +128,197 @@ class NameServer(object):
     
     def get_peers(self, obj_type):
         return list(self._get_group(obj_type))
+
+    def register_many(self, obj_type, addresses):
+        """Register several peers at once; returns their (id, hash)."""
+        group = self._get_group(obj_type)
+        self.lock.write_acquire()
+        entries = []
+        for address in addresses:
+            t = (self.next_id, tuple(address))
+            self.issued[self.next_id] = (obj_type, t[1])
+            self.next_id += 1
+            group.add(t)
+            entries.append(t)
+        self.lock.write_release()
+        logging.info("NameServer registered {} peers".format(len(entries)))
+        return entries
+
+    def join(self, obj_type, obj_id, address):
+        """Introduce a registered peer to its group; returns the group.
+
+        The peers joining within batch_window of each other are
+        announced to the members of the group together, with a single
+        register_peers call per member, and each of them gets the whole
+        group (the others joining included) back. So n peers joining
+        a group of m cost n + m calls instead of n * m.
+        """
+        self._batched("join", obj_type, [obj_id, address],
+                      self._announce_joins)
+        group = self._get_group(obj_type)
+        self.lock.read_acquire()
+        peers = list(group)
+        self.lock.read_release()
+        return peers
+
+    def leave(self, obj_type, obj_id):
+        """Remove a peer from its group and tell the group, with one
+        unregister_peers call per member for all the peers leaving
+        together.
+
+        This replaces unregister for a peer that joined: nobody is
+        checked, so a whole group leaving costs n + m calls, not n * m.
+        """
+        self.lock.write_acquire()
+        if self.issued.get(obj_id, (None,))[0] == obj_type:
+            # Gone for good: the id cannot be reclaimed any more.
+            del self.issued[obj_id]
+        self.lock.write_release()
+        self._batched("leave", obj_type, obj_id, self._announce_leaves)
+        return "null"
+
+    def suspect(self, obj_type, obj_id):
+        """A member of the group cannot be reached by another one: check
+        it, and if it does not answer, remove it and tell the group (as
+        leave does). Returns whether it was removed.
+
+        Its id is kept, so that it can still be reclaimed (see
+        Peer.suspend): it is then announced again.
+        """
+        group = self._get_group(obj_type)
+        self.lock.read_acquire()
+        suspects = [peer for peer in group if peer[0] == obj_id]
+        self.lock.read_release()
+        if not suspects or self._is_alive(obj_type, suspects[0], 5):
+            return False
+        logging.info("NameServer removing unreachable peer {}".format(
+            obj_id))
+        self._batched("leave", obj_type, obj_id, self._announce_leaves)
+        return True
+
+    def reclaim(self, obj_type, obj_id, obj_hash, address):
+        """Give a restarting peer its id back; returns (id, hash, group),
+        or None if the id was not given out here with that type and hash
+        (or was unregistered since) and the peer has to register.
+
+        A peer coming back at the address it had, and still in the
+        group, is back with this single call: the others kept it in
+        their lists meanwhile. Otherwise it is announced to the group
+        like a peer joining (see join).
+        """
+        address = tuple(address)
+        group = self._get_group(obj_type)
+        self.lock.write_acquire()
+        if self.issued.get(obj_id) != (obj_type, tuple(obj_hash)):
+            self.lock.write_release()
+            logging.info("NameServer refused to give id {} back".format(
+                obj_id))
+            return None
+        t = (obj_id, address)
+        current = [peer for peer in group if peer[0] == obj_id]
+        known = current == [t]
+        for peer in current:
+            group.discard(peer)
+        group.add(t)
+        # The hash is the address (see register).
+        self.issued[obj_id] = (obj_type, address)
+        self.lock.write_release()
+        logging.info("NameServer gave id {} back{}".format(
+            obj_id, "" if known else ", announcing it"))
+        if not known:
+            self._batched("join", obj_type, [obj_id, address],
+                          self._announce_joins)
+        self.lock.read_acquire()
+        peers = list(group)
+        self.lock.read_release()
+        return (obj_id, address, peers)
+
+    # Profiling, as on the peers (see Common/profiling.py)
+
+    def profile_start(self, mode, seconds, path=None):
+        return self.profiler.start(mode, seconds, path)
+
+    def profile_stop(self):
+        return self.profiler.stop()
+
+    def profile_status(self):
+        return self.profiler.status()
+
+    def profile_stacks(self, path=None):
+        return self.profiler.stacks(path)
     
+    def _batched(self, kind, obj_type, item, announce):
+        """Add item to the batch being collected for obj_type and wait
+        until the batch is announced.
+
+        The first caller of a batch announces it, announce(obj_type,
+        items): at once if it came alone, after collecting the others
+        for batch_window seconds if the previous one was less than that
+        ago.
+        """
+        key = (kind, obj_type)
+        now = time.monotonic()
+        self.batch_lock.acquire()
+        batch = self.batches.get(key)
+        leader = batch is None
+        if leader:
+            batch = self.batches[key] = Batch()
+        batch.items.append(item)
+        busy = now - self.last_arrival.get(key, float("-inf")) < batch_window
+        self.last_arrival[key] = now
+        self.batch_lock.release()
+
+        if not leader:
+            batch.done.wait()
+            return
+        if busy:
+            time.sleep(batch_window)
+        self.batch_lock.acquire()
+        del self.batches[key]
+        self.batch_lock.release()
+        try:
+            announce(obj_type, batch.items)
+        finally:
+            batch.done.set()
+
+    def _announce_joins(self, obj_type, joiners):
+        ids = set(pid for pid, paddr in joiners)
+        group = self._get_group(obj_type)
+        self.lock.read_acquire()
+        members = [peer for peer in group if peer[0] not in ids]
+        self.lock.read_release()
+        logging.info("NameServer announcing {} joining peer(s) to {} "
+                     "member(s)".format(len(joiners), len(members)))
+        self._announce(members, "register_peers", joiners)
+
+    def _announce_leaves(self, obj_type, ids):
+        group = self._get_group(obj_type)
+        self.lock.write_acquire()
+        for peer in [peer for peer in group if peer[0] in ids]:
+            group.remove(peer)
+        members = list(group)
+        self.lock.write_release()
+        logging.info("NameServer announcing {} leaving peer(s) to {} "
+                     "member(s)".format(len(ids), len(members)))
+        self._announce(members, "unregister_peers", ids)
+
+    def _announce(self, members, method, arg):
+        """Call method(arg) on every member, in parallel."""
+        def call(peer):
+            try:
+                getattr(Stub(peer[1]), method)(arg)
+            except:
+                err = sys.exc_info()
+                logging.info("Peer {} was not told: {}: {}".format(
+                    peer[0], err[0], err[1]))
+        if not members:
+            return
+        pool = multiprocessing.Pool(min(len(members), 16))
+        try:
+            pool.map(call, members)
+        finally:
+            pool.close()
+
     def _get_group(self, obj_type):
         # Create our group if it doesn't already exist
         self.lock.write_acquire()
@@ -129,7 +346,8 @@ class NameServer(object):
             group = self._get_group(obj_type)
             self.lock.write_acquire()
             logging.info("Removing peer {}.".format(t))
-            group.remove(t)
+            # It may have left (or been removed) meanwhile.
+            group.discard(t)
             self.lock.write_release()
 
     def _get_line(self, conn, peer, obj_type):
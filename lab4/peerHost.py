@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Run many mutex or chat peers in a single process.
+
+The peers share one listening port (see orb.PeerHost), and the calls
+between them do not go through the network. With --workload every peer
+runs the synthetic workload of its kind, in its own thread, and the
+timings of all of them are reported together.
+"""
+
+import os
+import sys
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.append("../modules")
+from Common import orb
+from Common import lanes
+from Common.nameServiceLocation import name_service_address
+from Common.objectType import object_type
+from Server.Lock.engines import ENGINES, DEFAULT_ENGINE
+from Server.workload import Results, Workload, report
+
+import chatPeer
+import mutexPeer
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+rand = random.Random()
+rand.seed()
+description = """Host many peers in one process."""
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-p", "--port", metavar="PORT", dest="port", type=int,
+    default=rand.randint(1, 10000) + 40000, choices=range(40001, 50000),
+    help="Set the port to listen to. Must be in the range "
+         "40001 .. 50000. The default value is chosen at random."
+)
+parser.add_argument(
+    "-t", "--type", metavar="TYPE", dest="type", default=object_type,
+    help="Set the type of the peers."
+)
+parser.add_argument(
+    "-k", "--kind", metavar="KIND", dest="kind", default="mutex",
+    choices=["mutex", "chat"],
+    help="The peers to run: 'mutex' (default) or 'chat'."
+)
+parser.add_argument(
+    "-n", "--peers", metavar="N", dest="peers", type=int, default=10,
+    help="Number of peers. The default value is 10."
+)
+parser.add_argument(
+    "-e", "--engine", metavar="ENGINE", dest="engine",
+    default=DEFAULT_ENGINE, choices=sorted(ENGINES),
+    help="The mutual exclusion algorithm of the mutex peers."
+)
+parser.add_argument(
+    "--history-dir", metavar="DIR", dest="history_dir", default=None,
+    help="Directory of the message logs of the chat peers. A temporary "
+         "one by default."
+)
+parser.add_argument(
+    "--workload", dest="workload", action="store_true",
+    help="Run the synthetic workload on every peer, then exit."
+)
+parser.add_argument(
+    "--think", metavar="SECONDS", dest="think", type=float, default=0.5,
+    help="Mutex peers: mean time between a release and the next acquire."
+)
+parser.add_argument(
+    "--hold", metavar="SECONDS", dest="hold", type=float, default=0.05,
+    help="Mutex peers: mean time the lock is held."
+)
+parser.add_argument(
+    "--rate", metavar="N", dest="rate", type=float, default=1.0,
+    help="Chat peers: messages sent per second by every peer."
+)
+parser.add_argument(
+    "--size", metavar="BYTES", dest="size", type=int, default=32,
+    help="Chat peers: size of the messages."
+)
+parser.add_argument(
+    "--mode", metavar="MODE", dest="mode", default="direct",
+    choices=["direct", "broadcast", "group"],
+    help="Chat peers: 'direct' (default), 'broadcast' or 'group'."
+)
+parser.add_argument(
+    "--duration", metavar="SECONDS", dest="duration", type=float,
+    default=60.0, help="Length of the workload (60s)."
+)
+parser.add_argument(
+    "--operations", metavar="N", dest="operations", type=int, default=None,
+    help="Stop the workload of a peer after N operations."
+)
+parser.add_argument(
+    "--seed", metavar="SEED", dest="seed", type=int, default=None,
+    help="Seed of the workloads."
+)
+parser.add_argument(
+    "--results", metavar="FILE", dest="results", default=None,
+    help="Write the timing of every operation to FILE, one JSON record "
+         "per line."
+)
+parser.add_argument(
+    "--bulk-workers", metavar="N", dest="bulk_workers", type=int,
+    default=lanes.budgets[lanes.BULK],
+    help="Serve at most N bulk requests (chat messages) at a time; 0 for "
+         "no limit ({}).".format(lanes.budgets[lanes.BULK])
+)
+opts = parser.parse_args()
+lanes.budgets[lanes.BULK] = opts.bulk_workers or None
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+host = orb.PeerHost((socket.gethostname(), opts.port))
+history_dir = opts.history_dir or tempfile.mkdtemp(prefix="chat-")
+peers = [None] * opts.peers
+
+
+def create(i):
+    if opts.kind == "chat":
+        peers[i] = chatPeer.Client(
+            None, name_service_address, opts.type, host=host,
+            history_file=os.path.join(history_dir, "chat-{}.log".format(i)))
+    else:
+        peers[i] = mutexPeer.Client(
+            None, name_service_address, opts.type, engine=opts.engine,
+            host=host)
+
+
+# All at once: the name server announces the peers joining together in
+# one call per member (see NameServer.join).
+creators = [threading.Thread(target=create, args=(i,))
+            for i in range(opts.peers)]
+for thread in creators:
+    thread.start()
+for thread in creators:
+    thread.join()
+peers = [p for p in peers if p is not None]
+print("{} {} peers running at {}.".format(len(peers), opts.kind,
+                                          host.address))
+
+
+def run(p, results, seed):
+    workload = Workload(seed, opts.duration, opts.operations)
+    if opts.kind == "chat":
+        chatPeer.run_workload(p, workload, results, opts.rate, opts.size,
+                              opts.mode)
+    else:
+        mutexPeer.run_workload(p, workload, results, opts.think, opts.hold)
+
+
+if opts.workload:
+    results = Results(opts.results)
+    threads = [threading.Thread(
+        target=run, args=(p, results, None if opts.seed is None
+                          else opts.seed + i)) for i, p in enumerate(peers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+else:
+    try:
+        while input("Type q to stop the peers.\n") != "q":
+            pass
+    except (KeyboardInterrupt, EOFError):
+        pass
+
+
+def destroy(p):
+    p.destroy()
+    host.remove(p)
+
+
+destroyers = [threading.Thread(target=destroy, args=(p,)) for p in peers]
+for thread in destroyers:
+    thread.start()
+for thread in destroyers:
+    thread.join()
+if opts.history_dir is None:
+    shutil.rmtree(history_dir, ignore_errors=True)
+if opts.workload:
+    report(results)
+    sys.exit(1 if results.errors() else 0)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Profile a running peer, or the name server, from the outside.
+
+    profilePeer.py -a HOST:PORT[:OBJECT] start sampling 10
+    profilePeer.py --name-server start deterministic 30 ns.prof
+    profilePeer.py -a HOST:PORT stop
+    profilePeer.py -a HOST:PORT status
+    profilePeer.py -a HOST:PORT stacks [FILE]
+
+The results are written by the profiled process, in its own working
+directory; start and stop print the name of the file.
+"""
+
+import sys
+import json
+import time
+import argparse
+sys.path.append("../modules")
+from Common import orb
+from Common.profiling import MODES
+from Common.nameServiceLocation import name_service_address
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+description = """Start, stop or inspect a profiling session of a peer."""
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-a", "--address", metavar="HOST:PORT[:OBJECT]", dest="address",
+    default=None,
+    help="Address of the peer; OBJECT for a peer of a peerHost.py."
+)
+parser.add_argument(
+    "--name-server", dest="name_server", action="store_true",
+    help="Profile the name server."
+)
+parser.add_argument(
+    "--wait", dest="wait", action="store_true",
+    help="With start: wait until the session is over."
+)
+parser.add_argument(
+    "command", metavar="COMMAND", choices=["start", "stop", "status", "stacks"],
+    help="start MODE SECONDS [FILE], stop, status or stacks [FILE]."
+)
+parser.add_argument("args", metavar="ARG", nargs="*")
+opts = parser.parse_args()
+
+if opts.name_server:
+    address = name_service_address
+elif opts.address is not None:
+    words = opts.address.split(":")
+    address = [words[0]] + [int(w) for w in words[1:]]
+else:
+    parser.error("Give the address of the peer, or --name-server.")
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+target = orb.Stub(address)
+if opts.command == "start":
+    if len(opts.args) < 2 or opts.args[0] not in MODES:
+        parser.error("start MODE SECONDS [FILE], MODE one of {}".format(
+            ", ".join(MODES)))
+    seconds = float(opts.args[1])
+    path = target.profile_start(opts.args[0], seconds, *opts.args[2:3])
+    print("Profiling into {}".format(path))
+    if opts.wait:
+        time.sleep(seconds)
+        while target.profile_status()["running"]:
+            time.sleep(0.5)
+        print("Done.")
+elif opts.command == "stop":
+    path = target.profile_stop()
+    print("No session was running." if path is None
+          else "Profile written to {}".format(path))
+elif opts.command == "status":
+    print(json.dumps(target.profile_status(), indent=2, sort_keys=True))
+else:
+    print(target.profile_stacks(*opts.args[:1]))
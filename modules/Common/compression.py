@@ -0,0 +1,145 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Compression of the large messages sent over TCP by the ORB.
+
+A message is one line of JSON. One that is at least threshold long is
+sent as
+
+    Z<base64 of the zlib compressed JSON>
+
+if that is shorter. Compression is negotiated in the JSON itself, so
+that peers without it keep working. A Stub offers it by ending its
+request with the key KEY (see offer), which a Skeleton without
+compression ignores. A Skeleton that has compression may then compress
+the answer, and it adds the same key to the answer. Once a Stub has
+seen that key, it compresses its large requests to that Skeleton; a
+compressed request implies the offer. A Skeleton
+never compresses an answer that was not asked for, so plain clients
+keep getting plain JSON. Messages through shared memory or within the
+process are not compressed.
+
+level (zlib's, 1 to 9) trades CPU for size; threshold None turns
+compression off. stats() reports how much was saved and the CPU time it
+took.
+"""
+
+import zlib
+import time
+import base64
+import binascii
+import threading
+
+MARK = "Z"
+# The key of the offer, and of the acceptance, at the end of the JSON.
+KEY = "accept"
+OFFER = ', "{}": "zlib"}}'.format(KEY)
+
+threshold = 1024
+level = 6
+
+
+class Stats(object):
+
+    """Bytes and CPU time spent on compression in this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.compressed = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.compress_time = 0.0
+        self.decompressed = 0
+        self.decompress_time = 0.0
+
+    def add(self, **amounts):
+        self.lock.acquire()
+        try:
+            for name, amount in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return {
+                "compressed": self.compressed,
+                "skipped": self.skipped,
+                "raw_bytes": self.raw_bytes,
+                "sent_bytes": self.sent_bytes,
+                "ratio": (self.raw_bytes / self.sent_bytes
+                          if self.sent_bytes else None),
+                "compress_cpu": self.compress_time,
+                "decompressed": self.decompressed,
+                "decompress_cpu": self.decompress_time,
+                "threshold": threshold,
+                "level": level
+            }
+        finally:
+            self.lock.release()
+
+
+counters = Stats()
+
+
+def encode(text):
+    """Return the line to send for the message text."""
+
+    if threshold is None or len(text) < threshold:
+        return text
+    start = time.thread_time()
+    data = zlib.compress(text.encode("utf-8"), level)
+    line = MARK + base64.b64encode(data).decode("ascii")
+    spent = time.thread_time() - start
+    if len(line) >= len(text):
+        # Not worth it (already compressed, random...).
+        counters.add(skipped=1, compress_time=spent)
+        return text
+    counters.add(compressed=1, raw_bytes=len(text), sent_bytes=len(line),
+                 compress_time=spent)
+    return line
+
+
+def decode(line):
+    """Return the message text of a line received."""
+
+    if not line.startswith(MARK):
+        return line
+    start = time.thread_time()
+    try:
+        text = zlib.decompress(
+            base64.b64decode(line[len(MARK):].strip())).decode("utf-8")
+    except (binascii.Error, zlib.error) as e:
+        raise ValueError("Bad compressed message: {}".format(e))
+    counters.add(decompressed=1,
+                 decompress_time=time.thread_time() - start)
+    # Compressed or not, a message ends up a line.
+    return text + "\n" if line.endswith("\n") else text
+
+
+def offer(text):
+    """Return the message text (a JSON object) with the offer added."""
+    return text[:-1] + OFFER
+
+
+def offered(line):
+    """Tell whether a request line (as received) takes a compressed
+    answer: it was compressed, or ends with the offer."""
+    return line.startswith(MARK) or line.rstrip().endswith(OFFER)
+
+
+def accept(text):
+    """Return the answer text with the acceptance added."""
+    return offer(text)
+
+
+def accepted(text):
+    """Tell whether an answer text carries the acceptance."""
+    return text.rstrip().endswith(OFFER)
+
+
+def stats():
+    return counters.snapshot()
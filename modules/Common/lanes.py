@@ -0,0 +1,157 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Priority lanes for the requests served by a Skeleton.
+
+Every method belongs to a lane: CONTROL for the calls that must not wait
+(the token of the lock, the liveness checks of the name server), BULK
+for the traffic that may (chat messages), NORMAL for the rest. An owner
+says which of its methods are not NORMAL in its priorities attribute,
+a dictionary from method name to lane.
+
+Each lane has its own queue and a budget, the number of its requests
+that may run at the same time (None: no limit). A request waits in the
+queue of its lane while the budget is used up, or while requests of a
+lane of higher priority are waiting; when one finishes, the waiting
+requests are let in highest priority first. With the default budgets
+only the BULK lane ever waits, so a flood of messages keeps a bounded
+number of threads busy and the control calls get the processor.
+"""
+
+import re
+import time
+import threading
+from collections import deque
+
+CONTROL = "control"
+NORMAL = "normal"
+BULK = "bulk"
+
+# The lanes, highest priority first, and their budgets.
+ORDER = [CONTROL, NORMAL, BULK]
+budgets = {CONTROL: None, NORMAL: None, BULK: 2}
+
+# The method of a request made by a Stub, see orb.json_dumps_method.
+METHOD = re.compile(r'\s*\{\s*"method"\s*:\s*"([^"\\]*)"')
+
+
+class Lane(object):
+
+    """The queue, budget and counters of one lane."""
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.running = 0
+        self.waiting = deque()
+        self.served = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.max_waiting = 0
+
+    def has_room(self):
+        return self.budget is None or self.running < self.budget
+
+    def snapshot(self):
+        return {
+            "budget": self.budget,
+            "running": self.running,
+            "waiting": len(self.waiting),
+            "served": self.served,
+            "waited": self.waited,
+            "mean_wait": (self.wait_time / self.waited
+                          if self.waited else 0.0),
+            "max_wait": self.max_wait,
+            "max_waiting": self.max_waiting
+        }
+
+
+class Lanes(object):
+
+    """Admission of the requests of a Skeleton, lane by lane."""
+
+    def __init__(self, lane_budgets=None):
+        lane_budgets = lane_budgets if lane_budgets is not None else budgets
+        self.lock = threading.Lock()
+        self.lanes = [Lane(name, lane_budgets.get(name)) for name in ORDER]
+        self.by_name = dict((lane.name, lane) for lane in self.lanes)
+
+    # Public methods
+
+    def lane_of(self, owner, request):
+        """Return the lane of request (JSON) made to owner."""
+        match = METHOD.match(request)
+        if match is None:
+            return self.by_name[NORMAL]
+        name = getattr(owner, "priorities", {}).get(match.group(1), NORMAL)
+        return self.by_name.get(name, self.by_name[NORMAL])
+
+    def enter(self, lane):
+        """Wait for the turn of a request in lane."""
+        self.lock.acquire()
+        try:
+            lane.served += 1
+            if lane.has_room() and not self._queued_up_to(lane):
+                lane.running += 1
+                return
+            ticket = threading.Event()
+            lane.waiting.append(ticket)
+            lane.max_waiting = max(lane.max_waiting, len(lane.waiting))
+        finally:
+            self.lock.release()
+        start = time.monotonic()
+        ticket.wait()
+        waited = time.monotonic() - start
+        self.lock.acquire()
+        try:
+            lane.waited += 1
+            lane.wait_time += waited
+            lane.max_wait = max(lane.max_wait, waited)
+        finally:
+            self.lock.release()
+
+    def leave(self, lane):
+        """A request of lane is done; let the next ones in."""
+        self.lock.acquire()
+        try:
+            lane.running -= 1
+            self._admit()
+        finally:
+            self.lock.release()
+
+    def set_budget(self, name, budget):
+        self.lock.acquire()
+        try:
+            self.by_name[name].budget = budget
+            self._admit()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return dict((lane.name, lane.snapshot()) for lane in self.lanes)
+        finally:
+            self.lock.release()
+
+    # Private methods
+
+    def _queued_up_to(self, lane):
+        """Tell whether requests of lane, or of a lane before it, wait."""
+        for other in self.lanes:
+            if other.waiting:
+                return True
+            if other is lane:
+                return False
+
+    def _admit(self):
+        # Lock held. A lane that cannot take its first request holds back
+        # the lanes after it.
+        for lane in self.lanes:
+            while lane.waiting and lane.has_room():
+                lane.running += 1
+                lane.waiting.popleft().set()
+            if lane.waiting:
+                return
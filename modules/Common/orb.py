@@ -7,12 +7,22 @@
 # Copyright 2012 Linkoping University
 # -----------------------------------------------------------------------------
 
+import os
 import threading
+import itertools
 import socket
+import random
 import json
+import time
+import uuid
 import logging
 import traceback
+from collections import OrderedDict
 from json import JSONDecodeError
+from Common import profiling
+from Common import compression
+from Common import lanes
+from Common import ringTransport
 
 """Object Request Broker
 
@@ -29,10 +39,50 @@ objects that communicate via networks. This infrastructure consists of:
         Class that implements basic bidirectional (Stub/Skeleton)
         communication. Any object wishing to transparently interact with
         remote objects should extend this class.
+--  PeerHost ::
+        Runs many peers in one process behind a single Skeleton. The
+        address of a hosted peer carries a third element, its object id,
+        which Stubs send along with every request so that the Skeleton
+        can route it. Calls between peers of the same process do not go
+        through the network at all.
+
+Calls to a Skeleton of another process on the same host go through
+shared memory instead of a new TCP connection (see ringTransport),
+unless shared_memory is set to False.
+
+Every request carries a call id, unique to the call. A Stub whose
+connection breaks before the answer comes sends the request again, with
+the same id, and the Skeleton answers a repeated id from its ReplyCache
+instead of running the call twice.
+
+Large messages over TCP are compressed, see compression.
+
+A Skeleton serves the requests in priority lanes (see lanes): the
+priorities attribute of its owner puts a method in the CONTROL or the
+BULK lane, and bulk requests wait while control ones are served.
+
+A Peer given an identity file keeps its id there. Stopped by suspend()
+instead of destroy(), it stays in its group, and takes the id back from
+the name server (NameServer.reclaim) when it starts again.
 """
 
 log = logging
 
+# Objects hosted by the PeerHosts of this process, by address.
+local_objects = {}
+
+# Use the shared-memory transport for the Skeletons of this host.
+shared_memory = ringTransport.available
+# The addresses of this host; see is_local().
+local_hosts = None
+
+# The Skeletons known to take compressed requests, by address.
+compressing = set()
+
+# Call ids: this process, then a counter.
+client_id = uuid.uuid4().hex[:12]
+call_counter = itertools.count()
+
 class ComunicationError(Exception):
     pass
 
@@ -62,39 +112,199 @@ def handle_JSONDecodeError(err):
         message.format(err.msg, err.lineno, err.colno, err.pos, err.doc))
     
 
-def json_dumps_method(method_name, args=[]):
-    return json.dumps({"method": method_name, "args": args})    
+def json_dumps_method(method_name, args=[], oid=None, call=None):
+    r = {"method": method_name, "args": args}
+    if oid is not None:
+        r["object"] = oid
+    if call is not None:
+        r["call"] = call
+    return json.dumps(r)
+
+def next_call_id():
+    return "{}-{}".format(client_id, next(call_counter))
 
 def json_dumps_result(result):
     return json.dumps({"result": result})
 
 def json_dumps_error(error):
-    return json.dumps({"error": {"name": error.__class__.__name__, "args": error.args}})
+    # The arguments are sent as text: they may not be serializable, and the
+    # receiving side only displays them.
+    args = [str(arg) for arg in error.args] or [""]
+    return json.dumps({"error": {"name": error.__class__.__name__, "args": args}})
+
+def process_request(owner, request, replies=None):
+    """Run a request (JSON) on owner and return the answer (JSON).
+
+    A request for a given object is run on owner.hosted_object(oid). A
+    request whose call id is in replies, a ReplyCache, is not run
+    again: the answer it got is returned.
+    """
+    try:
+        r = json.loads(request)
+    except JSONDecodeError as err:
+        handle_JSONDecodeError(err)
+    call = r.get("call") if isinstance(r, dict) else None
+    if replies is None or call is None:
+        return run_request(owner, r)
+    answer = replies.claim(call)
+    if answer is not None:
+        return answer
+    try:
+        answer = run_request(owner, r)
+    finally:
+        replies.complete(call, answer)
+    return answer
+
+def run_request(owner, r):
+    try:
+        if ("method" not in r.keys() or "args" not in r.keys()):
+            raise ProtocolError("Bad stuff")
+        method = r["method"]
+        args = r["args"]
+        if "object" in r:
+            owner = owner.hosted_object(r["object"])
+        call = getattr(owner, method)
+        profiler = profiling.active
+        if profiler is None:
+            result = call(*args)
+        else:
+            result = profiler.runcall(call, *args)
+        return json_dumps_result(result)
+    except Exception as detail:
+        # Report the error to the caller (as an ExternalError) instead
+        # of dropping the connection.
+        logging.info(traceback.format_exc())
+        return json_dumps_error(detail)
+
+def get_external_interface(address):
+    """ Determine the external interface associated with a host name.
+
+    This function translates the machine's host name into the
+    machine's external address, not into '127.0.0.1'.
+    """
+    logging.debug("get_external_interface({})".format(address))
+
+    addr_name = address[0]
+    if addr_name != "":
+        addrs = socket.gethostbyname_ex(addr_name)[2]
+        if len(addrs) == 0:
+            raise ComunicationError("Invalid address to listen to")
+        elif len(addrs) == 1:
+            addr_name = addrs[0]
+        else:
+            al = [a for a in addrs if a != "127.0.0.1"]
+            addr_name = al[0]
+    addr = list(address)
+    addr[0] = addr_name
+    return tuple(addr)
+
+def is_local(address):
+    """Tell whether address is on this host."""
+    global local_hosts
+    if local_hosts is None:
+        hosts = set(["127.0.0.1", "localhost"])
+        try:
+            hosts.update(socket.gethostbyname_ex(socket.gethostname())[2])
+        except socket.error:
+            pass
+        local_hosts = hosts
+    return address[0] in local_hosts
+
+class ReplyCache(object):
+    """The answers of the last calls served, by call id.
+
+    An answer is kept for ttl seconds, and at most size of them (calls
+    still running are never dropped). A repeated call that is still
+    running waits for the first one to finish and gets its answer.
+    """
+
+    def __init__(self, size=10000, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Condition()
+        # call id -> [answer (None while running), time]
+        self.entries = OrderedDict()
+        self.repeated = 0
+
+    def claim(self, call):
+        """Return the answer of call if it ran already, or None if the
+        caller is to run it."""
+        self.lock.acquire()
+        try:
+            now = time.monotonic()
+            self._evict(now)
+            entry = self.entries.get(call)
+            if entry is None:
+                self.entries[call] = [None, now]
+                return None
+            self.repeated += 1
+            while entry[0] is None and self.entries.get(call) is entry:
+                self.lock.wait()
+            if self.entries.get(call) is not entry:
+                # The first one failed, or was evicted: run it again.
+                self.entries[call] = [None, now]
+                return None
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def complete(self, call, answer):
+        """Record the answer of call; None if it failed without one."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(call)
+            if entry is not None:
+                if answer is None:
+                    del self.entries[call]
+                else:
+                    entry[0] = answer
+                    entry[1] = time.monotonic()
+                    self.entries.move_to_end(call)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def _evict(self, now):
+        # Only answers go: a call still running keeps its entry, or a
+        # retry of it would run it a second time. Completed entries are
+        # moved to the end, so the running ones gather at the front.
+        over = len(self.entries) - self.size
+        stale = []
+        for call, entry in self.entries.items():
+            if entry[0] is None:
+                continue
+            if over <= 0 and entry[1] >= now - self.ttl:
+                break
+            stale.append(call)
+            over -= 1
+        for call in stale:
+            del self.entries[call]
+
+# The ReplyCache of the Requests not started by a Skeleton.
+default_replies = ReplyCache()
 
 class Request(threading.Thread):
     """Run the incoming requests on the owner object of the skeleton."""
 
-    def __init__(self, owner, conn, addr):
+    def __init__(self, owner, conn, addr, replies=None, lanes=None):
         threading.Thread.__init__(self)
         self.addr = addr
         self.conn = conn
         self.owner = owner
+        self.replies = replies if replies is not None else default_replies
+        # Requests run at once when there are no lanes.
+        self.lanes = lanes
         self.daemon = True
         
     def process_request(self, request):
+        if self.lanes is None:
+            return process_request(self.owner, request, self.replies)
+        lane = self.lanes.lane_of(self.owner, request)
+        self.lanes.enter(lane)
         try:
-            r = json.loads(request)
-            if ("method" not in r.keys() or "args" not in r.keys()):
-                raise ProtocolError("Bad stuff")
-            method = r["method"]
-            args = r["args"]
-            result = getattr(self.owner, method).__call__(*args)
-            return json_dumps_result(result)
-        except OSError as detail:
-            logging.info(traceback.format_exc())
-            return json_dumps_error(detail)
-        except JSONDecodeError as err:
-            handle_JSONDecodeError(err)
+            return process_request(self.owner, request, self.replies)
+        finally:
+            self.lanes.leave(lane)
 
     def run(self):
         try:
@@ -102,10 +312,20 @@ class Request(threading.Thread):
             worker = self.conn.makefile(mode="rw")
             # Read the request in a serialized form (JSON).
             request = worker.readline()
+            if request.startswith(ringTransport.HELLO):
+                # Not a request: the connection stays open while the
+                # client uses the shared-memory channel.
+                ringTransport.serve(self.conn, request,
+                                    self.process_request)
+                return
+            accepts = compression.offered(request)
+            request = compression.decode(request)
             logging.debug("Request received: {}".format(request))
             # Process the request.
             result = self.process_request(request)
             logging.debug("Request processed. Sending result {}\n".format(result))
+            if accepts:
+                result = compression.encode(compression.accept(result))
             # Send the result.
             worker.write(str(result) + '\n')
             worker.flush()
@@ -117,29 +337,43 @@ class Stub(object):
     """ Stub for generic objects distributed over the network.
 
     This is a wrapper object for a socket.
+
+    A call whose connection breaks (but not one refused, the peer is not
+    there) is sent again up to retries times, after backoff seconds,
+    doubled every time. A retry refused is a ConnectionError, not a
+    ConnectionRefusedError: the call may have run before.
     """
 
+    retries = 2
+    backoff = 0.05
+
     def __init__(self, address):
         logging.debug("Stub.__init__()")
         self.address = tuple(address)
+        # The object id of a peer hosted by a PeerHost.
+        self.oid = self.address[2] if len(self.address) > 2 else None
 
     def _rmi(self, method, *args):
         logging.debug("Stub._rmi({}, {})".format(method, args))
+        owner = local_objects.get(self.address)
         try:
-            conn = socket.create_connection(self.address)
-            # Treat the socket as a file stream.
-            worker = conn.makefile(mode="rw")
-            msg = json_dumps_method(method, args)
-            logging.debug("Stub sending JSON message: {}".format(msg))
-            worker.write(msg + '\n')
-            worker.flush()
-            # Read the request in a serialized form (JSON).
-            answer = worker.readline()
+            if owner is not None:
+                # Hosted in this process: the request is run right here,
+                # on this thread, but still goes through JSON so that
+                # the call behaves exactly as a remote one.
+                answer = process_request(owner,
+                                         json_dumps_method(method, args))
+            else:
+                answer = self._retry(
+                    json_dumps_method(method, args, self.oid,
+                                      next_call_id()))
             logging.debug(answer)
             # Process the request.
             response = json.loads(answer)
             
-            if (set(response.keys()) != set(["error"]) and set(response.keys()) != set(["result"])):
+            # The acceptance of compression aside (see compression).
+            keys = set(response.keys()) - set([compression.KEY])
+            if (keys != set(["error"]) and keys != set(["result"])):
                 raise ProtocolError("Bad key(s):", response)
             if ("error" in response.keys()):
                 throw_ExternalError(response)
@@ -147,9 +381,70 @@ class Stub(object):
             result = response["result"]
             return result
         except JSONDecodeError as err:
-            conn.close()
             handle_JSONDecodeError(err)
 
+    def _retry(self, msg):
+        """Exchange msg, again if the connection breaks."""
+        delay = self.backoff
+        attempt = 0
+        while True:
+            try:
+                answer = self._exchange(msg)
+                # No answer at all: the connection was closed.
+                if answer or attempt >= self.retries:
+                    return answer
+            except ConnectionRefusedError as e:
+                if attempt == 0:
+                    raise
+                # A refusal means nothing was sent, but an attempt before
+                # may have got through.
+                raise ConnectionError("{} (after a broken attempt)".format(
+                    e))
+            except socket.error as e:
+                if attempt >= self.retries:
+                    raise
+                logging.info("Call to {} failed ({}), retrying".format(
+                    self.address, e))
+            attempt += 1
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+
+    def _exchange(self, msg):
+        """Send msg to the Skeleton and return the answer.
+
+        Through the shared-memory channel to it if it is on this host,
+        over a new connection otherwise.
+        """
+        if shared_memory and is_local(self.address):
+            channel = ringTransport.connect(self.address[:2])
+            if channel is not None:
+                return channel.call(msg)
+        address = self.address[:2]
+        line = msg
+        if compression.threshold is not None:
+            # Compress the request if the Skeleton took the offer
+            # before, offer to take a compressed answer otherwise (a
+            # compressed request implies it).
+            if address in compressing:
+                line = compression.encode(msg)
+            if line is msg:
+                line = compression.offer(msg)
+        conn = socket.create_connection(address)
+        try:
+            # Treat the socket as a file stream.
+            worker = conn.makefile(mode="rw")
+            logging.debug("Stub sending JSON message: {}".format(msg))
+            worker.write(line + '\n')
+            worker.flush()
+            # Read the request in a serialized form (JSON).
+            answer = worker.readline()
+        finally:
+            conn.close()
+        answer = compression.decode(answer)
+        if address not in compressing and compression.accepted(answer):
+            compressing.add(address)
+        return answer
+
     def __getattr__(self, attr):
         """Forward call to name over the network at the given address."""
         logging.debug("Stub.__getattr__({})".format(attr))
@@ -162,28 +457,37 @@ class Skeleton(threading.Thread):
     """ Skeleton class for a generic owner.
 
     This is used to listen to an address of the network, manage incoming
-    connections and forward calls to the generic owner class.
+    connections and forward calls to the generic owner class. Calls sent
+    again by a Stub are answered from self.replies; calls are let in
+    through self.lanes.
     """
 
-    def __init__(self, owner, address):
+    def __init__(self, owner, address, backlog=1):
         logging.debug("Skeleton.__init__()")
         threading.Thread.__init__(self)
         self.address = address
         self.owner = owner
+        self.backlog = backlog
+        self.replies = ReplyCache()
+        self.lanes = lanes.Lanes()
         self.daemon = True
 
     def run(self):
         logging.debug("Skeleton.run()")
         listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A peer restarted on its old address (see Peer.suspend) must not
+        # wait for the connections of the previous one to time out.
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         listener.bind(self.address)
-        listener.listen(1)
+        listener.listen(self.backlog)
         logging.debug("Skeleton running at: {}".format(self.address))
         logging.info("Press Ctrl-C to stop the peer...")
         try:
             while True:
                 try:
                     conn, addr = listener.accept()
-                    req = Request(self.owner, conn, addr)
+                    req = Request(self.owner, conn, addr, self.replies,
+                                  self.lanes)
                     logging.info("Serving a request from {0}".format(addr))
                     req.start()
                 except socket.error as socket_error:
@@ -198,39 +502,86 @@ class Skeleton(threading.Thread):
 class Peer(object):
     """Class, extended by objects that communicate over the network."""
 
-    def __init__(self, l_address, ns_address, ptype):
+    # The lanes of the methods not in lanes.NORMAL, see Skeleton.
+    priorities = {"check": lanes.CONTROL}
+    # Whether an identity saved without state (by a peer that crashed
+    # instead of calling suspend) may be reclaimed.
+    resume_after_crash = True
+
+    def __init__(self, l_address, ns_address, ptype, host=None,
+                 identity_file=None):
         logging.debug("Peer.__init__()")
         self.type = ptype
         self.hash = ""
         self.id = -1
-        self.address = self._get_external_interface(l_address)
-        self.skeleton = Skeleton(self, self.address)
+        self.host = host
+        if host is None:
+            self.address = self._get_external_interface(l_address)
+            self.skeleton = Skeleton(self, self.address)
+        else:
+            # l_address is ignored: we are reached through the host.
+            self.address = host.add(self)
+            self.skeleton = host.skeleton
         self.name_service_address = self._get_external_interface(ns_address)
         self.name_service = Stub(self.name_service_address)
+        self.profiler = profiling.Profiler(ptype)
+        # Warm restart: where the identity is kept (None: nowhere), and,
+        # once it was reclaimed, the state saved with it and the group
+        # as the name server returned it.
+        self.identity_file = identity_file
+        self.resumed = None
+        self.reclaimed_peers = None
+        # Set by a PeerList once we joined the group: we then leave it
+        # through the name server (see NameServer.leave), not unregister.
+        self.joined = False
 
     # Private methods
 
     def _get_external_interface(self, address):
-        """ Determine the external interface associated with a host name.
+        return get_external_interface(address)
 
-        This function translates the machine's host name into the
-        machine's external address, not into '127.0.0.1'.
-        """
-        logging.debug("Peer._get_external_interface(self, {})".format(address))
-
-        addr_name = address[0]
-        if addr_name != "":
-            addrs = socket.gethostbyname_ex(addr_name)[2]
-            if len(addrs) == 0:
-                raise ComunicationError("Invalid address to listen to")
-            elif len(addrs) == 1:
-                addr_name = addrs[0]
-            else:
-                al = [a for a in addrs if a != "127.0.0.1"]
-                addr_name = al[0]
-        addr = list(address)
-        addr[0] = addr_name
-        return tuple(addr)
+    def _load_identity(self):
+        """Return the identity saved in self.identity_file, or None."""
+        if self.identity_file is None:
+            return None
+        try:
+            with open(self.identity_file) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Identity in {} not read: {}".format(
+                self.identity_file, e))
+            return None
+        if saved.get("type") != self.type:
+            return None
+        return saved
+
+    def _save_identity(self, state=None):
+        if self.identity_file is None:
+            return
+        saved = {"type": self.type, "id": self.id, "hash": self.hash}
+        if state is not None:
+            saved["state"] = state
+        # Replaced in one step, so that a crash never leaves half a file.
+        path = self.identity_file + ".tmp"
+        with open(path, "w") as f:
+            json.dump(saved, f)
+        os.replace(path, self.identity_file)
+
+    def _reclaim(self, saved):
+        """Take the saved identity back; returns whether it worked."""
+        if saved.get("state") is None and not self.resume_after_crash:
+            # Our state is lost with the old process: the old id goes.
+            self.name_service.leave(self.type, saved["id"])
+            return False
+        claimed = self.name_service.reclaim(self.type, saved["id"],
+                                            saved["hash"], self.address)
+        if claimed is None:
+            return False
+        self.id, self.hash, self.reclaimed_peers = claimed
+        self.resumed = saved.get("state", {})
+        return True
 
     # Public methods
 
@@ -239,23 +590,206 @@ class Peer(object):
         
         logging.debug("Peer starting...")
         logging.debug("Peer starting Skeleton...")
-        self.skeleton.start()
+        if self.host is None:
+            self.skeleton.start()
+        else:
+            self.host.start()
 
         logging.debug("Peer done starting Skeleton!")
-        logging.debug("Peer registering name service...")
-        self.id, self.hash = self.name_service.register(self.type,
-                                                        self.address)
-        logging.debug("Peer done registering name service!\n{}"
-                      .format((self.id, self.hash)))
+        saved = self._load_identity()
+        if saved is not None and self._reclaim(saved):
+            logging.info("Peer reclaimed its id {}".format(self.id))
+        else:
+            logging.debug("Peer registering name service...")
+            if self.host is None:
+                self.id, self.hash = self.name_service.register(
+                    self.type, self.address)
+            else:
+                self.id, self.hash = self.host.register(
+                    self.name_service, self.type, self.address)
+            logging.debug("Peer done registering name service!\n{}"
+                          .format((self.id, self.hash)))
+        # Without state: what a crash from now on would leave behind.
+        self._save_identity()
+        self.profiler.name = "{}-{}".format(self.type, self.id)
 
     def destroy(self):
         """Unregister the object before removal."""
 
-        logging.debug("Peer unregistering from name service...")
-        self.name_service.unregister(self.id, self.type, self.hash)
-        logging.debug("Peer unregistered from name service")
+        # A profiling session still running is cut short, not lost.
+        self.profiler.stop()
+        if not self.joined:
+            logging.debug("Peer unregistering from name service...")
+            self.name_service.unregister(self.id, self.type, self.hash)
+            logging.debug("Peer unregistered from name service")
+        # Gone for good: the id is not to be reclaimed.
+        if self.identity_file is not None and \
+                os.path.exists(self.identity_file):
+            os.remove(self.identity_file)
+
+    def suspend(self, state=None):
+        """Stop without leaving the group, saving our identity and state
+        (of the subclass, JSON) for the next start to reclaim.
+
+        The other peers keep us in their lists meanwhile; calls to us
+        fail until we are back.
+        """
+
+        if self.identity_file is None:
+            raise ValueError("No identity file to save the identity to.")
+        self.profiler.stop()
+        self._save_identity(state if state is not None else {})
+        logging.debug("Peer suspended, identity saved to {}".format(
+            self.identity_file))
 
     def check(self):
         """Checking to see if the object is still alive."""
         logging.info("Name server is checking me; I am responding with {}".format((self.id, self.type)))
         return (self.id, self.type)
+
+    def lane_stats(self):
+        """How the requests of each lane were served, see lanes."""
+        return self.skeleton.lanes.stats()
+
+    def compression_stats(self):
+        """What compressing the large messages saved, and cost."""
+        return compression.stats()
+
+    def profile_start(self, mode, seconds, path=None):
+        """Profile this process for seconds seconds (see profiling);
+        returns the file the results go to."""
+        return self.profiler.start(mode, seconds, path)
+
+    def profile_stop(self):
+        return self.profiler.stop()
+
+    def profile_status(self):
+        return self.profiler.status()
+
+    def profile_stacks(self, path=None):
+        """Return the stacks of all the threads of this process."""
+        return self.profiler.stacks(path)
+
+
+class Registration(object):
+    """Hosted peers registering together, see PeerHost.register."""
+
+    def __init__(self):
+        self.addresses = []
+        self.entries = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PeerHost(object):
+    """Host many peers in one process, behind a single Skeleton.
+
+    Pass the host to the constructor of every Peer to be hosted. Each
+    one gets the address (host, port, object id); the Skeleton routes
+    the requests by object id, and Stubs of this process call hosted
+    peers directly.
+    """
+
+    # Hosted peers registering within this many seconds of each other
+    # are registered together.
+    batch_window = 0.2
+
+    def __init__(self, address):
+        self.address = get_external_interface(address)
+        self.skeleton = Skeleton(self, self.address,
+                                 backlog=socket.SOMAXCONN)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.next_oid = 0
+        # Those of all the peers hosted; lanes go by method name.
+        self.priorities = {}
+        self.started = False
+        # The registrations being collected, by (name service, type),
+        # and when the last one of each came.
+        self.registering = {}
+        self.last_registration = {}
+
+    def add(self, obj):
+        """Host obj; returns its address."""
+        self.lock.acquire()
+        try:
+            oid = self.next_oid
+            self.next_oid += 1
+            self.objects[oid] = obj
+            self.priorities.update(getattr(obj, "priorities", {}))
+            address = self.address + (oid,)
+            local_objects[address] = obj
+            return address
+        finally:
+            self.lock.release()
+
+    def remove(self, obj):
+        """Stop hosting obj, e.g. once it was destroyed."""
+        self.lock.acquire()
+        try:
+            oid = obj.address[2]
+            if self.objects.get(oid) is obj:
+                del self.objects[oid]
+                local_objects.pop(obj.address, None)
+        finally:
+            self.lock.release()
+
+    def register(self, name_service, obj_type, address):
+        """Register a hosted peer with name_service; returns its (id,
+        hash).
+
+        The peers of the host registering within batch_window of each
+        other do it with a single register_many call. The first one of
+        a burst is registered at once, the others wait for the window
+        to close (as NameServer.join does).
+        """
+        key = (name_service.address[:2], obj_type)
+        now = time.monotonic()
+        self.lock.acquire()
+        try:
+            batch = self.registering.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.registering[key] = Registration()
+            index = len(batch.addresses)
+            batch.addresses.append(address)
+            busy = now - self.last_registration.get(key, float("-inf")) \
+                < self.batch_window
+            self.last_registration[key] = now
+        finally:
+            self.lock.release()
+
+        if not leader:
+            batch.done.wait()
+        else:
+            if busy:
+                time.sleep(self.batch_window)
+            self.lock.acquire()
+            del self.registering[key]
+            self.lock.release()
+            try:
+                batch.entries = name_service.register_many(obj_type,
+                                                           batch.addresses)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        if batch.error is not None:
+            raise batch.error
+        return batch.entries[index]
+
+    def hosted_object(self, oid):
+        obj = self.objects.get(oid)
+        if obj is None:
+            raise KeyError("No object with id {} is hosted here.".format(oid))
+        return obj
+
+    def start(self):
+        """Start the Skeleton, once."""
+        self.lock.acquire()
+        try:
+            if not self.started:
+                self.started = True
+                self.skeleton.start()
+        finally:
+            self.lock.release()
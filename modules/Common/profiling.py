@@ -0,0 +1,244 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Profiling sessions started and stopped from a distance.
+
+Every Peer, and the name server, has a Profiler and exposes it through
+the profile_start/profile_stop/profile_status/profile_stacks methods, so
+that a running process can be profiled without restarting it (see
+lab4/profilePeer.py). Nothing is installed while no session runs.
+
+Two kinds of sessions:
+
+--  deterministic ::
+        cProfile on the remote calls served by the process, in whatever
+        thread they run (orb.process_request runs them through
+        runcall()). One such session at a time in a process. The result
+        is a pstats file (python3 -m pstats FILE).
+--  sampling ::
+        A thread records the stack of every other thread each interval
+        seconds, background threads included. Cheap enough for a loaded
+        process; the result is a text file of "frame;...;frame count"
+        lines, the input format of the usual flame graph tools.
+
+A session stops after the given number of seconds, or when stopped.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import traceback
+
+DETERMINISTIC = "deterministic"
+SAMPLING = "sampling"
+MODES = [DETERMINISTIC, SAMPLING]
+
+# The Profiler running a deterministic session in this process, if any.
+active = None
+
+
+def format_stacks():
+    """The current stack of every thread, as text."""
+
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append("Thread {} ({}):\n".format(
+            names.get(ident, "?"), ident))
+        lines.extend(traceback.format_stack(frame))
+        lines.append("\n")
+    return "".join(lines)
+
+
+class Profiler(object):
+
+    """One profiling session at a time; results go to files in directory."""
+
+    def __init__(self, name="peer", directory="."):
+        self.name = name
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.mode = None
+        self.path = None
+        self.started = None
+        self.timer = None
+        # Deterministic sessions: thread -> [cProfile.Profile, call depth].
+        self.threads = {}
+        # Sampling sessions: collapsed stack -> count.
+        self.samples = {}
+        self.sampler = None
+        self.stopped = None
+
+    # Public methods
+
+    def start(self, mode=SAMPLING, seconds=10.0, path=None, interval=0.005):
+        """Start a session; returns the file the results will go to."""
+
+        global active
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode: {}".format(mode))
+        self.lock.acquire()
+        try:
+            if self.mode is not None:
+                raise RuntimeError("A {} session is running already.".format(
+                    self.mode))
+            if mode == DETERMINISTIC:
+                if active is not None:
+                    raise RuntimeError("This process is being profiled "
+                                       "already.")
+                self.threads = {}
+                active = self
+            else:
+                self.samples = {}
+                self.stopped = threading.Event()
+                self.sampler = threading.Thread(
+                    target=self._sample, args=(self.stopped, interval))
+                self.sampler.daemon = True
+                self.sampler.start()
+            self.mode = mode
+            self.path = self._path(path, mode)
+            self.started = time.time()
+            self.timer = threading.Timer(seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+            logging.info("Profiling ({}) for {}s into {}".format(
+                mode, seconds, self.path))
+            return self.path
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Stop the session and write its results; returns their file
+        (None if no session was running)."""
+
+        global active
+        self.lock.acquire()
+        try:
+            if self.mode is None:
+                return None
+            self.timer.cancel()
+            if self.mode == DETERMINISTIC:
+                if active is self:
+                    active = None
+                self._write_profiles()
+            else:
+                self.stopped.set()
+                self.sampler.join()
+                self._write_samples()
+            path = self.path
+            logging.info("Profile written to {}".format(path))
+            self.mode = None
+            self.threads = {}
+            self.samples = {}
+            return path
+        finally:
+            self.lock.release()
+
+    def runcall(self, call, *args):
+        """Run call(*args), under the cProfile of this thread if a
+        deterministic session is running."""
+
+        ident = threading.get_ident()
+        self.lock.acquire()
+        try:
+            entry = None
+            if self.mode == DETERMINISTIC:
+                entry = self.threads.get(ident)
+                if entry is None:
+                    entry = self.threads[ident] = [cProfile.Profile(), 0]
+                entry[1] += 1
+        finally:
+            self.lock.release()
+        if entry is None:
+            return call(*args)
+        try:
+            if entry[1] == 1:
+                return entry[0].runcall(call, *args)
+            # A nested call (to a peer of this process): profiled already.
+            return call(*args)
+        finally:
+            self.lock.acquire()
+            try:
+                entry[1] -= 1
+            finally:
+                self.lock.release()
+
+    def status(self):
+        self.lock.acquire()
+        try:
+            if self.mode is None:
+                return {"running": False}
+            return {"running": True, "mode": self.mode, "path": self.path,
+                    "elapsed": time.time() - self.started}
+        finally:
+            self.lock.release()
+
+    def stacks(self, path=None):
+        """The stacks of all the threads; also written to path if given."""
+        text = format_stacks()
+        if path is not None:
+            path = self._path(path, "stacks")
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    # Private methods
+
+    def _path(self, path, kind):
+        if path is None:
+            path = "{}-{}-{}-{}.{}".format(
+                self.name, os.getpid(), kind, time.strftime("%Y%m%d-%H%M%S"),
+                "prof" if kind == DETERMINISTIC else "txt")
+        # Only a file name: remote callers do not choose the directory.
+        return os.path.join(self.directory, os.path.basename(path))
+
+    def _write_profiles(self):
+        stats = None
+        busy = 0
+        for profile, depth in self.threads.values():
+            if depth > 0:
+                # Still running a call; its profile is incomplete.
+                busy += 1
+                continue
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if busy:
+            logging.info("{} call(s) still running were left out of the "
+                         "profile.".format(busy))
+        if stats is None:
+            # Nothing ran: still leave a (valid, empty) file.
+            profile = cProfile.Profile()
+            profile.create_stats()
+            stats = pstats.Stats(profile)
+        stats.dump_stats(self.path)
+
+    def _sample(self, stopped, interval):
+        me = threading.get_ident()
+        while not stopped.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def _write_samples(self):
+        with open(self.path, "w") as f:
+            for key, count in sorted(self.samples.items()):
+                f.write("{} {}\n".format(key, count))
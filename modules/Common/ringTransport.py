@@ -0,0 +1,566 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Shared-memory transport for the ORB, between processes of one host.
+
+A process talking to a Skeleton of its own host opens one channel to it,
+shared by all its Stubs. A channel is a shared memory segment holding
+two ring buffers, one for the requests and one for the answers, each
+with a FIFO used as its doorbell. A frame is
+
+    call id (8 bytes) | length (4 bytes) | JSON request or answer
+
+The writer of a ring copies the frame in and moves the tail; the reader
+moves the head as it consumes it. A reader that finds its ring empty
+spins for a moment, then raises its waiting flag and sleeps on the
+doorbell; the writer only rings (one byte written to the FIFO) when the
+flag is up, so a busy channel makes no system call at all. Each side
+reads its ring in a single thread: the Skeleton side hands the requests
+to a pool of worker threads, the Stub side wakes up the caller waiting
+for the answer.
+
+The channel is set up over a TCP connection to the Skeleton, which is
+then kept open and idle: when it breaks, the process at the other end
+is gone and the channel is closed. The client only sends the name of
+the segment; the Skeleton finds the doorbells from it (see
+fifo_directory), and only uses them if they are FIFOs of its own user
+that nobody else may open. It refuses connections that do not come
+from its own host.
+"""
+
+import os
+import re
+import stat
+import queue
+import select
+import socket
+import struct
+import ipaddress
+import time
+import logging
+import tempfile
+import threading
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+    available = hasattr(os, "mkfifo")
+except ImportError:
+    available = False
+
+# First line sent over TCP to open a channel.
+HELLO = "ORB-SHM"
+# The names SharedMemory gives the segments it creates.
+NAME = re.compile(r"^/?[A-Za-z0-9_]+$")
+RING_SIZE = 1 << 18
+
+# Ring header: head, tail, waiting flag; padded to a cache line.
+HEADER = struct.Struct("=QQI")
+HEADER_SIZE = 64
+FRAME = struct.Struct("=QI")
+
+# Checks of an empty ring before going to sleep on the doorbell. Kept
+# short: the spinning thread holds the interpreter lock, which the
+# threads that are to answer may need.
+SPIN = 10
+# The doorbell may be missed (the waiting flag and the tail are not
+# fenced); the sleep is then cut short, after MIN_SLEEP at first and at
+# most MAX_SLEEP once the channel is idle.
+MIN_SLEEP = 0.001
+MAX_SLEEP = 1.0
+
+
+class NoChannel(Exception):
+    pass
+
+
+def fifo_directory(name):
+    """The directory of the doorbells of the segment name."""
+    return os.path.join(tempfile.gettempdir(), "orb-" + name.lstrip("/"))
+
+
+def is_local_peer(conn):
+    """Tell whether the other end of the TCP connection conn is a
+    process of this host: it connected over the loopback interface, or
+    from the address it reached us at."""
+    peer = conn.getpeername()[0]
+    return ipaddress.ip_address(peer).is_loopback or \
+        peer == conn.getsockname()[0]
+
+
+def _check_private(path, kind):
+    """Raise ValueError unless path is a kind (stat.S_ISDIR, ...) of
+    our own user that nobody else may use."""
+    st = os.lstat(path)
+    if not kind(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise ValueError("{} is not a private {} of ours".format(
+            path, "directory" if kind is stat.S_ISDIR else "FIFO"))
+
+
+class Ring(object):
+
+    """One direction of a channel: a ring buffer and its doorbell.
+
+    Only one thread may read a ring; writers take write_lock.
+    """
+
+    def __init__(self, buf, offset, size, doorbell):
+        self.buf = buf
+        self.header = offset
+        self.data = offset + HEADER_SIZE
+        self.size = size
+        self.doorbell = doorbell
+        self.write_lock = threading.Lock()
+        self.closed = False
+
+    # Public methods
+
+    def write(self, cid, data):
+        """Write one frame, waiting for space if the ring is full."""
+        self.write_lock.acquire()
+        try:
+            self._write(FRAME.pack(cid, len(data)) + data)
+        finally:
+            self.write_lock.release()
+
+    def read(self, lifeline):
+        """Read the next frame; returns (call id, data).
+
+        Raises ConnectionError when lifeline, a socket, is closed.
+        """
+        cid, length = FRAME.unpack(self._read(FRAME.size, lifeline))
+        return cid, self._read(length, lifeline)
+
+    # Private methods
+
+    def _get(self):
+        return HEADER.unpack_from(self.buf, self.header)
+
+    def _set_head(self, head):
+        struct.pack_into("=Q", self.buf, self.header, head)
+
+    def _set_tail(self, tail):
+        struct.pack_into("=Q", self.buf, self.header + 8, tail)
+
+    def _set_waiting(self, waiting):
+        struct.pack_into("=I", self.buf, self.header + 16, waiting)
+
+    def _write(self, data):
+        pos = 0
+        pause = 0.0
+        while pos < len(data):
+            if self.closed:
+                raise ConnectionError("The channel is closed.")
+            head, tail, waiting = self._get()
+            free = self.size - (tail - head)
+            if free == 0:
+                # The reader is behind: wait for it to make room.
+                pause = min(2 * pause or 0.0001, 0.01)
+                threading.Event().wait(pause)
+                continue
+            n = min(free, len(data) - pos)
+            start = tail % self.size
+            first = min(n, self.size - start)
+            self.buf[self.data + start:self.data + start + first] = \
+                data[pos:pos + first]
+            if first < n:
+                self.buf[self.data:self.data + n - first] = \
+                    data[pos + first:pos + n]
+            self._set_tail(tail + n)
+            pos += n
+            if self._get()[2] and not self.closed:
+                self._ring()
+
+    def _read(self, n, lifeline):
+        """Read n bytes, a piece at a time if they do not fit in."""
+        data = b""
+        while len(data) < n:
+            head = self._get()[0]
+            tail = self._wait(head, lifeline)
+            count = min(tail - head, n - len(data))
+            start = head % self.size
+            first = min(count, self.size - start)
+            data += bytes(self.buf[self.data + start:
+                                   self.data + start + first])
+            if first < count:
+                data += bytes(self.buf[self.data:self.data + count - first])
+            self._set_head(head + count)
+        return data
+
+    def _wait(self, head, lifeline):
+        """Wait until there is something after head; returns the tail."""
+        for _ in range(SPIN):
+            tail = self._get()[1]
+            if tail > head:
+                return tail
+        sleep = MIN_SLEEP
+        while True:
+            self._set_waiting(1)
+            tail = self._get()[1]
+            if tail > head:
+                self._set_waiting(0)
+                return tail
+            ready = select.select([self.doorbell, lifeline], [], [], sleep)[0]
+            self._set_waiting(0)
+            if self.doorbell in ready:
+                try:
+                    os.read(self.doorbell, 4096)
+                except BlockingIOError:
+                    pass
+            if lifeline in ready:
+                try:
+                    gone = not lifeline.recv(1)
+                except OSError:
+                    gone = True
+                if gone:
+                    self.closed = True
+                    raise ConnectionError(
+                        "The other end of the channel is gone.")
+            tail = self._get()[1]
+            if tail > head:
+                return tail
+            sleep = min(2 * sleep, MAX_SLEEP)
+
+    def _ring(self):
+        try:
+            os.write(self.doorbell, b"\0")
+        except BlockingIOError:
+            # The pipe is full: the reader has plenty of wake-ups.
+            pass
+
+
+# The names of the segments created by this process and not unlinked yet.
+created = set()
+
+
+class Segment(object):
+
+    """A shared memory segment with two rings and their doorbells."""
+
+    def __init__(self, name=None, ring_size=RING_SIZE):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=2 * (HEADER_SIZE + ring_size))
+            directory = fifo_directory(self.shm.name)
+            try:
+                os.mkdir(directory, 0o700)
+                fifos = [os.path.join(directory, d) for d in ("req", "ans")]
+                for fifo in fifos:
+                    os.mkfifo(fifo, 0o600)
+            except OSError:
+                self.shm.close()
+                self.shm.unlink()
+                raise
+            created.add(self.shm.name)
+        else:
+            # The name comes from the other end: only the doorbells of
+            # that segment, made by our own user, are ever opened.
+            if not NAME.match(name):
+                raise ValueError("Bad segment name {!r}".format(name))
+            directory = fifo_directory(name)
+            fifos = [os.path.join(directory, d) for d in ("req", "ans")]
+            _check_private(directory, stat.S_ISDIR)
+            for fifo in fifos:
+                _check_private(fifo, stat.S_ISFIFO)
+            self.shm = shared_memory.SharedMemory(name=name)
+            # The creator unlinks the segment; do not let the resource
+            # tracker of this process do it (again) at exit. A process
+            # calling its own Skeleton is both ends and shares the one
+            # tracker entry with its unlink.
+            if self.shm.name not in created:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.name = self.shm.name
+        self.fifos = fifos
+        ring_size = self.shm.size // 2 - HEADER_SIZE
+        # Opened read-write so that opening does not wait for the other
+        # end, and non-blocking so that ringing never blocks.
+        doorbells = [os.open(fifo, os.O_RDWR | os.O_NONBLOCK |
+                             os.O_NOFOLLOW) for fifo in fifos]
+        self.requests = Ring(self.shm.buf, 0, ring_size, doorbells[0])
+        self.answers = Ring(self.shm.buf, HEADER_SIZE + ring_size,
+                            ring_size, doorbells[1])
+
+    def unlink(self):
+        """Remove the names; the segment lives on while it is mapped."""
+        self.shm.unlink()
+        created.discard(self.name)
+        for fifo in self.fifos:
+            os.unlink(fifo)
+        os.rmdir(os.path.dirname(self.fifos[0]))
+
+    def close(self):
+        for ring in (self.requests, self.answers):
+            ring.closed = True
+            os.close(ring.doorbell)
+        try:
+            self.shm.close()
+        except BufferError:
+            # Still used by a thread; released with the object.
+            pass
+
+
+class Workers(object):
+
+    """Threads running the requests of the channels of a process.
+
+    Requests may block (on a lock, or on calls to other peers), so a new
+    thread is started whenever no idle one is left.
+    """
+
+    def __init__(self, idle_timeout=30.0):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def run(self, task):
+        self.lock.acquire()
+        try:
+            tasks = self.idle.pop() if self.idle else None
+        finally:
+            self.lock.release()
+        if tasks is not None:
+            tasks.put(task)
+        else:
+            thread = threading.Thread(target=self._work, args=(task,))
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, task):
+        tasks = queue.Queue()
+        while True:
+            try:
+                task()
+            except Exception:
+                logging.exception("Shared-memory request failed")
+            self.lock.acquire()
+            try:
+                self.idle.append(tasks)
+            finally:
+                self.lock.release()
+            try:
+                task = tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self.lock.acquire()
+                try:
+                    if tasks in self.idle:
+                        self.idle.remove(tasks)
+                        return
+                finally:
+                    self.lock.release()
+                # Handed a task just now.
+                task = tasks.get()
+
+
+workers = Workers()
+
+
+def serve(conn, hello, process_request):
+    """Serve the channel asked for by hello over the TCP connection conn.
+
+    Returns when the client is gone. process_request(request) returns
+    the answer to a request, both JSON.
+    """
+
+    words = hello.split()
+    try:
+        if not is_local_peer(conn):
+            raise ValueError("{} is not on this host".format(
+                conn.getpeername()[0]))
+        segment = Segment(words[1])
+    except Exception as e:
+        logging.info("Shared-memory channel refused: {}".format(e))
+        conn.sendall(b"NO\n")
+        return
+    logging.debug("Serving the shared-memory channel {}".format(segment.name))
+    conn.sendall(b"OK\n")
+
+    def answer(cid, request):
+        try:
+            result = process_request(request.decode("utf-8"))
+        except Exception:
+            # Over TCP the connection would be dropped; an empty answer
+            # has the same effect on the caller.
+            logging.exception("Shared-memory request failed")
+            result = ""
+        try:
+            segment.answers.write(cid, result.encode("utf-8"))
+        except (ConnectionError, ValueError):
+            # The client is gone, and the segment may be closed already.
+            pass
+
+    try:
+        while True:
+            cid, request = segment.requests.read(conn)
+            workers.run(lambda cid=cid, request=request:
+                        answer(cid, request))
+    except ConnectionError:
+        logging.debug("Shared-memory channel {} closed".format(segment.name))
+    finally:
+        segment.close()
+
+
+class Channel(object):
+
+    """The client side of a channel to a Skeleton."""
+
+    def __init__(self, address, ring_size=RING_SIZE):
+        self.address = address
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_cid = 0
+        self.closed = False
+        try:
+            self.segment = Segment(ring_size=ring_size)
+        except OSError as e:
+            raise NoChannel(e)
+        reply = None
+        try:
+            self.conn = socket.create_connection(address)
+            self.conn.sendall("{} {}\n".format(
+                HELLO, self.segment.name).encode("utf-8"))
+            reader = self.conn.makefile(mode="r")
+            reply = reader.readline()
+            reader.close()
+        finally:
+            self.segment.unlink()
+            if reply != "OK\n":
+                self.segment.close()
+                if reply is not None:
+                    self.conn.close()
+        if reply != "OK\n":
+            # Refused, or a Skeleton that does not know the transport.
+            raise NoChannel("Refused by {}".format(address))
+        self.reader = threading.Thread(target=self._read_answers)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def call(self, request):
+        """Send request (JSON) and wait for the answer."""
+        waiter = [threading.Event(), None]
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise ConnectionError("The channel is closed.")
+            cid = self.next_cid
+            self.next_cid += 1
+            self.pending[cid] = waiter
+        finally:
+            self.lock.release()
+        try:
+            self.segment.requests.write(cid, request.encode("utf-8"))
+        except (ConnectionError, ValueError):
+            self.lock.acquire()
+            try:
+                self.pending.pop(cid, None)
+            finally:
+                self.lock.release()
+            raise ConnectionError("The channel to {} was closed.".format(
+                self.address))
+        waiter[0].wait()
+        if waiter[1] is None:
+            raise ConnectionError("The channel to {} was closed.".format(
+                self.address))
+        return waiter[1]
+
+    def _read_answers(self):
+        try:
+            while True:
+                cid, answer = self.segment.answers.read(self.conn)
+                self.lock.acquire()
+                try:
+                    waiter = self.pending.pop(cid, None)
+                finally:
+                    self.lock.release()
+                if waiter is not None:
+                    waiter[1] = answer.decode("utf-8")
+                    waiter[0].set()
+        except ConnectionError:
+            pass
+        finally:
+            self._close()
+
+    def _close(self):
+        forget(self)
+        self.lock.acquire()
+        try:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        finally:
+            self.lock.release()
+        for waiter in pending:
+            waiter[0].set()
+        self.conn.close()
+        self.segment.close()
+
+
+# The channels of this process, by address.
+channels = {}
+channels_lock = threading.Lock()
+# The Skeletons that refused a channel, and until when they are not
+# asked again: they may be restarted with the transport.
+refused = {}
+REFUSED_TTL = 30.0
+# The channels being set up, by address; other callers for the same
+# address wait on the event.
+setting_up = {}
+
+
+def connect(address):
+    """Return the channel to the Skeleton at address, or None if the
+    Skeleton does not take any.
+
+    The channel is set up without holding channels_lock, so a slow peer
+    only holds up the callers for that peer. Raises the socket errors of
+    connecting to address; those are not remembered.
+    """
+
+    address = tuple(address)
+    while True:
+        channels_lock.acquire()
+        try:
+            channel = channels.get(address)
+            if channel is not None:
+                return channel
+            if refused.get(address, 0.0) > time.monotonic():
+                return None
+            pending = setting_up.get(address)
+            if pending is None:
+                pending = setting_up[address] = threading.Event()
+                break
+        finally:
+            channels_lock.release()
+        pending.wait()
+
+    channel = None
+    failed = True
+    try:
+        try:
+            channel = Channel(address)
+        except NoChannel as e:
+            logging.info("No shared-memory channel to {}: {}".format(
+                address, e))
+        failed = False
+    finally:
+        channels_lock.acquire()
+        try:
+            if channel is not None:
+                channels[address] = channel
+                refused.pop(address, None)
+            elif not failed:
+                refused[address] = time.monotonic() + REFUSED_TTL
+            del setting_up[address]
+        finally:
+            channels_lock.release()
+        pending.set()
+    return channel
+
+
+def forget(channel):
+    channels_lock.acquire()
+    try:
+        if channels.get(channel.address) is channel:
+            del channels[channel.address]
+    finally:
+        channels_lock.release()
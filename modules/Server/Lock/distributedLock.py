@@ -7,30 +7,196 @@
 #
 #
 #  @Sarah - see the method's comments for specific rules
+#
+#  Token loss: a peer that waits for the token longer than token_timeout
+#  (the lease of the current holder) suspects that it is lost and asks
+#  for a recovery. The recovery is run by the lowest ranked peer that
+#  answers (see recover_token): it freezes every peer, so that the token
+#  cannot move, and asks each of them whether it has it. Only if every
+#  peer answers that it does not, it mints a new token of a higher
+#  generation; a peer that cannot be asked calls the recovery off until
+#  the next attempt. Everybody is thawed, and tokens of an older
+#  generation that turn up later are dropped.
+#
+#  Incoming requests are queued and coalesced per peer, then applied in
+#  batches by whichever handler thread gets to them first; duplicate and
+#  stale requests are dropped there. The engine has its own lock, and the
+#  token is only sent once that lock is released (see _flush), so that a
+#  slow handoff does not hold up the calls arriving meanwhile.
 # ------------------------------------------------------------------------------
 
+import time
+import logging
+import threading
+from Common import orb
+from Server.Lock.token import Token
+from Server.Lock.lockEngine import LockEngine
+
 NO_TOKEN = 0
 TOKEN_PRESENT = 1
 TOKEN_HELD = 2
 
 
-class DistributedLock(object):
+class HoldPolicy(object):
+
+    """How long a peer may keep the token for its own queued work.
+
+    When the lock is released while other local threads wait for it and
+    remote peers wait too, the token stays for the local threads until it
+    has served max_entries critical sections or has been here for
+    max_hold seconds. It then goes to the oldest remote request.
+    """
+
+    def __init__(self, max_entries=8, max_hold=0.05):
+        self.max_entries = max_entries
+        self.max_hold = max_hold
+
+    def allows(self, entries, held):
+        return entries < self.max_entries and held < self.max_hold
+
+
+class DistributedLock(LockEngine):
+
+    """Token based algorithm; every request is broadcast to all peers."""
+
+    name = "token"
 
     def __init__(self, owner, peer_list):
-        self.peer_list = peer_list
-        self.owner = owner
+        LockEngine.__init__(self, owner, peer_list)
+        self.lock = threading.Condition()
         self.time = 0
-        self.token = {}
+        # The token while this peer has it, the copy of the last handoff
+        # otherwise (see Token).
+        self.token = Token()
         self.request = {}
         self.state = NO_TOKEN
+        # True while a local acquire waits for the token.
+        self.waiting = False
+        # Reentrancy: the thread holding the lock (None while the token
+        # is held for whichever local thread takes it first) and how many
+        # times it acquired it.
+        self.holder = None
+        self.depth = 0
+        self.local_waiters = 0
+        # Batching: when the token came, the entries served since, and
+        # when each pending remote request arrived.
+        self.policy = HoldPolicy()
+        self.held_since = 0.0
+        self.entries = 0
+        self.arrivals = {}
+        # Token loss detection and recovery.
+        self.token_timeout = 5.0
+        self.freeze_timeout = 2.0
+        self.generation = 0
+        self.frozen_until = 0.0
+        self.recovery = threading.Lock()
+        self.recoveries = 0
+        # Seconds from the suspicion of a loss to the token being back,
+        # for the last recovery.
+        self.recovery_time = None
+        # Requests received but not applied yet, coalesced by peer.
+        self.incoming = {}
+        self.incoming_lock = threading.Lock()
+        self.draining = False
+        self.coalesced = 0
+        self.suppressed = 0
+        # The handoff decided under the lock, [pid, generation, message],
+        # until _flush has sent it, and the peers it failed to reach.
+        self.transfer = None
+        self.sending = False
+        self.unreachable = set()
+
+    def _prepare(self, pid, full=False):
+        """Build the message handing the token over to pid.
 
-    def _prepare(self, token):
-        return list(token.items())
+        Only the entries the receiver has not seen yet are sent.
+        """
+        return self.token.encode(self.owner.id, pid, full)
 
     def _unprepare(self, token):
-        return dict(token)
+        self.token.decode(token)
+
+    def _send_token(self, pid):
+        """Hand the token over to pid.
+
+        Called with the lock held: the handoff is only recorded here, and
+        sent by _flush once the lock is released.
+        """
+        self.transfer = [pid, self.generation, self._prepare(pid)]
+
+    def _flush(self):
+        """Send the token if a handoff was decided; called without the lock.
+
+        If the token certainly did not leave (see _not_sent) it comes back
+        here and goes to the next request, so it is not lost. If it may
+        have reached the receiver (the connection broke, or timed out),
+        taking it back could make two tokens: it is left as sent, and if
+        it was lost the peers waiting for it have it recovered (see
+        recover_token).
+        """
 
-    def initialize(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if self.transfer is None or self.sending:
+                    # Nothing to send, or another thread is sending it.
+                    return
+                transfer = self.transfer
+                pid, generation, message = transfer
+                self.sending = True
+            finally:
+                self.lock.release()
+            error = None
+            try:
+                stub = self.peer_list.peer(pid)
+            except Exception as e:
+                # It left meanwhile: nothing was sent.
+                stub, error = None, e
+            if stub is not None:
+                try:
+                    self._deliver(stub, pid, message, generation)
+                except Exception as e:
+                    error = e
+            self.lock.acquire()
+            try:
+                self.sending = False
+                if self.transfer is transfer:
+                    self.transfer = None
+                if error is None:
+                    self.unreachable.discard(pid)
+                    self._fire("handoff", to=pid)
+                    continue
+                if stub is not None and not self._not_sent(error):
+                    logging.warning("The token may not have reached peer "
+                                    "{}: {}".format(pid, error))
+                    self._fire("delivery_in_doubt", to=pid)
+                    continue
+                logging.warning("The token could not be sent to peer {}: {}"
+                                .format(pid, error))
+                self._fire("delivery_failed", to=pid)
+                # Skipped until it asks again (see _apply_request).
+                self.unreachable.add(pid)
+                self.state = TOKEN_PRESENT
+                self._accept_token()
+            finally:
+                self.lock.release()
+
+    def _deliver(self, stub, pid, message, generation):
+        """Hand the token over to pid through stub."""
+
+        try:
+            stub.obtain_token(message, generation)
+        except orb.ExternalError:
+            # The receiver could not apply the delta onto its copy of the
+            # token (e.g. it restarted), so send the whole token.
+            self.lock.acquire()
+            try:
+                message = self._prepare(pid, full=True)
+            finally:
+                self.lock.release()
+            stub.obtain_token(message, generation)
+
+    def initialize(self, mint_token=True):
 
         """
         Rule for process initialization /* performed at initialization */
@@ -41,48 +207,79 @@ class DistributedLock(object):
         elements k = 1 .. n.
         """
 
-        self.peer_list.lock.acquire()
+        self.lock.acquire()
         try:
-            first_peer = sorted(self.peer_list.get_peers().keys())[0]
-            if first_peer is not self.owner.id:
-                self.token = {self.owner.id: self.time}
-                self.request = {self.owner.id: self.time}
-                for pid in self.peer_list.get_peers().keys():
+            peers = self.peer_list.get_peers()
+            first_peer = sorted(peers)[0]
+            self.request = {self.owner.id: self.time}
+            for pid in peers:
+                self.request[pid] = 0
+            if first_peer == self.owner.id and mint_token:
+                self.token = Token()
+                for pid in peers:
                     self.token[pid] = 0
-                    self.request[pid] = 0
-            else:
-                self.token = {self.owner.id: self.time}
+                self.token[self.owner.id] = self.time
                 self.state = TOKEN_PRESENT
         finally:
-            self.peer_list.lock.release()
+            self.lock.release()
 
     def destroy(self):
-        self.peer_list.lock.acquire()
+        """Leave, handing the token over if it is here.
+
+        It goes to the next requesting peer, or to any other peer if
+        nobody is waiting for it, so that it does not leave with us.
+        """
+
+        self.lock.acquire()
         try:
-            if self.state is TOKEN_PRESENT or self.state is TOKEN_HELD:
-                self.release()
+            if self.state is NO_TOKEN:
+                return
+            self.waiting = False
+            self.holder = None
+            self.depth = 0
+            self.frozen_until = 0.0
+            self.state = TOKEN_PRESENT
+            self._pass_token()
         finally:
-            self.peer_list.lock.release()
+            self.lock.release()
+        self._flush()
+        others = [pid for pid in sorted(self.peer_list.get_peers())
+                  if pid != self.owner.id]
+        for pid in others:
+            self.lock.acquire()
+            try:
+                if self.state is not TOKEN_PRESENT:
+                    break
+                if pid in self.unreachable:
+                    continue
+                self.token[self.owner.id] = self.time
+                self._send_token(pid)
+                self.state = NO_TOKEN
+            finally:
+                self.lock.release()
+            self._flush()
 
     def register_peer(self, pid):
-        self.peer_list.lock.acquire()
+        self.lock.acquire()
         try:
             self.request[pid] = 0
             if self.state is TOKEN_HELD or self.state is TOKEN_PRESENT:
                 self.token[pid] = 0
         finally:
-            self.peer_list.lock.release()
+            self.lock.release()
 
     def unregister_peer(self, pid):
-        self.peer_list.lock.acquire()
+        self.lock.acquire()
         try:
-            del self.request[pid]
-            if self.state is TOKEN_HELD or self.state is TOKEN_PRESENT:
+            self.request.pop(pid, None)
+            self.unreachable.discard(pid)
+            if (self.state is TOKEN_HELD or self.state is TOKEN_PRESENT) \
+                    and pid in self.token:
                 del self.token[pid]
         finally:
-            self.peer_list.lock.release()
+            self.lock.release()
 
-    def acquire(self):
+    def acquire(self, timeout=None):
 
         """
         /* performed whenever process Pi requests an access to the CS and
@@ -94,22 +291,112 @@ class DistributedLock(object):
         of the local logical clock,and i is an identifier of Pi.
         Pi waits until it receives the token.end if.state Pi:= TOKEN-HELD.Pi
         enters the CS.
+
+        The wait is done on the engine's own condition, self.lock, which
+        obtain_token notifies, so no CPU is used meanwhile. Returns True
+        once the lock is held, or False if timeout seconds passed first.
+        The time spent waiting is kept in self.wait_time.
+
+        Acquires are reentrant: the thread holding the lock may acquire it
+        again, and holds it until it has released it as many times. Other
+        local threads wait; while they do, the token is kept for them as
+        long as self.policy allows (see release).
         """
 
-        self.peer_list.lock.acquire()
-        self.time = self.time + 1
-        if self.state is NO_TOKEN:
-            self.peer_list.lock.release()
-            for id in self.peer_list.get_peers():
-                self.peer_list.get_peers()[id].request_token(
-                    self.time, self.owner.id)
-            while self.state is not TOKEN_HELD:
-                pass
-        else:
+        start = time.monotonic()
+        me = threading.get_ident()
+        self.lock.acquire()
+        try:
+            if self.state is TOKEN_HELD and self.holder == me:
+                self.depth += 1
+                return True
+            self.local_waiters += 1
+            acquired = False
             try:
-                self.obtain_token(self._prepare(self.token))
+                while True:
+                    if self._claimable():
+                        self.holder = me
+                        self.depth = 1
+                        acquired = True
+                        break
+                    if self.state is not TOKEN_HELD and not self.waiting:
+                        # Nobody here asks for the token (any more).
+                        self.lock.release()
+                        try:
+                            self.start_acquire()
+                        finally:
+                            self.lock.acquire()
+                        continue
+                    if not self._wait_token(
+                            lambda: self._claimable() or (
+                                self.state is not TOKEN_HELD and
+                                not self.waiting), start, timeout):
+                        break
             finally:
-                self.peer_list.lock.release()
+                self.local_waiters -= 1
+            if acquired:
+                self.wait_time = time.monotonic() - start
+            elif self.local_waiters == 0:
+                # From now on a late token is passed on instead of being
+                # held.
+                self.waiting = False
+                if self._claimable():
+                    self.state = TOKEN_PRESENT
+                if self.state is TOKEN_PRESENT:
+                    self._pass_token()
+        finally:
+            self.lock.release()
+        self._flush()
+        return acquired
+
+    def start_acquire(self):
+        """The first half of acquire: take the token if it is here, send
+        the request otherwise."""
+
+        self.lock.acquire()
+        try:
+            if self.state is TOKEN_HELD:
+                # Held here: release hands it over to the local waiters.
+                return
+            self.time = self.time + 1
+            self.waiting = True
+            self._fire("requested")
+            present = self.state is not NO_TOKEN
+            if present:
+                self._accept_token()
+        finally:
+            self.lock.release()
+        if present:
+            self._flush()
+        else:
+            self._broadcast_request()
+
+    def try_acquire(self):
+        """Take the lock only if the token is already here.
+
+        Never blocks and never sends any request.
+        """
+
+        self.lock.acquire()
+        try:
+            me = threading.get_ident()
+            if self.state is TOKEN_HELD and self.holder == me:
+                self.depth += 1
+                return True
+            if self.state is not TOKEN_PRESENT:
+                return False
+            self.time = self.time + 1
+            self.token[self.owner.id] = self.time
+            self.state = TOKEN_HELD
+            self.holder = me
+            self.depth = 1
+            self.held_since = time.monotonic()
+            self.entries = 0
+            self.wait_time = 0.0
+            self._fire("acquired")
+            return True
+        finally:
+            self.lock.release()
 
     def release(self):
 
@@ -124,70 +411,115 @@ class DistributedLock(object):
         token[i] := CPi, the value of the local logical clock.
         Pi sends the token to Pk.
         break. /* leave the for loop */
+
+        The token stays here for the other local threads waiting for the
+        lock as long as no remote peer waits for it, or self.policy allows;
+        after such a batch it goes to the oldest remote request.
         """
 
-        if self.state is TOKEN_HELD:
-            self.peer_list.lock.acquire()
-            try:
-                self.state = TOKEN_PRESENT
-                # This implementation goes over the peers in order from the
-                # beginning
-
-                #for peer in sorted(self.peer_list.get_peers()):
-                #    if self.request[peer] > self.token[peer]:
-                #        self.state = NO_TOKEN
-                #        self.token[self.owner.id] = self.time
-                #        self.peer_list.get_peers()[peer].obtain_token(
-                #            self._prepare(self.token))
-                #        break
-
-                # The algorithm checks all the peers in an order "clockwise"
-                # from the current peer that way it isn't always the first peer
-                # in the list that is being checked
-                peers = self.peer_list.get_peers()
-                keys = peers.keys()
-
-                # Since the peers can enter and exit at any time, the chance of
-                # there being missing ids are high, so a modulo loop would not
-                # work
-                before = {}
-                after = {}
-                for key in keys:
-                    if key < self.owner.id:
-                        before[key] = peers[key]
-                    elif key > self.owner.id:
-                        after[key] = peers[key]
-                request_found = False
-
-                # So at most, this block of code should only loop n times
-                for peer in sorted(after):
-                    request_found = self.release_aux(peer)
-                    if (request_found == True):
-                        break
+        self.lock.acquire()
+        try:
+            if self.state is not TOKEN_HELD or (
+                    self.holder is None and self.depth == 0 and
+                    self.local_waiters):
+                # Not held, or already handed over to a local thread.
+                return
+            if self.depth > 1:
+                self.depth -= 1
+                return
+            self.holder = None
+            self.depth = 0
+            self.entries += 1
+            self._fire("released")
+            if self.local_waiters and (
+                    not self._remote_pending() or self.policy.allows(
+                        self.entries, time.monotonic() - self.held_since)):
+                # Keep the token for the next local critical section.
+                self._fire("acquired")
+                self.lock.notify_all()
+                return
+            self.state = TOKEN_PRESENT
+            # The local waiters, if any, ask for it again once it is gone.
+            self.waiting = False
+            if self.entries > 1:
+                self._yield_token()
+            else:
+                self._pass_token()
+            if self.local_waiters:
+                self.lock.notify_all()
+        finally:
+            self.lock.release()
+        self._flush()
 
-                if (request_found == False):
-                    # A request wasn't found in the peers with ids greater than
-                    # this, so search in the peers whose ids are less than the
-                    # owner's
-                    for peer in sorted(before):
-                        request_found = self.release_aux(peer)
-                        if (request_found == True):
-                            break
-            finally:
-                self.peer_list.lock.release()
+    def _pass_token(self):
+        """Send the token to the next requesting peer, if there is one.
+
+        Must be called with the lock held and the token present.
+        """
+
+        if self._frozen():
+            # A recovery is running; token_thaw passes it on.
+            return
+
+        # This implementation goes over the peers in order from the
+        # beginning
+
+        #for peer in sorted(self.peer_list.get_peers()):
+        #    if self.request[peer] > self.token[peer]:
+        #        self.state = NO_TOKEN
+        #        self.token[self.owner.id] = self.time
+        #        self.peer_list.get_peers()[peer].obtain_token(
+        #            self._prepare(self.token))
+        #        break
+
+        # The algorithm checks all the peers in an order "clockwise"
+        # from the current peer that way it isn't always the first peer
+        # in the list that is being checked
+        peers = self.peer_list.get_peers()
+        keys = peers.keys()
+
+        # Since the peers can enter and exit at any time, the chance of
+        # there being missing ids are high, so a modulo loop would not
+        # work
+        before = {}
+        after = {}
+        for key in keys:
+            if key < self.owner.id:
+                before[key] = peers[key]
+            elif key > self.owner.id:
+                after[key] = peers[key]
+        request_found = False
+
+        # So at most, this block of code should only loop n times
+        for peer in sorted(after):
+            request_found = self.release_aux(peer)
+            if (request_found == True):
+                break
+
+        if (request_found == False):
+            # A request wasn't found in the peers with ids greater than
+            # this, so search in the peers whose ids are less than the
+            # owner's
+            for peer in sorted(before):
+                request_found = self.release_aux(peer)
+                if (request_found == True):
+                    break
 
     def release_aux(self, peer):
         """
         Just a function make the code a little cleaner
         """
-        if self.request[peer] > self.token[peer]:
+        if peer in self.unreachable:
+            return False
+        if self.request.get(peer, 0) > self.token.get(peer, 0):
+            self.token[self.owner.id] = self._served_time()
+            self._send_token(peer)
             self.state = NO_TOKEN
-            self.token[self.owner.id] = self.time
-            self.peer_list.get_peers()[peer].obtain_token(
-                self._prepare(self.token))
+            self.arrivals.pop(peer, None)
             return True
+        return False
 
-    def request_token(self, time, pid):
+    def request_token(self, time, pid, *extra):
 
         """
         Rule for handling incoming requests
@@ -195,35 +527,234 @@ class DistributedLock(object):
         [RH1]: requestPi[j] := max(requestPi[j], TPj).
         [RH2]: if state Pi= TOKEN-PRESENT then Pi
         releases the resource (see rule RR2)
+
+        The request is queued; if no other handler is applying the queued
+        requests already, this one applies them, in batches (see _drain).
+        A newer request of the same peer replaces the queued one.
         """
 
-        self.peer_list.lock.acquire()
+        self.incoming_lock.acquire()
         try:
-            self.request[pid] = time if time > self.request[pid] \
-                else self.request[pid]
-            if self.state is TOKEN_PRESENT:
-                self.peer_list.get_peers()[pid].obtain_token(
-                    self._prepare(self.token))
-                self.state = NO_TOKEN
+            queued = self.incoming.get(pid)
+            if queued is not None:
+                self.coalesced += 1
+            if queued is None or time > queued[0]:
+                self.incoming[pid] = (time,) + extra
+            if self.draining:
+                return
+            self.draining = True
         finally:
-            self.peer_list.lock.release()
+            self.incoming_lock.release()
+        self._drain()
 
-    def obtain_token(self, token):
-        self.peer_list.lock.acquire()
+    def obtain_token(self, token, generation=0):
+        self.lock.acquire()
         try:
-            self.token = self._unprepare(token)
-            if self.time > self.token[self.owner.id]:
-                self.token[self.owner.id] = self.time
-                self.state = TOKEN_HELD
-            else:
+            if generation < self.generation:
+                logging.warning("Token of generation {} dropped, it was "
+                                "replaced by generation {}.".format(
+                                    generation, self.generation))
+                return
+            self.generation = generation
+            self._unprepare(token)
+            if self._frozen():
+                # A recovery may have been told that we have no token:
+                # keep this one until token_thaw tells whether it counts.
                 self.state = TOKEN_PRESENT
+                return
+            self._accept_token()
+        finally:
+            self.lock.release()
+        self._flush()
+
+    def _accept_token(self):
+        """Enter the CS if we are waiting for it, pass the token on
+        otherwise."""
+
+        if self.waiting and self.time > self.token.get(self.owner.id, 0):
+            self.token[self.owner.id] = self.time
+            self.state = TOKEN_HELD
+            self.waiting = False
+            self.holder = None
+            self.depth = 0
+            self.held_since = time.monotonic()
+            self.entries = 0
+            # Wake up the waiting acquire.
+            self.lock.notify_all()
+            self._fire("acquired")
+        else:
+            # Nobody here wants it (any more): hand it over right away.
+            self.state = TOKEN_PRESENT
+            self._pass_token()
+
+    def remote_calls(self):
+        return {
+            "request_token":      self.request_token,
+            "obtain_token":       self.obtain_token,
+            "recover_token":      self.recover_token,
+            "token_freeze":       self.token_freeze,
+            "token_thaw":         self.token_thaw
+        }
+
+    # Token loss recovery
+
+    def recover(self):
+        """Have the token recovered if it is lost, then send our request
+        again in case it was the request that got lost."""
+
+        self._suspect_loss()
+        if self.waiting:
+            self._broadcast_request()
+
+    def recover_token(self):
+        """Find out whether the token is lost, and regenerate it if it is.
+
+        Returns True if a new token was minted here. Recoveries run one at
+        a time on a peer, and the waiting peers always ask the lowest
+        ranked peer that answers, so only one token is minted.
+
+        A token is only minted if every peer of the list answered that
+        it does not have it, all within freeze_timeout (the peers asked
+        first are not frozen any longer after that). If a peer cannot be
+        asked it may have the token: the recovery is called off, and the
+        name server is asked to check the peer (see PeerList.suspect), so
+        that the next attempt does without it if it is gone.
+        """
+
+        me = self.owner.id
+        with self.recovery:
+            peers = self.peer_list.get_peers()
+            replies = {}
+            failed = []
+            start = time.monotonic()
+            for pid in peers:
+                try:
+                    replies[pid] = peers[pid].token_freeze(
+                        me, self.freeze_timeout)
+                except Exception as e:
+                    failed.append(pid)
+                    logging.info("Peer {} did not answer the token probe: "
+                                 "{}".format(pid, e))
+            holders = [pid for pid in replies if replies[pid][0]]
+            generation = self.generation
+            lost = not holders and not failed and \
+                time.monotonic() - start < self.freeze_timeout
+            if lost:
+                generation = max([self.generation] + [
+                    reply[1] for reply in replies.values()]) + 1
+                self.lock.acquire()
+                try:
+                    self.generation = generation
+                    self.token = Token()
+                    for pid in replies:
+                        self.token[pid] = replies[pid][2]
+                    self.token[me] = self.token.get(me, 0)
+                    self.state = TOKEN_PRESENT
+                    self.recoveries += 1
+                finally:
+                    self.lock.release()
+                logging.warning("The token was lost; generation {} minted "
+                                "by peer {}.".format(generation, me))
+            elif not holders:
+                logging.warning("Token recovery called off, peer(s) {} "
+                                "could not be asked.".format(failed or
+                                                             "all"))
+            for pid in replies:
+                try:
+                    peers[pid].token_thaw(generation)
+                except Exception as e:
+                    logging.info("Peer {} could not be thawed: {}".format(
+                        pid, e))
+            for pid in failed:
+                self.peer_list.suspect(pid)
+            return lost
+
+    def token_freeze(self, pid, duration):
+        """Keep the token where it is for duration seconds (or until
+        token_thaw) and tell whether it is here.
+
+        Returns [has the token, generation, our last access]; a token
+        being sent from here counts as here. A token that arrives while
+        we are frozen is kept until token_thaw (see obtain_token).
+        """
+
+        self.lock.acquire()
+        try:
+            self.frozen_until = time.monotonic() + duration
+            present = self.state is not NO_TOKEN or \
+                self.transfer is not None
+            return [present, self.generation,
+                    self.token.get(self.owner.id, 0)]
         finally:
-            self.peer_list.lock.release()
+            self.lock.release()
+
+    def token_thaw(self, generation):
+        """The recovery is over; generation is the one of the token from
+        now on.
+
+        A token of an older generation here arrived after we told the
+        recovery that we had none (see obtain_token): it was replaced,
+        and is dropped instead of being promoted.
+        """
+
+        self.lock.acquire()
+        try:
+            if generation > self.generation and \
+                    self.state is TOKEN_PRESENT:
+                logging.warning("Token of generation {} dropped, it was "
+                                "replaced by generation {}.".format(
+                                    self.generation, generation))
+                self.state = NO_TOKEN
+            self.generation = max(self.generation, generation)
+            self.frozen_until = 0.0
+            if self.state is TOKEN_PRESENT:
+                self._accept_token()
+        finally:
+            self.lock.release()
+        self._flush()
+
+    def is_idle(self):
+        """Idle when the token is elsewhere and nobody here waits for it."""
+
+        self.lock.acquire()
+        try:
+            return self.state is NO_TOKEN and not self.waiting
+        finally:
+            self.lock.release()
+
+    def get_state(self):
+        """The logical clock, and the requests that may still have to be
+        served if the token comes back here (as far as our copy of the
+        token tells)."""
+
+        self.lock.acquire()
+        try:
+            pending = [[pid, stamp] for pid, stamp in self.request.items()
+                       if stamp > self.token.get(pid, 0)]
+            return {"time": self.time, "pending": pending,
+                    "generation": self.generation}
+        finally:
+            self.lock.release()
+
+    def set_state(self, state):
+        self.lock.acquire()
+        try:
+            # The logical clock must never go back, or the token would not
+            # be taken when it comes back to us.
+            self.time = max(self.time, state["time"])
+            self.generation = max(self.generation,
+                                  state.get("generation", 0))
+            for pid, stamp in state.get("pending", []):
+                if pid in self.request:
+                    self.request[pid] = max(stamp, self.request[pid])
+        finally:
+            self.lock.release()
 
     def display_status(self):
         """Print the status of this peer."""
-        self.peer_list.lock.acquire()
+        self.lock.acquire()
         try:
+            print("Engine  :: {0}".format(self.name))
             nt = self.state == NO_TOKEN
             tp = self.state == TOKEN_PRESENT
             th = self.state == TOKEN_HELD
@@ -233,5 +764,146 @@ class DistributedLock(object):
             print("Request :: {0}".format(self.request))
             print("Token   :: {0}".format(self.token))
             print("Time    :: {0}".format(self.time))
+            print("Waited  :: {0:.3f}s".format(self.wait_time))
+            recovery = "-" if self.recovery_time is None \
+                else "{0:.3f}s".format(self.recovery_time)
+            print("Recover :: generation {0}, {1} token(s) minted, last "
+                  "recovery took {2}".format(
+                      self.generation, self.recoveries, recovery))
+            print("Queue   :: {0} request(s) coalesced, {1} suppressed"
+                  .format(self.coalesced, self.suppressed))
         finally:
-            self.peer_list.lock.release()
+            self.lock.release()
+
+    # Private methods
+
+    def _broadcast_request(self, *extra):
+        """Send our request to every peer."""
+
+        # A single snapshot is iterated, so peers joining or leaving
+        # meanwhile do not disturb the broadcast.
+        peers = self.peer_list.get_peers()
+        for id in peers:
+            try:
+                peers[id].request_token(self.time, self.owner.id, *extra)
+            except Exception as e:
+                logging.info("Request not delivered to peer {}: {}".format(
+                    id, e))
+
+    def _drain(self):
+        """Apply the queued requests until there are none left, then send
+        the token if one of them got it."""
+
+        while True:
+            self.incoming_lock.acquire()
+            try:
+                batch = self.incoming
+                if not batch:
+                    self.draining = False
+                    return
+                self.incoming = {}
+            finally:
+                self.incoming_lock.release()
+            self.lock.acquire()
+            try:
+                for pid in batch:
+                    self._apply_request(pid, *batch[pid])
+                if self.state is TOKEN_PRESENT and not self._frozen():
+                    self._pass_token()
+            finally:
+                self.lock.release()
+            self._flush()
+
+    def _apply_request(self, pid, time, *extra):
+        """Rule RH1 for one queued request; requests that are not newer
+        than the last one of the peer are dropped."""
+
+        # It is evidently up again.
+        self.unreachable.discard(pid)
+        if time <= self.request.get(pid, 0):
+            self.suppressed += 1
+            return
+        self._record_request(time, pid)
+
+    def _wait_token(self, predicate, start, timeout):
+        """Wait, with the lock held, until predicate is true.
+
+        Whenever token_timeout seconds pass without it, the token is
+        suspected lost (see recover). Returns the final value of
+        predicate.
+        """
+
+        suspected = None
+        while True:
+            wait = self.token_timeout
+            if timeout is not None:
+                wait = min(wait, start + timeout - time.monotonic())
+            if self.lock.wait_for(predicate, max(wait, 0)):
+                break
+            if timeout is not None and \
+                    time.monotonic() - start >= timeout:
+                break
+            if suspected is None:
+                suspected = time.monotonic()
+            self.lock.release()
+            try:
+                self.recover()
+            finally:
+                self.lock.acquire()
+        if suspected is not None and predicate():
+            self.recovery_time = time.monotonic() - suspected
+            logging.info("Token recovered after {:.3f}s.".format(
+                self.recovery_time))
+        return predicate()
+
+    def _suspect_loss(self):
+        """Ask the lowest ranked peer that answers to run a recovery."""
+
+        me = self.owner.id
+        peers = self.peer_list.get_peers()
+        for pid in sorted(peers):
+            try:
+                if pid == me:
+                    self.recover_token()
+                else:
+                    peers[pid].recover_token()
+                return
+            except Exception as e:
+                logging.info("Peer {} cannot run the token recovery: {}"
+                             .format(pid, e))
+
+    def _served_time(self):
+        """Our entry in the token when it leaves: the time of our last
+        access, which every request of ours up to now is served by."""
+        return self.time
+
+    def _record_request(self, request_time, pid):
+        """Rule RH1; also note when a request became pending."""
+        if request_time > self.request.get(pid, 0):
+            self.request[pid] = request_time
+            if request_time > self.token.get(pid, 0) and \
+                    pid != self.owner.id and pid not in self.arrivals:
+                self.arrivals[pid] = time.monotonic()
+
+    def _remote_pending(self):
+        me = self.owner.id
+        return [pid for pid, time in self.request.items()
+                if pid != me and time > self.token.get(pid, 0)]
+
+    def _claimable(self):
+        """The token is held for the local threads, none has it yet."""
+        return self.state is TOKEN_HELD and self.holder is None and \
+            self.depth == 0
+
+    def _yield_token(self):
+        """Hand the token to the oldest pending remote request."""
+
+        pending = sorted(self._remote_pending(),
+                         key=lambda pid: self.arrivals.get(pid, 0.0))
+        for pid in pending:
+            if self.release_aux(pid):
+                return
+        self._pass_token()
+
+    def _frozen(self):
+        return time.monotonic() < self.frozen_until
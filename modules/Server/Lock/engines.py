@@ -0,0 +1,32 @@
+# ------------------------------------------------------------------------------
+#  The distributed mutual exclusion algorithms a peer can choose from.
+#
+#  token    :: broadcast token algorithm (DistributedLock), n messages per
+#              entry into the CS, the token is handed over directly.
+#  raymond  :: Raymond's tree algorithm (RaymondLock), O(log n) messages
+#              per entry, at the cost of more hops for the token.
+#  shared   :: the token algorithm with a shared (readers) mode besides the
+#              exclusive one (SharedLock, see acquire_shared).
+# ------------------------------------------------------------------------------
+
+from Server.Lock.distributedLock import DistributedLock
+from Server.Lock.raymondLock import RaymondLock
+from Server.Lock.sharedLock import SharedLock
+
+ENGINES = {
+    DistributedLock.name: DistributedLock,
+    RaymondLock.name: RaymondLock,
+    SharedLock.name: SharedLock
+}
+
+DEFAULT_ENGINE = DistributedLock.name
+
+
+def create_engine(name, owner, peer_list):
+    """Build the lock engine called name for the given owner."""
+    try:
+        engine = ENGINES[name]
+    except KeyError:
+        raise ValueError("Unknown lock engine '{}', choose one of {}.".format(
+            name, sorted(ENGINES)))
+    return engine(owner, peer_list)
@@ -0,0 +1,184 @@
+# ------------------------------------------------------------------------------
+#  Interface shared by the distributed mutual exclusion algorithms.
+#
+#  A mutex peer talks to its lock only through this interface, so the
+#  algorithm can be chosen per process (see engines.py).
+# ------------------------------------------------------------------------------
+
+import queue
+import logging
+import threading
+from Common import orb
+
+
+class Dispatcher(threading.Thread):
+
+    """Send outgoing lock messages from a background thread.
+
+    Message handlers of the lock engines run while holding the engine's
+    lock; sending from the handler itself could deadlock two peers
+    sending to each other. Messages are sent one at a time, in the order
+    in which they were queued.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.queue = queue.Queue()
+        self.daemon = True
+        self.start()
+
+    def send(self, call, on_failure=None):
+        """Queue call (a function without arguments) for sending."""
+        self.queue.put((call, on_failure))
+
+    def flush(self):
+        """Wait until every queued message has been sent."""
+        self.queue.join()
+
+    def close(self):
+        """Stop the thread once the queued messages have been sent."""
+        self.queue.put((None, None))
+
+    def run(self):
+        while True:
+            call, on_failure = self.queue.get()
+            try:
+                if call is None:
+                    return
+                call()
+            except Exception as e:
+                logging.info("Lock message could not be sent: {}".format(e))
+                if on_failure is not None:
+                    try:
+                        on_failure(e)
+                    except Exception:
+                        logging.exception("Lock message failure handler")
+            finally:
+                self.queue.task_done()
+
+
+class LockEngine(object):
+
+    """Base class of the distributed mutual exclusion algorithms.
+
+    Subclasses implement the lock itself; remote_calls lists the methods
+    the peers of the algorithm call on each other, which the owner has to
+    dispatch.
+    """
+
+    name = None
+
+    def __init__(self, owner, peer_list):
+        self.owner = owner
+        self.peer_list = peer_list
+        # Seconds the last successful acquire had to wait.
+        self.wait_time = 0.0
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(engine, event, info) on the events of the lock.
+
+        requested       :: this peer asks for the lock,
+        acquired        :: the lock is held (after any kind of acquire),
+        released        :: it is released,
+        handoff         :: the token was handed over to info["to"],
+        delivery_failed :: handing it over to info["to"] failed, the token
+                           is still here,
+        delivery_in_doubt :: handing it over to info["to"] may have
+                             failed, the token may be lost.
+
+        The first three have info["mode"] set to "S" for a shared access
+        (see SharedLock), and no mode for an exclusive one.
+
+        Listeners run with the engine's lock held, so they must not block
+        nor call back into the engine.
+        """
+        self.listeners.append(listener)
+
+    def initialize(self, mint_token=True):
+        """Set the lock up once the peer list is known.
+
+        With mint_token False this peer never creates the token, not even
+        as the first peer (the lock existed before and its token is
+        elsewhere).
+        """
+        raise NotImplementedError
+
+    def destroy(self):
+        raise NotImplementedError
+
+    def register_peer(self, pid):
+        raise NotImplementedError
+
+    def unregister_peer(self, pid):
+        raise NotImplementedError
+
+    def start_acquire(self):
+        """Ask for the lock without waiting for it.
+
+        The "acquired" event is fired once the lock is held.
+        """
+        raise NotImplementedError
+
+    def acquire(self, timeout=None):
+        """Block until the lock is held or timeout seconds passed.
+
+        Returns True if the lock was acquired.
+        """
+        raise NotImplementedError
+
+    def try_acquire(self):
+        """Acquire the lock only if no message has to be exchanged."""
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+    def display_status(self):
+        raise NotImplementedError
+
+    def remote_calls(self):
+        """Return the methods the other peers call, by name."""
+        raise NotImplementedError
+
+    def recover(self):
+        """Called when an acquire has waited suspiciously long.
+
+        Engines that can find out whether their token was lost (and get
+        it back) do it here.
+        """
+        pass
+
+    def is_idle(self):
+        """Tell whether the lock may be dropped without losing anything.
+
+        Engines that cannot be rebuilt from get_state never are.
+        """
+        return False
+
+    def get_state(self):
+        """Return what has to survive when the lock is dropped."""
+        return {}
+
+    def set_state(self, state):
+        """Restore the state returned by get_state."""
+        pass
+
+    def close(self):
+        """Free what the lock holds once it is dropped, after destroy or
+        once it is idle (see LockManager)."""
+        pass
+
+    # Private methods
+
+    def _fire(self, event, **info):
+        for listener in self.listeners:
+            listener(self, event, info)
+
+    def _not_sent(self, error):
+        """Tell whether a call that failed with error certainly did not
+        reach the peer: it refused the connection, or its circuit was
+        open (see MonitoredStub), which fails the call before any write.
+        """
+        return isinstance(error, (ConnectionRefusedError,
+                                  orb.ComunicationError))
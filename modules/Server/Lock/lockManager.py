@@ -0,0 +1,286 @@
+# ------------------------------------------------------------------------------
+#  Many named distributed locks hosted by a single peer.
+#
+#  Every named lock is an independent lock engine with its own token and
+#  request vectors. Locks are created the first time they are used,
+#  locally or by a message from another peer, and dropped again once they
+#  have been idle for a while. All their messages go through the peer's
+#  existing Skeleton, tagged with the name of the lock (see lock_call).
+#
+#  Only the engines that can be rebuilt from get_state are ever dropped
+#  (see LockEngine.is_idle). Raymond's lock is not one of them: its tree
+#  is made of the holder pointers of all the peers, so its named locks
+#  stay for as long as the peer does.
+# ------------------------------------------------------------------------------
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from Server.peerList import PeerSnapshot
+from Server.Lock.engines import DEFAULT_ENGINE, create_engine
+from Server.Lock.lockMetrics import LockMetrics
+
+
+class NamedStub(object):
+
+    """Stub of a peer as seen by one named lock.
+
+    Every call is forwarded as lock_call(name, method, args).
+    """
+
+    def __init__(self, stub, name):
+        self.stub = stub
+        self.name = name
+        self.address = stub.address
+
+    def __getattr__(self, method):
+        def rmi_call(*args):
+            return self.stub.lock_call(self.name, method, list(args))
+        return rmi_call
+
+
+class LockPeerList(object):
+
+    """The peer list as seen by one named lock.
+
+    Membership is the one of the real peer list.
+    """
+
+    def __init__(self, peer_list, name):
+        self.peer_list = peer_list
+        self.name = name
+        self.peers = PeerSnapshot()
+
+    def get_peers(self):
+        snapshot = self.peer_list.get_peers()
+        if snapshot.version != self.peers.version:
+            self.peers = PeerSnapshot(snapshot.version, {
+                pid: NamedStub(snapshot[pid], self.name) for pid in snapshot})
+        return self.peers
+
+    def peer(self, pid):
+        return NamedStub(self.peer_list.peer(pid), self.name)
+
+    def suspect(self, pid):
+        self.peer_list.suspect(pid)
+
+
+class LockManager(object):
+
+    """Host the named locks of a peer.
+
+    Idle locks are collected, except those of the engines that never are
+    idle (RaymondLock).
+    """
+
+    def __init__(self, owner, peer_list, engine=DEFAULT_ENGINE,
+                 idle_timeout=60.0, max_retired=1000):
+        self.owner = owner
+        self.peer_list = peer_list
+        self.engine = engine
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.metrics = {}
+        self.last_used = {}
+        # Number of calls currently running on each lock.
+        self.busy = {}
+        # State of the locks that were collected, so that they can be
+        # brought back (without minting a second token), the last
+        # max_retired of them. Those dropped beyond that only leave the
+        # highest clock and generation among them, see _create.
+        self.max_retired = max_retired
+        self.retired = OrderedDict()
+        self.floor = None
+        self.collector = threading.Thread(target=self._collect_loop,
+                                          daemon=True)
+        self.collector.start()
+
+    # Public methods
+
+    def acquire(self, name, timeout=None):
+        return self._call(name, lambda lock: lock.acquire(timeout))
+
+    def try_acquire(self, name):
+        return self._call(name, lambda lock: lock.try_acquire())
+
+    def release(self, name):
+        return self._call(name, lambda lock: lock.release())
+
+    def acquire_shared(self, name, timeout=None):
+        return self._call(name, lambda lock: lock.acquire_shared(timeout))
+
+    def release_shared(self, name):
+        return self._call(name, lambda lock: lock.release_shared())
+
+    def lock_call(self, name, method, args):
+        """Entry point of the messages exchanged by the named locks."""
+
+        def call(lock):
+            calls = lock.remote_calls()
+            if method not in calls:
+                raise AttributeError(
+                    "Lock engine has no remote call '{}'".format(method))
+            return calls[method](*args)
+        return self._call(name, call)
+
+    def lock_metrics(self):
+        """Return the metrics of the hosted locks, by name."""
+
+        self.lock.acquire()
+        try:
+            metrics = dict(self.metrics)
+        finally:
+            self.lock.release()
+        return {name: metrics[name].snapshot() for name in sorted(metrics)}
+
+    def get_state(self):
+        """Return the state of every named lock, hosted or collected, by
+        name (see LockEngine.get_state), and the floor of those
+        forgotten."""
+
+        self.lock.acquire()
+        try:
+            states = dict(self.retired)
+            locks = dict(self.locks)
+            floor = self.floor
+        finally:
+            self.lock.release()
+        for name, lock in locks.items():
+            states[name] = lock.get_state()
+        return {"locks": states, "floor": floor}
+
+    def set_state(self, state):
+        """Bring the named locks back from state (see get_state) the
+        first time they are used."""
+
+        self.lock.acquire()
+        try:
+            self.retired.update(state["locks"])
+            if state.get("floor") is not None:
+                self._raise_floor(state["floor"])
+            self._trim()
+        finally:
+            self.lock.release()
+
+    def register_peer(self, pid):
+        for lock in self._hosted():
+            lock.register_peer(pid)
+
+    def unregister_peer(self, pid):
+        for lock in self._hosted():
+            lock.unregister_peer(pid)
+
+    def destroy(self):
+        for lock in self._hosted():
+            lock.destroy()
+            lock.close()
+
+    def display_status(self, name=None):
+        if name is not None:
+            self._call(name, lambda lock: lock.display_status())
+            return
+        self.lock.acquire()
+        try:
+            print("Named locks ({} hosted, {} collected):".format(
+                len(self.locks), len(self.retired)))
+            now = time.monotonic()
+            for n in sorted(self.locks):
+                print("    {}: idle for {:.1f}s".format(
+                    n, now - self.last_used[n]))
+        finally:
+            self.lock.release()
+
+    # Private methods
+
+    def _hosted(self):
+        self.lock.acquire()
+        try:
+            return list(self.locks.values())
+        finally:
+            self.lock.release()
+
+    def _call(self, name, call):
+        self.lock.acquire()
+        try:
+            lock = self.locks.get(name)
+            if lock is None:
+                lock = self._create(name)
+            self.busy[name] = self.busy.get(name, 0) + 1
+        finally:
+            self.lock.release()
+        try:
+            return call(lock)
+        finally:
+            self.lock.acquire()
+            try:
+                self.busy[name] -= 1
+                self.last_used[name] = time.monotonic()
+            finally:
+                self.lock.release()
+
+    def _create(self, name):
+        """Create a lock, with self.lock held."""
+
+        lock = create_engine(self.engine, self.owner,
+                             LockPeerList(self.peer_list, name))
+        state = self.retired.pop(name, None)
+        if state is None and self.floor is not None:
+            # It may be one of the locks forgotten: its token may be out
+            # there, and our clock must not go back. A lock that really
+            # is new gets its token from the recovery of the first peer
+            # waiting for it (see DistributedLock.recover_token).
+            state = dict(self.floor, pending=[])
+        if state is None:
+            lock.initialize()
+        else:
+            lock.initialize(mint_token=False)
+            lock.set_state(state)
+        self.locks[name] = lock
+        self.metrics[name] = LockMetrics(lock)
+        self.last_used[name] = time.monotonic()
+        logging.debug("Lock '{}' created.".format(name))
+        return lock
+
+    def _collect_loop(self):
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            self._collect()
+
+    def _collect(self):
+        now = time.monotonic()
+        self.lock.acquire()
+        try:
+            for name in list(self.locks):
+                lock = self.locks[name]
+                if self.busy.get(name) or \
+                        now - self.last_used[name] < self.idle_timeout or \
+                        not lock.is_idle():
+                    continue
+                self.retired[name] = lock.get_state()
+                lock.close()
+                self._trim()
+                del self.locks[name]
+                del self.metrics[name]
+                del self.last_used[name]
+                self.busy.pop(name, None)
+                logging.debug("Idle lock '{}' collected.".format(name))
+        finally:
+            self.lock.release()
+
+    def _trim(self):
+        """Forget the oldest collected locks beyond max_retired, with
+        self.lock held."""
+
+        while len(self.retired) > self.max_retired:
+            _, state = self.retired.popitem(last=False)
+            self._raise_floor(state)
+
+    def _raise_floor(self, state):
+        floor = self.floor or {"time": 0, "generation": 0}
+        self.floor = {
+            "time": max(floor["time"], state.get("time", 0)),
+            "generation": max(floor["generation"],
+                              state.get("generation", 0))
+        }
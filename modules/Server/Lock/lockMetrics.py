@@ -0,0 +1,185 @@
+# ------------------------------------------------------------------------------
+#  Metrics of a lock engine, built from the events it fires.
+#
+#  A LockMetrics listens to one engine and keeps: a histogram of the time
+#  an acquire waited and one of the time the lock was held, the number of
+#  token handoffs (in total and per second), the requests served per peer
+#  (the token was handed over to it, or taken here) and the handoffs that
+#  failed, or may have, per peer. snapshot() returns all of it as plain
+#  data, ready to be sent over RMI or written out by a MetricsDump.
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+
+class Histogram(object):
+
+    """Histogram of durations with exponentially growing buckets.
+
+    Bucket i counts the values up to smallest * factor ** i seconds; the
+    last one everything above.
+    """
+
+    def __init__(self, smallest=0.0001, factor=2.0, buckets=24):
+        self.bounds = [smallest * factor ** i for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction."""
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        buckets = []
+        for i, n in enumerate(self.counts):
+            if n:
+                bound = self.bounds[i] if i < len(self.bounds) else None
+                buckets.append([bound, n])
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "buckets": buckets
+        }
+
+
+class LockMetrics(object):
+
+    """Metrics of one lock engine (see LockEngine.add_listener)."""
+
+    def __init__(self, engine, window=60.0):
+        self.engine = engine
+        # Handoffs per second are computed over the last window seconds.
+        self.window = window
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requested_at = None
+        self.acquired_at = None
+        self.acquires = 0
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.handoffs = 0
+        self.recent = deque()
+        self.served = {}
+        self.failed = {}
+        self.doubtful = {}
+        engine.add_listener(self.on_event)
+
+    def on_event(self, engine, event, info):
+        now = time.monotonic()
+        with self.lock:
+            if event == "requested":
+                self.requested_at = now
+            elif event == "acquired":
+                self.acquires += 1
+                if self.requested_at is not None:
+                    self.wait.add(now - self.requested_at)
+                else:
+                    # Taken without asking (try_acquire).
+                    self.wait.add(0.0)
+                self.requested_at = None
+                self.acquired_at = now
+                self._count(self.served, engine.owner.id)
+            elif event == "released":
+                if self.acquired_at is not None:
+                    self.hold.add(now - self.acquired_at)
+                self.acquired_at = None
+            elif event == "handoff":
+                self.handoffs += 1
+                self.recent.append(now)
+                self._trim(now)
+                self._count(self.served, info["to"])
+            elif event == "delivery_failed":
+                self._count(self.failed, info["to"])
+            elif event == "delivery_in_doubt":
+                self._count(self.doubtful, info["to"])
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            uptime = now - self.started
+            return {
+                "engine": self.engine.name,
+                "peer": self.engine.owner.id,
+                "uptime": uptime,
+                "acquires": self.acquires,
+                "held_for": None if self.acquired_at is None
+                else now - self.acquired_at,
+                "wait": self.wait.snapshot(),
+                "hold": self.hold.snapshot(),
+                "handoffs": self.handoffs,
+                "handoffs_per_second": len(self.recent) / min(
+                    self.window, uptime) if uptime > 0 else 0.0,
+                "served": dict(self.served),
+                "failed_deliveries": dict(self.failed),
+                "doubtful_deliveries": dict(self.doubtful)
+            }
+
+    # Private methods
+
+    def _count(self, counters, pid):
+        counters[pid] = counters.get(pid, 0) + 1
+
+    def _trim(self, now):
+        """Forget the handoffs older than the window, with self.lock held."""
+        while self.recent and now - self.recent[0] > self.window:
+            self.recent.popleft()
+
+
+class MetricsDump(threading.Thread):
+
+    """Write snapshot() to a JSON file every interval seconds.
+
+    The file is replaced atomically, so a reader never sees half of it.
+    """
+
+    def __init__(self, snapshot, path, interval=10.0):
+        threading.Thread.__init__(self)
+        self.snapshot = snapshot
+        self.path = path
+        self.interval = interval
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except Exception as e:
+                logging.warning("Lock metrics could not be written to {}: "
+                                "{}".format(self.path, e))
+
+    def dump(self):
+        data = dict(self.snapshot(), time=time.time())
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
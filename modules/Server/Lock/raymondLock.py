@@ -0,0 +1,530 @@
+# ------------------------------------------------------------------------------
+#  Raymond's tree based token algorithm for distributed mutual exclusion.
+#
+#  K. Raymond, "A tree-based algorithm for distributed mutual exclusion",
+#  ACM Transactions on Computer Systems, 1989.
+#
+#  The peers form a tree; every peer only knows its 'holder', the
+#  neighbour in the direction of the token. Requests travel up the holder
+#  pointers and the token travels back down, turning the pointers around
+#  as it goes. With the peers arranged as a balanced tree an entry into
+#  the CS costs O(log n) messages instead of the n of the broadcast
+#  algorithm.
+#
+#  Recovery: lost messages and peers leaving or crashing can break the
+#  tree, or lose the token. A peer that waits longer than token_timeout
+#  has the tree rebuilt by the lowest ranked peer that answers (see
+#  raymond_recover). It freezes every peer and asks each of them whether
+#  it has the token. If one does, the tree is rebuilt around it; if every
+#  peer answers that none does, a token of a higher generation is minted
+#  and the tree is rebuilt around the recovering peer. If a peer cannot
+#  be asked, nothing changes until the next attempt. Privileges of an
+#  older generation that turn up later are dropped.
+# ------------------------------------------------------------------------------
+
+import time
+import logging
+import threading
+from Server.Lock.lockEngine import LockEngine, Dispatcher
+
+
+class RaymondLock(LockEngine):
+
+    name = "raymond"
+
+    def __init__(self, owner, peer_list):
+        LockEngine.__init__(self, owner, peer_list)
+        self.lock = threading.Condition()
+        self.dispatcher = Dispatcher()
+        self.holder = None
+        self.using = False
+        self.asked = False
+        self.queue = []
+        self.messages = 0
+        # Reentrancy, as with the token algorithm: the thread in the CS
+        # (None while it is ours but no local thread took it yet), how
+        # many times it acquired it, and the local threads waiting.
+        self.thread = None
+        self.depth = 0
+        self.local_waiters = 0
+        # True while the token is on its way to us from a peer that left
+        # (see raymond_reparent): holder is us, but we cannot use it yet.
+        self.expecting = False
+        # The peer we pointed everybody at when we left, see destroy.
+        self.successor = None
+        # Recovery, as with the token algorithm.
+        self.token_timeout = 5.0
+        self.freeze_timeout = 2.0
+        self.generation = 0
+        self.frozen_until = 0.0
+        self.recovery = threading.Lock()
+        self.recoveries = 0
+
+    def initialize(self, mint_token=True):
+        """
+        The peers are arranged as a binary heap in the order of their ids:
+        a new peer hangs below the peer at position (i - 1) // 2. Only the
+        first peer starts with the token.
+        """
+
+        self.lock.acquire()
+        try:
+            pids = sorted(self.peer_list.get_peers())
+            me = self.owner.id
+            position = pids.index(me)
+            if position == 0 and mint_token:
+                self.holder = me
+            elif position == 0:
+                self.holder = pids[1] if len(pids) > 1 else None
+            else:
+                self.holder = pids[(position - 1) // 2]
+        finally:
+            self.lock.release()
+
+    def destroy(self):
+        """Leave the tree, handing the token over if it is here.
+
+        Every peer pointing at us is told to point at our successor: our
+        own holder, or the peer that gets the token. A token still on its
+        way to us is passed on to the successor when it arrives (see
+        raymond_privilege).
+        """
+
+        self.lock.acquire()
+        try:
+            me = self.owner.id
+            others = [pid for pid in self.peer_list.get_peers() if pid != me]
+            if not others:
+                return
+            if self.holder == me:
+                waiting = [pid for pid in self.queue if pid != me]
+                successor = waiting[0] if waiting else others[0]
+                self.using = False
+                self.thread = None
+                self.depth = 0
+                if not self.expecting:
+                    self._send(successor, "raymond_privilege", me,
+                               self.generation)
+            else:
+                successor = self.holder
+            self.holder = successor
+            self.successor = successor
+            for pid in others:
+                self._send(pid, "raymond_reparent", me, successor)
+        finally:
+            self.lock.release()
+        self.dispatcher.flush()
+
+    def close(self):
+        self.dispatcher.close()
+
+    def register_peer(self, pid):
+        # A new peer attaches itself below an existing one, nothing to do.
+        pass
+
+    def unregister_peer(self, pid):
+        self.lock.acquire()
+        try:
+            self.queue = [q for q in self.queue if q != pid]
+            if self.holder == pid:
+                logging.warning("Peer {} left without handing over; the "
+                                "lock tree is mended by the next recovery."
+                                .format(pid))
+        finally:
+            self.lock.release()
+
+    def acquire(self, timeout=None):
+        """Block until the lock is held or timeout seconds passed.
+
+        Acquires are reentrant: the thread in the CS may acquire the lock
+        again, and holds it until it has released it as many times. Other
+        local threads wait for it; each of them asks for the token again
+        once it is released, behind the requests queued meanwhile.
+        """
+
+        start = time.monotonic()
+        me = threading.get_ident()
+        self.lock.acquire()
+        try:
+            if self.using and self.thread == me:
+                self.depth += 1
+                return True
+            self.local_waiters += 1
+            acquired = False
+            try:
+                while True:
+                    if self._claimable():
+                        self.thread = me
+                        self.depth = 1
+                        acquired = True
+                        break
+                    if not self.using and self.owner.id not in self.queue:
+                        # Nobody here asks for the token (any more).
+                        self.start_acquire()
+                        continue
+                    if not self._wait_using(
+                            lambda: self._claimable() or (
+                                not self.using and
+                                self.owner.id not in self.queue),
+                            start, timeout):
+                        break
+            finally:
+                self.local_waiters -= 1
+            if acquired:
+                self.wait_time = time.monotonic() - start
+            elif self.local_waiters == 0:
+                # Give up; the token will be passed on when it gets here.
+                if self.owner.id in self.queue:
+                    self.queue.remove(self.owner.id)
+                if self._claimable():
+                    # It got here meanwhile, but nobody takes it any more.
+                    self.using = False
+                    self._fire("released")
+                    self._assign_privilege()
+                    self._make_request()
+            return acquired
+        finally:
+            self.lock.release()
+
+    def start_acquire(self):
+        self.lock.acquire()
+        try:
+            if self.using or self.owner.id in self.queue:
+                return
+            self.queue.append(self.owner.id)
+            self._fire("requested")
+            self._assign_privilege()
+            self._make_request()
+        finally:
+            self.lock.release()
+
+    def try_acquire(self):
+        self.lock.acquire()
+        try:
+            if self.using and self.thread == threading.get_ident():
+                self.depth += 1
+                return True
+            if self.holder != self.owner.id or self.using or self.queue \
+                    or self.expecting or self._frozen():
+                return False
+            self.using = True
+            self.thread = threading.get_ident()
+            self.depth = 1
+            self.wait_time = 0.0
+            self._fire("acquired")
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        try:
+            if not self.using or (self.thread is None and
+                                  self.local_waiters):
+                # Not held, or already ours for a local thread.
+                return
+            if self.depth > 1:
+                self.depth -= 1
+                return
+            self.thread = None
+            self.depth = 0
+            self.using = False
+            self._fire("released")
+            self._assign_privilege()
+            self._make_request()
+            if self.local_waiters:
+                # They ask for the token again, see acquire.
+                self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def remote_calls(self):
+        return {
+            "raymond_request":    self.raymond_request,
+            "raymond_privilege":  self.raymond_privilege,
+            "raymond_reparent":   self.raymond_reparent,
+            "raymond_recover":    self.raymond_recover,
+            "raymond_freeze":     self.raymond_freeze,
+            "raymond_thaw":       self.raymond_thaw
+        }
+
+    def recover(self):
+        """Ask the lowest ranked peer that answers to rebuild the tree."""
+
+        me = self.owner.id
+        peers = self.peer_list.get_peers()
+        for pid in sorted(peers):
+            try:
+                if pid == me:
+                    self.raymond_recover()
+                else:
+                    peers[pid].raymond_recover()
+                return
+            except Exception as e:
+                logging.info("Peer {} cannot run the tree recovery: {}"
+                             .format(pid, e))
+
+    # Messages
+
+    def raymond_request(self, pid):
+        """A neighbour asks for the token on behalf of its subtree."""
+
+        self.lock.acquire()
+        try:
+            self.queue.append(pid)
+            self._assign_privilege()
+            self._make_request()
+        finally:
+            self.lock.release()
+
+    def raymond_privilege(self, pid, generation=0):
+        """The token arrives from a neighbour."""
+
+        self.lock.acquire()
+        try:
+            if self.successor is not None:
+                # We left: it goes where everybody was told to look.
+                self._send(self.successor, "raymond_privilege",
+                           self.owner.id, generation)
+                return
+            if generation < self.generation:
+                logging.warning("Privilege of generation {} dropped, it "
+                                "was replaced by generation {}.".format(
+                                    generation, self.generation))
+                return
+            self.generation = generation
+            self.holder = self.owner.id
+            self.expecting = False
+            self._assign_privilege()
+            self._make_request()
+        finally:
+            self.lock.release()
+
+    def raymond_reparent(self, old, new):
+        """Peer old left the tree; new takes its place."""
+
+        self.lock.acquire()
+        try:
+            self.queue = [q for q in self.queue if q != old]
+            if self.holder == old:
+                # Whatever we asked old for is lost, ask again.
+                self.asked = False
+                self.holder = new
+                if new == self.owner.id:
+                    # The token is on its way to us: old handed it over,
+                    # or passes on the one it was sent (see destroy).
+                    # We are the root, but wait for it before using it.
+                    self.expecting = True
+            self._assign_privilege()
+            self._make_request()
+        finally:
+            self.lock.release()
+
+    # Recovery
+
+    def raymond_recover(self):
+        """Rebuild the tree around the token, regenerating the token if
+        it is lost; returns True if a new one was minted here.
+
+        Only the peers that have the token of the highest generation
+        count as having it. A token is only minted if every peer of the
+        list answered, all within freeze_timeout; if a peer cannot be
+        asked, the name server is asked to check it (see
+        PeerList.suspect), and nothing changes until the next attempt.
+        """
+
+        me = self.owner.id
+        with self.recovery:
+            peers = self.peer_list.get_peers()
+            replies = {}
+            failed = []
+            start = time.monotonic()
+            for pid in peers:
+                try:
+                    replies[pid] = peers[pid].raymond_freeze(
+                        me, self.freeze_timeout)
+                except Exception as e:
+                    failed.append(pid)
+                    logging.info("Peer {} did not answer the token probe: "
+                                 "{}".format(pid, e))
+            generation = max([self.generation] + [
+                reply[1] for reply in replies.values()])
+            holders = sorted(pid for pid in replies if replies[pid][0] and
+                             replies[pid][1] == generation)
+            minted = False
+            if failed or len(holders) > 1 or \
+                    time.monotonic() - start >= self.freeze_timeout:
+                root = None
+                generation = None
+                logging.warning("Tree recovery called off, peer(s) {} "
+                                "could not be asked.".format(failed or
+                                                             "all"))
+            elif holders:
+                root = holders[0]
+            else:
+                root = me
+                generation += 1
+                minted = True
+                self.lock.acquire()
+                try:
+                    self.generation = generation
+                    self.holder = me
+                    self.expecting = False
+                    self.recoveries += 1
+                finally:
+                    self.lock.release()
+                logging.warning("The token was lost; generation {} minted "
+                                "by peer {}.".format(generation, me))
+            # The new tree: a binary heap with the root on top, as in
+            # initialize.
+            parents = {}
+            if root is not None:
+                order = [root] + sorted(pid for pid in replies
+                                        if pid != root)
+                for position, pid in enumerate(order):
+                    parents[pid] = order[(position - 1) // 2] \
+                        if position else root
+            for pid in replies:
+                try:
+                    peers[pid].raymond_thaw(generation, parents.get(pid))
+                except Exception as e:
+                    logging.info("Peer {} could not be thawed: {}".format(
+                        pid, e))
+            for pid in failed:
+                self.peer_list.suspect(pid)
+            return minted
+
+    def raymond_freeze(self, pid, duration):
+        """Keep the token where it is for duration seconds (or until
+        raymond_thaw); returns [has the token, generation].
+
+        A privilege arriving meanwhile is kept, but not used or passed on
+        before raymond_thaw.
+        """
+
+        self.lock.acquire()
+        try:
+            self.frozen_until = time.monotonic() + duration
+            present = self.holder == self.owner.id and not self.expecting
+            return [present, self.generation]
+        finally:
+            self.lock.release()
+
+    def raymond_thaw(self, generation, parent):
+        """The recovery is over. Unless it was called off (generation
+        None), the token is of generation from now on and our holder is
+        parent (ourselves at the root); the requests are made again along
+        the new tree."""
+
+        self.lock.acquire()
+        try:
+            me = self.owner.id
+            self.frozen_until = 0.0
+            if generation is not None:
+                if generation > self.generation and self.holder == me \
+                        and not self.expecting:
+                    logging.warning("Privilege of generation {} dropped, "
+                                    "it was replaced by generation {}."
+                                    .format(self.generation, generation))
+                self.generation = max(self.generation, generation)
+                self.holder = parent
+                self.expecting = False
+                self.asked = False
+                self.queue = [me] if me in self.queue else []
+            self._assign_privilege()
+            self._make_request()
+        finally:
+            self.lock.release()
+
+    def display_status(self):
+        self.lock.acquire()
+        try:
+            print("Engine  :: {0}".format(self.name))
+            print("Holder  :: {0}".format(self.holder))
+            print("Using   :: {0}".format(self.using))
+            print("Asked   :: {0}".format(self.asked))
+            print("Queue   :: {0}".format(self.queue))
+            print("Sent    :: {0} messages".format(self.messages))
+            print("Waited  :: {0:.3f}s".format(self.wait_time))
+            print("Recover :: generation {0}, {1} token(s) minted".format(
+                self.generation, self.recoveries))
+        finally:
+            self.lock.release()
+
+    # Private methods, called with self.lock held
+
+    def _assign_privilege(self):
+        me = self.owner.id
+        if self.holder != me or self.using or not self.queue or \
+                self.expecting or self._frozen():
+            return
+        self.holder = self.queue.pop(0)
+        self.asked = False
+        if self.holder == me:
+            self.using = True
+            self.lock.notify_all()
+            self._fire("acquired")
+        else:
+            self._send(self.holder, "raymond_privilege", me, self.generation,
+                       on_failure=self._privilege_lost(self.holder))
+            self._fire("handoff", to=self.holder)
+
+    def _make_request(self):
+        if self.holder != self.owner.id and self.queue and not self.asked:
+            self._send(self.holder, "raymond_request", self.owner.id)
+            self.asked = True
+
+    def _privilege_lost(self, pid):
+        def on_failure(error):
+            self.lock.acquire()
+            try:
+                if not self._not_sent(error):
+                    # It may have arrived: taking it back could make two
+                    # tokens. If it is lost, the recovery mints another.
+                    self._fire("delivery_in_doubt", to=pid)
+                    return
+                # The token never left: take it back and serve the others.
+                self._fire("delivery_failed", to=pid)
+                if self.holder == pid:
+                    self.holder = self.owner.id
+                    self._assign_privilege()
+                    self._make_request()
+            finally:
+                self.lock.release()
+        return on_failure
+
+    def _claimable(self):
+        """The lock is ours, no local thread took it yet."""
+        return self.using and self.thread is None and self.depth == 0
+
+    def _wait_using(self, predicate, start, timeout):
+        """Wait, with the lock held, until predicate is true.
+
+        Whenever token_timeout seconds pass without it, the tree is
+        suspected broken (see recover). Returns the final value of
+        predicate.
+        """
+
+        while True:
+            wait = self.token_timeout
+            if timeout is not None:
+                wait = min(wait, start + timeout - time.monotonic())
+            if self.lock.wait_for(predicate, max(wait, 0)):
+                return True
+            if timeout is not None and \
+                    time.monotonic() - start >= timeout:
+                return predicate()
+            self.lock.release()
+            try:
+                self.recover()
+            finally:
+                self.lock.acquire()
+
+    def _frozen(self):
+        return time.monotonic() < self.frozen_until
+
+    def _send(self, pid, method, *args, on_failure=None):
+        self.messages += 1
+        self.dispatcher.send(
+            lambda: getattr(self.peer_list.peer(pid), method)(*args),
+            on_failure)
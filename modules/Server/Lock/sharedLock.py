@@ -0,0 +1,407 @@
+# ------------------------------------------------------------------------------
+#  Shared/exclusive (readers-writers) mode for the token based lock.
+#
+#  Exclusive access works exactly as in DistributedLock: the token is
+#  needed and held. For shared access a peer broadcasts a request marked
+#  as shared. The peer that has the token grants it a shared access
+#  without giving the token away and keeps track of its readers; as long
+#  as it has readers the token stays where it is. The grants must be
+#  returned before anybody gets exclusive access.
+#
+#  To bound the waiting of the writers, no new shared access is granted
+#  once an exclusive request is pending: the readers drain, and the token
+#  moves on following the usual rules.
+#
+#  A grant or its return may get lost. When a request that was already
+#  seen comes again (the peer waited for too long, see recover), the peer
+#  with the token asks its readers whether they still use their grant
+#  (check_shared): those that never got it take it then, those that
+#  returned it are forgotten.
+# ------------------------------------------------------------------------------
+
+import time
+import logging
+from Server.Lock.lockEngine import Dispatcher
+from Server.Lock.distributedLock import DistributedLock, TOKEN_PRESENT
+
+SHARED = "S"
+EXCLUSIVE = "X"
+
+
+class SharedLock(DistributedLock):
+
+    """Token based lock with shared and exclusive modes."""
+
+    name = "shared"
+
+    def __init__(self, owner, peer_list):
+        DistributedLock.__init__(self, owner, peer_list)
+        # Grants and their returns go through a dispatcher: both are sent
+        # by handlers, with the lock held on both sides.
+        self.dispatcher = Dispatcher()
+        self.mode = {}
+        # Peers (us included) holding a shared access granted by us, with
+        # the time of the request that was granted.
+        self.readers = {}
+        self.shared_waiting = False
+        self.shared_held = False
+        # The peer whose grant we hold, and the time of our request.
+        self.granter = None
+        self.granted = 0
+        self.drain_timeout = 5.0
+
+    # Shared mode
+
+    def acquire_shared(self, timeout=None):
+        """Block until a shared access is granted or timeout seconds passed.
+
+        Returns True if the lock is held in shared mode.
+        """
+
+        start = time.monotonic()
+        if self.start_acquire_shared():
+            self.wait_time = time.monotonic() - start
+            return True
+
+        self.lock.acquire()
+        try:
+            acquired = self._wait_token(
+                lambda: self.shared_held, start, timeout)
+            # A late grant is returned at once, a late token passed on.
+            self.shared_waiting = False
+            if acquired:
+                self.wait_time = time.monotonic() - start
+            return acquired
+        finally:
+            self.lock.release()
+
+    def start_acquire_shared(self):
+        """The first half of acquire_shared: enter at once if the token is
+        here and no exclusive request is pending, send the request
+        otherwise.
+
+        Returns True if the lock is held in shared mode.
+        """
+
+        self.lock.acquire()
+        try:
+            if self.shared_held:
+                return True
+            self.time = self.time + 1
+            self._fire("requested", mode=SHARED)
+            if self.state is TOKEN_PRESENT and not self._exclusive_pending():
+                self._enter_shared(self.owner.id)
+                return True
+            self.shared_waiting = True
+        finally:
+            self.lock.release()
+        self._broadcast_request(SHARED)
+        return False
+
+    def release_shared(self):
+        self.lock.acquire()
+        try:
+            if not self.shared_held:
+                return
+            self.shared_held = False
+            self._fire("released", mode=SHARED)
+            if self.granter == self.owner.id:
+                self._reader_done(self.owner.id, self.granted)
+            else:
+                self._send(self.granter, "return_shared", self.owner.id,
+                           self.granted)
+            self.granter = None
+        finally:
+            self.lock.release()
+        self._flush()
+
+    def grant_shared(self, pid, time):
+        """Peer pid, which has the token, grants our request of the given
+        time a shared access."""
+
+        self.lock.acquire()
+        try:
+            if self._holds_grant(pid, time):
+                # Taken already, when it was checked (see check_shared).
+                return
+            if not self._take_grant(pid, time):
+                # Late, the request was given up.
+                self._send(pid, "return_shared", self.owner.id, time)
+        finally:
+            self.lock.release()
+
+    def check_shared(self, pid, time):
+        """Peer pid, which has the token, asks whether we still use the
+        shared access it granted to our request of the given time.
+
+        A grant that got lost is taken now. Returns False once we are
+        done with it.
+        """
+
+        self.lock.acquire()
+        try:
+            return self._holds_grant(pid, time) or \
+                self._take_grant(pid, time)
+        finally:
+            self.lock.release()
+
+    def return_shared(self, pid, time):
+        """Peer pid is done with the shared access granted to its request
+        of the given time."""
+
+        self.lock.acquire()
+        try:
+            self._reader_done(pid, time)
+        finally:
+            self.lock.release()
+        self._flush()
+
+    # Exclusive mode and the rules of DistributedLock
+
+    def destroy(self):
+        """Leave, handing the token over once the readers are done.
+
+        Readers that do not return their grant within drain_timeout
+        seconds are forgotten.
+        """
+
+        self.release_shared()
+        self.lock.acquire()
+        try:
+            self.lock.wait_for(lambda: not self.readers, self.drain_timeout)
+            self.readers.clear()
+            # A local exclusive request is given up, not served now.
+            self.waiting = False
+            if self.state is TOKEN_PRESENT:
+                self._pass_token()
+        finally:
+            self.lock.release()
+        self._flush()
+        DistributedLock.destroy(self)
+        self.dispatcher.flush()
+
+    def close(self):
+        self.dispatcher.close()
+
+    def recover(self):
+        DistributedLock.recover(self)
+        if self.shared_waiting:
+            self._broadcast_request(SHARED)
+        self._check_readers()
+
+    def try_acquire(self):
+        self.lock.acquire()
+        try:
+            if self.readers:
+                return False
+            return DistributedLock.try_acquire(self)
+        finally:
+            self.lock.release()
+
+    def unregister_peer(self, pid):
+        DistributedLock.unregister_peer(self, pid)
+        self.lock.acquire()
+        try:
+            self.mode.pop(pid, None)
+            if pid in self.readers:
+                self._reader_done(pid, self.readers[pid])
+        finally:
+            self.lock.release()
+        self._flush()
+
+    def remote_calls(self):
+        calls = DistributedLock.remote_calls(self)
+        calls.update({
+            "grant_shared":       self.grant_shared,
+            "return_shared":      self.return_shared,
+            "check_shared":       self.check_shared
+        })
+        return calls
+
+    def get_state(self):
+        state = DistributedLock.get_state(self)
+        self.lock.acquire()
+        try:
+            state["modes"] = [[pid, self.mode[pid]] for pid, _ in
+                              state["pending"] if pid in self.mode]
+            return state
+        finally:
+            self.lock.release()
+
+    def set_state(self, state):
+        DistributedLock.set_state(self, state)
+        self.lock.acquire()
+        try:
+            for pid, mode in state.get("modes", []):
+                self.mode[pid] = mode
+        finally:
+            self.lock.release()
+
+    def is_idle(self):
+        self.lock.acquire()
+        try:
+            return DistributedLock.is_idle(self) and \
+                not self.shared_waiting and not self.shared_held
+        finally:
+            self.lock.release()
+
+    def display_status(self):
+        DistributedLock.display_status(self)
+        self.lock.acquire()
+        try:
+            print("Shared  :: held: {0}, granted by: {1}".format(
+                self.shared_held, self.granter))
+            print("Readers :: {0}".format(sorted(self.readers)))
+            print("Modes   :: {0}".format(self.mode))
+        finally:
+            self.lock.release()
+
+    # Private methods, called with the lock held
+
+    def _apply_request(self, pid, time, mode=EXCLUSIVE):
+        if time > self.request.get(pid, 0):
+            self.mode[pid] = mode
+        elif self.state is TOKEN_PRESENT and \
+                set(self.readers) - {self.owner.id}:
+            # Sent again: it waited for long, maybe for a lost grant or
+            # a lost return.
+            self.dispatcher.send(self._check_readers)
+        DistributedLock._apply_request(self, pid, time)
+
+    def _accept_token(self):
+        if self.shared_waiting and not self.shared_held and not self.waiting:
+            self.state = TOKEN_PRESENT
+            self._enter_shared(self.owner.id)
+            self.lock.notify_all()
+            self._pass_token()
+        elif self.waiting and self.readers:
+            # Taken once the readers are done (see _pass_token).
+            self.state = TOKEN_PRESENT
+        else:
+            DistributedLock._accept_token(self)
+
+    def _pass_token(self):
+        """Serve the pending requests while the token is present.
+
+        Shared requests are granted while no exclusive one is pending.
+        The token only moves on once every reader is done.
+        """
+
+        if not self._exclusive_pending():
+            if self.shared_waiting and not self.shared_held:
+                # A local shared acquire that came while we held the lock.
+                self._enter_shared(self.owner.id)
+                self.lock.notify_all()
+            for pid in self._pending(SHARED):
+                self.token[pid] = self.request[pid]
+                self.readers[pid] = self.request[pid]
+                self._send(pid, "grant_shared", self.owner.id,
+                           self.request[pid],
+                           on_failure=self._grant_lost(pid))
+        if self.readers:
+            return
+        if self.waiting:
+            # A local exclusive acquire waited for the readers.
+            DistributedLock._accept_token(self)
+            return
+        DistributedLock._pass_token(self)
+
+    def _holds_grant(self, pid, time):
+        return self.shared_held and self.granter == pid and \
+            self.granted == time
+
+    def _take_grant(self, pid, time):
+        """Take the grant of pid for our request of the given time if we
+        still wait for it; returns True if it was taken."""
+
+        if not self.shared_waiting or self.shared_held or time != self.time:
+            return False
+        self.shared_waiting = False
+        self.shared_held = True
+        self.granter = pid
+        self.granted = time
+        self._fire("acquired", mode=SHARED)
+        self.lock.notify_all()
+        return True
+
+    def _enter_shared(self, pid):
+        self.token[pid] = self.time
+        self.readers[pid] = self.time
+        self.shared_waiting = False
+        self.shared_held = True
+        self.granter = pid
+        self.granted = self.time
+        self._fire("acquired", mode=SHARED)
+
+    def _reader_done(self, pid, time):
+        if self.readers.get(pid) == time:
+            del self.readers[pid]
+        if not self.readers and self.state is TOKEN_PRESENT:
+            self._pass_token()
+
+    def _pending(self, mode):
+        me = self.owner.id
+        return [pid for pid, time in self.request.items()
+                if pid != me and time > self.token.get(pid, 0) and
+                self.mode.get(pid, EXCLUSIVE) == mode]
+
+    def _exclusive_pending(self):
+        return self.waiting or bool(self._pending(EXCLUSIVE))
+
+    def _served_time(self):
+        # Our own shared request may still be pending when the token
+        # leaves (an exclusive one came first): keep it pending.
+        if self.shared_waiting and not self.shared_held:
+            return self.time - 1
+        return self.time
+
+    def _grant_lost(self, pid):
+        def on_failure(error):
+            self.lock.acquire()
+            try:
+                if not self._not_sent(error):
+                    # The reader may have the grant and return it: it is
+                    # only forgotten when it leaves (see unregister_peer).
+                    logging.warning("The grant may not have reached peer "
+                                    "{}: {}".format(pid, error))
+                    self._fire("delivery_in_doubt", to=pid)
+                elif pid in self.readers:
+                    # It never got the grant, it will never return it.
+                    self._reader_done(pid, self.readers[pid])
+            finally:
+                self.lock.release()
+            self._flush()
+        return on_failure
+
+    def _check_readers(self):
+        """Ask the other readers whether they still use their grant, and
+        forget those that do not (their return got lost). Called without
+        the lock held, from recover or the dispatcher."""
+
+        me = self.owner.id
+        self.lock.acquire()
+        try:
+            readers = [(pid, time) for pid, time in self.readers.items()
+                       if pid != me]
+        finally:
+            self.lock.release()
+        for pid, time in readers:
+            try:
+                using = self.peer_list.peer(pid).check_shared(me, time)
+            except Exception as e:
+                # If it is gone, unregister_peer forgets it.
+                logging.info("Reader {} could not be checked: {}".format(
+                    pid, e))
+                continue
+            if not using:
+                self.lock.acquire()
+                try:
+                    self._reader_done(pid, time)
+                finally:
+                    self.lock.release()
+        self._flush()
+
+    def _send(self, pid, method, *args, on_failure=None):
+        self.dispatcher.send(
+            lambda: getattr(self.peer_list.peer(pid), method)(*args),
+            on_failure)
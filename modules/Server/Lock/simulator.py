@@ -0,0 +1,458 @@
+# ------------------------------------------------------------------------------
+#  Deterministic simulation of the distributed lock engines.
+#
+#  N peers run in a single thread over a simulated network: every RMI
+#  between peers becomes an event, delivered after a random latency (or
+#  lost), on a virtual clock. Each peer runs a closed loop workload
+#  (think, acquire, hold, release), some of whose accesses may be shared
+#  reads, and peers may leave, crash and join while it runs. The same seed gives the same run, so engines can be
+#  compared side by side (see lab4/lockSim.py).
+#
+#  The calls whose result the caller needs (those of the token recovery,
+#  see SYNCHRONOUS) are delivered at once, without latency nor loss.
+# ------------------------------------------------------------------------------
+
+import heapq
+import random
+import logging
+from Common import orb
+from Server.peerList import PeerList
+from Server.Lock.engines import create_engine
+from Server.Lock.sharedLock import SHARED, EXCLUSIVE
+
+SYNCHRONOUS = frozenset(["recover_token", "token_freeze", "token_thaw",
+                         "raymond_recover", "raymond_freeze",
+                         "raymond_thaw", "check_shared"])
+
+
+class Network(object):
+
+    """Virtual clock, event queue and links of the simulation."""
+
+    def __init__(self, seed=0, latency=(0.001, 0.005), loss=0.0):
+        self.random = random.Random("{}-network".format(seed))
+        self.latency = latency
+        self.loss = loss
+        self.now = 0.0
+        self.events = []
+        self.sequence = 0
+        self.nodes = {}
+        self.messages = 0
+        self.lost = 0
+        self.control = 0
+
+    def schedule(self, delay, call):
+        """Run call (a function without arguments) delay seconds from now."""
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, call))
+
+    def run(self, until):
+        while self.events and self.events[0][0] <= until:
+            self.now, _, call = heapq.heappop(self.events)
+            call()
+        self.now = until
+
+    def send(self, src, dst, method, args):
+        node = self.nodes.get(dst)
+        if node is None:
+            raise orb.ComunicationError(
+                "Peer {} is unreachable (simulated).".format(dst))
+        if method in SYNCHRONOUS:
+            self.control += 1
+            return node.call(method, args)
+        self.messages += 1
+        if self.random.random() < self.loss:
+            self.lost += 1
+            return None
+        low, high = self.latency
+        self.schedule(self.random.uniform(low, high),
+                      lambda: self._deliver(dst, method, args))
+        return None
+
+    def _deliver(self, dst, method, args):
+        node = self.nodes.get(dst)
+        if node is None:
+            # It left while the message was on its way.
+            self.lost += 1
+            return
+        try:
+            node.call(method, args)
+        except Exception:
+            logging.exception("Simulated call {} on peer {} failed".format(
+                method, dst))
+
+
+class SimStub(object):
+
+    """Stub of a simulated peer; calls go through the Network.
+
+    Calls other than the SYNCHRONOUS ones return None right away.
+    """
+
+    def __init__(self, network, src, dst):
+        self.network = network
+        self.src = src
+        self.dst = dst
+        self.address = ("sim", dst)
+
+    def __getattr__(self, method):
+        def rmi_call(*args):
+            return self.network.send(self.src, self.dst, method, list(args))
+        return rmi_call
+
+
+class SimDispatcher(object):
+
+    """Dispatcher sending at once: sending is queuing an event anyway."""
+
+    def send(self, call, on_failure=None):
+        try:
+            call()
+        except Exception as e:
+            if on_failure is not None:
+                on_failure(e)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimPeerList(PeerList):
+
+    """Peer list whose stubs go through the simulated network."""
+
+    def __init__(self, owner, network):
+        PeerList.__init__(self, owner)
+        self.network = network
+
+    def _make_stub(self, pid, paddr):
+        return SimStub(self.network, self.owner.id, pid)
+
+    def register_peer(self, pid, paddr):
+        self.lock.acquire()
+        try:
+            self.peers = self.peers.updated(pid, self._make_stub(pid, paddr))
+        finally:
+            self.lock.release()
+
+    def unregister_peer(self, pid):
+        self.lock.acquire()
+        try:
+            if pid in self.peers:
+                self.peers = self.peers.without(pid)
+        finally:
+            self.lock.release()
+
+    def suspect(self, pid):
+        # Crashes are noticed after Simulation.detect seconds anyway.
+        pass
+
+
+class SimPeer(object):
+
+    """A mutex peer of the simulation, with its lock engine."""
+
+    def __init__(self, network, pid, engine):
+        self.id = pid
+        self.type = "sim"
+        self.address = ("sim", pid)
+        self.peer_list = SimPeerList(self, network)
+        self.distributed_lock = create_engine(engine, self, self.peer_list)
+        if hasattr(self.distributed_lock, "dispatcher"):
+            self.distributed_lock.dispatcher.close()
+            self.distributed_lock.dispatcher = SimDispatcher()
+        self.calls = self.distributed_lock.remote_calls()
+
+    def call(self, method, args):
+        return self.calls[method](*args)
+
+    def register_peer(self, pid, paddr):
+        self.peer_list.register_peer(pid, paddr)
+        self.distributed_lock.register_peer(pid)
+
+    def unregister_peer(self, pid):
+        self.peer_list.unregister_peer(pid)
+        self.distributed_lock.unregister_peer(pid)
+
+
+class Simulation(object):
+
+    """One run of a lock engine under a given workload.
+
+    peers     :: number of peers at the start (kept about constant),
+    think     :: mean time between a release and the next request,
+    hold      :: mean time spent in the critical section,
+    read_ratio :: fraction of the accesses that are shared; engines
+                 without a shared mode take them exclusively,
+    churn     :: mean number of peers leaving per second (each one is
+                 replaced by a new peer after rejoin seconds),
+    crash     :: fraction of the leaving peers that crash instead of
+                 leaving cleanly; the others notice after detect seconds.
+    """
+
+    def __init__(self, engine, peers=5, seed=0, duration=60.0,
+                 latency=(0.001, 0.005), loss=0.0, think=0.05, hold=0.01,
+                 read_ratio=0.0, churn=0.0, crash=0.0, rejoin=1.0,
+                 detect=1.0, token_timeout=1.0):
+        self.engine = engine
+        self.seed = seed
+        self.duration = duration
+        self.think = think
+        self.hold = hold
+        self.read_ratio = read_ratio
+        self.churn = churn
+        self.crash = crash
+        self.rejoin = rejoin
+        self.detect = detect
+        self.token_timeout = token_timeout
+        self.network = Network(seed, latency, loss)
+        self.churn_random = random.Random("{}-churn".format(seed))
+        self.randoms = {}
+        self.next_id = 0
+        # Per peer: time the pending request was made, or None.
+        self.asked = {}
+        self.joined = {}
+        self.left = {}
+        self.entries = {}
+        self.shared_entries = 0
+        # The peers in the critical section, with their mode.
+        self.holders = {}
+        self.waits = []
+        self.sync_delays = []
+        self.handoff_from = None
+        self.violations = 0
+        for _ in range(peers):
+            self._join()
+
+    # Public methods
+
+    def run(self):
+        """Run the simulation; returns the results as a dictionary."""
+
+        if self.churn > 0:
+            self._schedule_churn()
+        self.network.run(self.duration)
+        return self.results()
+
+    def results(self):
+        now = self.network.now
+        total = sum(self.entries.values())
+        waits = sorted(self.waits)
+        rates = []
+        for pid, count in self.entries.items():
+            alive = self.left.get(pid, now) - self.joined[pid]
+            if alive > 0:
+                rates.append(count / alive)
+        stalled = [now - t for pid, t in self.asked.items()
+                   if t is not None and pid in self.network.nodes]
+        return {
+            "engine": self.engine,
+            "seed": self.seed,
+            "entries": total,
+            "shared_entries": self.shared_entries,
+            "messages": self.network.messages,
+            "lost": self.network.lost,
+            "control": self.network.control,
+            "messages_per_entry": self.network.messages / total
+            if total else None,
+            "throughput": total / now if now else 0.0,
+            "sync_delay": _mean(self.sync_delays),
+            "wait_mean": _mean(waits),
+            "wait_p95": _percentile(waits, 0.95),
+            "wait_max": waits[-1] if waits else None,
+            "fairness": _jain(rates),
+            "stalled": len([w for w in stalled if w > self.token_timeout]),
+            "violations": self.violations
+        }
+
+    # Workload
+
+    def _think(self, pid):
+        rand = self.randoms[pid]
+        self.network.schedule(rand.expovariate(1.0 / self.think),
+                              lambda: self._request(pid))
+
+    def _request(self, pid):
+        node = self.network.nodes.get(pid)
+        if node is None:
+            return
+        asked = self.network.now
+        self.asked[pid] = asked
+        lock = node.distributed_lock
+        # Drawn only for mixed workloads, so that the others keep their
+        # runs.
+        if self.read_ratio > 0 and hasattr(lock, "start_acquire_shared") \
+                and self.randoms[pid].random() < self.read_ratio:
+            lock.start_acquire_shared()
+        else:
+            lock.start_acquire()
+        self.network.schedule(self.token_timeout,
+                              lambda: self._lease(pid, asked))
+
+    def _lease(self, pid, asked):
+        """The request made at asked still waits: suspect the token."""
+
+        node = self.network.nodes.get(pid)
+        if node is None or self.asked.get(pid) != asked:
+            return
+        node.distributed_lock.recover()
+        self.network.schedule(self.token_timeout,
+                              lambda: self._lease(pid, asked))
+
+    def _acquired(self, engine, event, info):
+        if event != "acquired":
+            return
+        pid = engine.owner.id
+        now = self.network.now
+        mode = info.get("mode", EXCLUSIVE)
+        if mode == EXCLUSIVE and self.holders or \
+                EXCLUSIVE in self.holders.values():
+            self.violations += 1
+        self.holders[pid] = mode
+        if mode == SHARED:
+            self.shared_entries += 1
+        if self.asked.get(pid) is not None:
+            self.waits.append(now - self.asked[pid])
+        self.asked[pid] = None
+        if self.handoff_from is not None:
+            self.sync_delays.append(now - self.handoff_from)
+            self.handoff_from = None
+        self.entries[pid] += 1
+        rand = self.randoms[pid]
+        self.network.schedule(rand.expovariate(1.0 / self.hold),
+                              lambda: self._release(pid))
+
+    def _release(self, pid):
+        node = self.network.nodes.get(pid)
+        if node is None:
+            return
+        mode = self.holders.pop(pid, EXCLUSIVE)
+        if any(t is not None for p, t in self.asked.items()
+               if p != pid and p in self.network.nodes):
+            self.handoff_from = self.network.now
+        if mode == SHARED:
+            node.distributed_lock.release_shared()
+        else:
+            node.distributed_lock.release()
+        self._think(pid)
+
+    # Churn
+
+    def _schedule_churn(self):
+        self.network.schedule(self.churn_random.expovariate(self.churn),
+                              self._churn)
+
+    def _churn(self):
+        alive = sorted(self.network.nodes)
+        if len(alive) > 1:
+            pid = self.churn_random.choice(alive)
+            if self.churn_random.random() < self.crash:
+                self._crash(pid)
+            else:
+                self._leave(pid)
+            self.network.schedule(self.rejoin, self._join)
+        self._schedule_churn()
+
+    def _join(self):
+        pid = self.next_id
+        self.next_id += 1
+        node = SimPeer(self.network, pid, self.engine)
+        node.distributed_lock.token_timeout = self.token_timeout
+        node.distributed_lock.add_listener(self._acquired)
+        others = sorted(self.network.nodes)
+        self.network.nodes[pid] = node
+        for other in others:
+            node.peer_list.register_peer(other, ("sim", other))
+            self.network.nodes[other].register_peer(pid, node.address)
+        node.peer_list.register_peer(pid, node.address)
+        node.distributed_lock.initialize()
+        self.randoms[pid] = random.Random("{}-peer-{}".format(self.seed, pid))
+        self.joined[pid] = self.network.now
+        self.entries[pid] = 0
+        self.asked[pid] = None
+        self._think(pid)
+
+    def _leave(self, pid):
+        node = self.network.nodes.get(pid)
+        if node is None:
+            return
+        if set(getattr(node.distributed_lock, "readers", ())) - {pid}:
+            # SharedLock.destroy waits for its readers to be done: on the
+            # virtual clock, the peer leaves once they are.
+            self.network.schedule(self.hold, lambda: self._leave(pid))
+            return
+        self.holders.pop(pid, None)
+        node.distributed_lock.destroy()
+        self._gone(pid)
+        for other in sorted(self.network.nodes):
+            self.network.nodes[other].unregister_peer(pid)
+
+    def _crash(self, pid):
+        self.holders.pop(pid, None)
+        self._gone(pid)
+
+        def notice():
+            for other in sorted(self.network.nodes):
+                self.network.nodes[other].unregister_peer(pid)
+        self.network.schedule(self.detect, notice)
+
+    def _gone(self, pid):
+        del self.network.nodes[pid]
+        self.asked[pid] = None
+        self.left[pid] = self.network.now
+
+
+def format_results(results):
+    """Lay the results of several runs out side by side."""
+
+    rows = [
+        ("engine", "engine", "{}"),
+        ("CS entries", "entries", "{}"),
+        ("  shared", "shared_entries", "{}"),
+        ("messages", "messages", "{}"),
+        ("  lost", "lost", "{}"),
+        ("  recovery calls", "control", "{}"),
+        ("messages / entry", "messages_per_entry", "{:.2f}"),
+        ("throughput (1/s)", "throughput", "{:.1f}"),
+        ("sync delay (ms)", "sync_delay", "{:.2f}", 1000),
+        ("wait mean (ms)", "wait_mean", "{:.2f}", 1000),
+        ("wait p95 (ms)", "wait_p95", "{:.2f}", 1000),
+        ("wait max (ms)", "wait_max", "{:.2f}", 1000),
+        ("fairness (Jain)", "fairness", "{:.3f}"),
+        ("stalled peers", "stalled", "{}"),
+        ("ME violations", "violations", "{}")
+    ]
+    lines = []
+    for row in rows:
+        label, key, fmt = row[:3]
+        scale = row[3] if len(row) > 3 else 1
+        cells = []
+        for result in results:
+            value = result[key]
+            if value is None:
+                cells.append("-")
+            else:
+                cells.append(fmt.format(value * scale if scale != 1
+                                        else value))
+        lines.append("{:<18}".format(label) +
+                     "".join("{:>14}".format(c) for c in cells))
+    return "\n".join(lines)
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _jain(rates):
+    """Jain's fairness index: 1 when every peer got the same share."""
+    if not rates or not any(rates):
+        return None
+    return sum(rates) ** 2 / (len(rates) * sum(r * r for r in rates))
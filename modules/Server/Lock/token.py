@@ -0,0 +1,156 @@
+# ------------------------------------------------------------------------------
+#  Compact representation of the token of the distributed lock.
+#
+#  The token holds one logical time per peer. Instead of a dictionary it
+#  keeps a few arrays indexed by a slot number, and every peer keeps the
+#  copy it had when it last passed the token on. A handoff then only has
+#  to carry the slots that changed since the receiver's copy was taken.
+# ------------------------------------------------------------------------------
+
+from array import array
+
+FREE = -1
+
+
+class TokenError(Exception):
+    pass
+
+
+class Token(object):
+
+    """Array backed token, indexed by peer slot.
+
+    For every slot k the token keeps:
+        pids[k]   :: the id of the peer using the slot, or FREE,
+        values[k] :: token[pid], the time of the peer's last access,
+        seen[k]   :: the handoff (epoch) at which the peer last had the
+                     token; its local copy is exact as of that epoch,
+        stamps[k] :: the epoch at which the slot last changed.
+
+    Reading and writing by peer id works as with the dictionary used
+    before, so the lock rules can be written the same way.
+    """
+
+    def __init__(self):
+        self.epoch = 0
+        self.slots = {}
+        self.pids = array("q")
+        self.values = array("q")
+        self.seen = array("q")
+        self.stamps = array("q")
+
+    # Dictionary like access
+
+    def __getitem__(self, pid):
+        return self.values[self.slots[pid]]
+
+    def __setitem__(self, pid, value):
+        slot = self._slot(pid)
+        if self.values[slot] != value:
+            self.values[slot] = value
+            self._touch(slot)
+
+    def __delitem__(self, pid):
+        slot = self.slots.pop(pid)
+        self.pids[slot] = FREE
+        self.values[slot] = 0
+        self.seen[slot] = 0
+        self._touch(slot)
+
+    def __contains__(self, pid):
+        return pid in self.slots
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, pid, default=None):
+        slot = self.slots.get(pid)
+        return default if slot is None else self.values[slot]
+
+    def keys(self):
+        return self.slots.keys()
+
+    def items(self):
+        return [(pid, self.values[slot]) for pid, slot in self.slots.items()]
+
+    # Wire format
+
+    def encode(self, sender, receiver, full=False):
+        """Hand the token over from sender to receiver.
+
+        Returns the message to send: [epoch, base, size, entries], where
+        entries is a flat list of (slot, pid, value, seen, stamp) for the
+        slots that changed after epoch base, the last epoch at which the
+        receiver had the token (0, i.e. everything, if it never had it).
+        """
+
+        base = 0
+        if not full and receiver in self.slots:
+            base = self.seen[self.slots[receiver]]
+        self.epoch += 1
+        for pid in (sender, receiver):
+            slot = self._slot(pid)
+            self.seen[slot] = self.epoch
+            self.stamps[slot] = self.epoch
+        entries = []
+        for slot in range(len(self.pids)):
+            if self.stamps[slot] > base:
+                entries.extend((slot, self.pids[slot], self.values[slot],
+                                self.seen[slot], self.stamps[slot]))
+        return [self.epoch, base, len(self.pids), entries]
+
+    def decode(self, message):
+        """Apply a message built by encode onto this (stale) copy."""
+
+        epoch, base, size, entries = message
+        if base == 0:
+            self.__init__()
+        elif base != self.epoch:
+            raise TokenError("Token delta based on epoch {}, local copy is at "
+                             "epoch {}.".format(base, self.epoch))
+        self._grow(size)
+        for i in range(0, len(entries), 5):
+            slot, pid, value, seen, stamp = entries[i:i + 5]
+            old = self.pids[slot]
+            if old != FREE and self.slots.get(old) == slot:
+                del self.slots[old]
+            if pid != FREE:
+                self.slots[pid] = slot
+            self.pids[slot] = pid
+            self.values[slot] = value
+            self.seen[slot] = seen
+            self.stamps[slot] = stamp
+        self.epoch = epoch
+
+    # Private methods
+
+    def _touch(self, slot):
+        # Local changes belong to the next handoff.
+        self.stamps[slot] = self.epoch + 1
+
+    def _grow(self, size):
+        while len(self.pids) < size:
+            for a in (self.pids, self.values, self.seen, self.stamps):
+                a.append(0)
+            self.pids[-1] = FREE
+
+    def _slot(self, pid):
+        slot = self.slots.get(pid)
+        if slot is None:
+            try:
+                slot = self.pids.index(FREE)
+            except ValueError:
+                self._grow(len(self.pids) + 1)
+                slot = len(self.pids) - 1
+            self.slots[pid] = slot
+            self.pids[slot] = pid
+            self.values[slot] = 0
+            self.seen[slot] = 0
+            self._touch(slot)
+        return slot
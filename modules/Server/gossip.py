@@ -0,0 +1,382 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Gossip based membership for a list of peers (SWIM style).
+
+The name service is only used to obtain an id and a seed peer to join
+through. From then on the members keep track of each other:
+
+--  every protocol period a member pings one other member, chosen in a
+    shuffled round-robin order,
+--  if the ping fails, a few other members are asked to ping it on its
+    behalf (indirect ping) before it is suspected,
+--  a suspected member that does not refute the suspicion (by gossiping
+    a higher incarnation number) within the suspicion timeout is
+    declared dead and removed,
+--  the dead are remembered for a while, so that stale gossip cannot
+    bring them back; a member declared dead by mistake comes back by
+    gossiping a higher incarnation number,
+--  joins, suspicions and deaths are piggybacked on the pings and their
+    acknowledgements, each update being retransmitted O(log n) times.
+
+Each member thus sends a constant number of messages per period, no
+matter how large the group grows.
+"""
+
+import math
+import time
+import random
+import logging
+import threading
+from Common import orb
+from Server.peerList import PeerList
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+
+class Member(object):
+
+    """What a member knows about another member."""
+
+    __slots__ = ("pid", "address", "status", "incarnation", "suspected_at",
+                 "dead_at")
+
+    def __init__(self, pid, address, status=ALIVE, incarnation=0):
+        self.pid = pid
+        self.address = tuple(address)
+        self.status = status
+        self.incarnation = incarnation
+        self.suspected_at = 0.0
+        self.dead_at = 0.0
+
+
+class GossipPeerList(PeerList):
+
+    """PeerList whose membership is maintained by gossip.
+
+    The interface is the one of PeerList. Membership changes discovered
+    by gossip are applied through the owner's register_peer and
+    unregister_peer methods, exactly as if another peer had called them.
+    """
+
+    def __init__(self, owner, period=1.0, indirect_probes=3,
+                 suspicion_mult=4, retransmit_mult=3, max_piggyback=6,
+                 tombstone_mult=10):
+        PeerList.__init__(self, owner)
+        self.period = period
+        self.indirect_probes = indirect_probes
+        self.suspicion_mult = suspicion_mult
+        # Dead members are forgotten after this many suspicion timeouts.
+        self.tombstone_mult = tombstone_mult
+        self.retransmit_mult = retransmit_mult
+        self.max_piggyback = max_piggyback
+        self.incarnation = 0
+        self.members = {}
+        # Pending updates, as [update, times left to transmit].
+        self.updates = []
+        self.probe_order = []
+        self.rand = random.Random()
+        self.running = False
+
+    # Public methods
+
+    def initialize(self):
+        """Join the group through one of the peers known to the name service."""
+
+        peer_set = self.owner.name_service.get_peers(self.owner.type)
+        self.owner.register_peer(self.owner.id, self.owner.address)
+        seeds = [tuple(p) for p in peer_set if p[0] != self.owner.id]
+        self.rand.shuffle(seeds)
+        for seed_id, seed_addr in seeds:
+            try:
+                members = orb.Stub(seed_addr).gossip_join(
+                    self.owner.id, self.owner.address)
+            except Exception as e:
+                logging.info("Could not join through peer {}: {}".format(
+                    seed_id, e))
+                continue
+            self._merge(members)
+            break
+
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def destroy(self):
+        """Tell a few members that we leave; gossip does the rest."""
+
+        self.running = False
+        targets = self._random_members(self.indirect_probes)
+        for member in targets:
+            try:
+                orb.Stub(member.address).gossip_leave(self.owner.id)
+            except Exception:
+                continue
+
+    def suspect(self, pid):
+        # The protocol periods find out about it, see _ping.
+        pass
+
+    def gossip_calls(self):
+        """Return the calls the owner has to dispatch for this engine."""
+
+        return {
+            "ping":          self.ping,
+            "ping_req":      self.ping_req,
+            "gossip_join":   self.gossip_join,
+            "gossip_leave":  self.gossip_leave
+        }
+
+    def ping(self, from_id, updates):
+        """Acknowledge a direct ping and exchange piggybacked updates."""
+
+        self._apply(updates)
+        return self._piggyback()
+
+    def ping_req(self, from_id, target_id, updates):
+        """Ping a member on behalf of another one."""
+
+        self._apply(updates)
+        self.lock.acquire()
+        try:
+            member = self.members.get(target_id)
+        finally:
+            self.lock.release()
+        acked = member is not None and self._ping(member)
+        return [acked, self._piggyback()]
+
+    def gossip_join(self, pid, paddr):
+        """Admit a new member and return the current membership."""
+
+        self._update(pid, paddr, ALIVE, 0)
+        self.lock.acquire()
+        try:
+            members = [[m.pid, list(m.address), m.status, m.incarnation]
+                       for m in self.members.values() if m.status != DEAD]
+        finally:
+            self.lock.release()
+        members.append([self.owner.id, list(self.owner.address), ALIVE,
+                        self.incarnation])
+        return members
+
+    def gossip_leave(self, pid):
+        """A member announced that it leaves the group."""
+
+        self.lock.acquire()
+        try:
+            member = self.members.get(pid)
+            incarnation = member.incarnation if member else 0
+        finally:
+            self.lock.release()
+        self._update(pid, None, DEAD, incarnation)
+
+    def display_peers(self):
+        PeerList.display_peers(self)
+        self.lock.acquire()
+        try:
+            print("Gossip view (incarnation {}, {} pending updates):".format(
+                self.incarnation, len(self.updates)))
+            for pid in sorted(self.members):
+                m = self.members[pid]
+                print("    id: {:>2}, status: {}, incarnation: {}".format(
+                    pid, m.status, m.incarnation))
+        finally:
+            self.lock.release()
+
+    # Private methods
+
+    def _run(self):
+        while self.running:
+            started = time.monotonic()
+            try:
+                self._protocol_period()
+                self._expire_suspects()
+                self._expire_tombstones()
+            except Exception as e:
+                logging.debug("Gossip period failed: {}".format(e))
+            elapsed = time.monotonic() - started
+            time.sleep(max(0.0, self.period - elapsed))
+
+    def _protocol_period(self):
+        target = self._next_target()
+        if target is None:
+            return
+        if self._ping(target):
+            return
+        # Indirect probing through k other members.
+        helpers = self._random_members(self.indirect_probes,
+                                       exclude=target.pid)
+        for helper in helpers:
+            try:
+                acked, updates = orb.Stub(helper.address).ping_req(
+                    self.owner.id, target.pid, self._piggyback())
+            except Exception:
+                continue
+            self._apply(updates)
+            if acked:
+                return
+        self._update(target.pid, None, SUSPECT, target.incarnation)
+
+    def _ping(self, member):
+        try:
+            updates = orb.Stub(member.address).ping(self.owner.id,
+                                                    self._piggyback())
+        except Exception as e:
+            logging.debug("Ping of member {} failed: {}".format(member.pid, e))
+            return False
+        self._apply(updates)
+        return True
+
+    def _next_target(self):
+        """Round-robin over a shuffled list, reshuffled every round."""
+
+        self.lock.acquire()
+        try:
+            while self.probe_order:
+                pid = self.probe_order.pop()
+                member = self.members.get(pid)
+                if member is not None and member.status != DEAD:
+                    return member
+            self.probe_order = [pid for pid, m in self.members.items()
+                                if m.status != DEAD]
+            self.rand.shuffle(self.probe_order)
+            if not self.probe_order:
+                return None
+            return self.members[self.probe_order.pop()]
+        finally:
+            self.lock.release()
+
+    def _random_members(self, k, exclude=None):
+        self.lock.acquire()
+        try:
+            candidates = [m for m in self.members.values()
+                          if m.status == ALIVE and m.pid != exclude]
+        finally:
+            self.lock.release()
+        return self.rand.sample(candidates, min(k, len(candidates)))
+
+    def _suspicion_timeout(self):
+        n = len(self.members) + 1
+        return self.suspicion_mult * max(1.0, math.log10(n)) * self.period
+
+    def _expire_suspects(self):
+        now = time.monotonic()
+        timeout = self._suspicion_timeout()
+        self.lock.acquire()
+        try:
+            expired = [m for m in self.members.values()
+                       if m.status == SUSPECT and
+                       now - m.suspected_at > timeout]
+        finally:
+            self.lock.release()
+        for member in expired:
+            logging.info("Member {} did not refute the suspicion.".format(
+                member.pid))
+            self._update(member.pid, None, DEAD, member.incarnation)
+
+    def _expire_tombstones(self):
+        now = time.monotonic()
+        timeout = self.tombstone_mult * self._suspicion_timeout()
+        self.lock.acquire()
+        try:
+            for pid in [m.pid for m in self.members.values()
+                        if m.status == DEAD and now - m.dead_at > timeout]:
+                del self.members[pid]
+        finally:
+            self.lock.release()
+
+    def _piggyback(self):
+        """Pick the least transmitted updates to send along a message."""
+
+        self.lock.acquire()
+        try:
+            self.updates.sort(key=lambda entry: -entry[1])
+            chosen = self.updates[:self.max_piggyback]
+            for entry in chosen:
+                entry[1] -= 1
+            self.updates = [entry for entry in self.updates if entry[1] > 0]
+            return [entry[0] for entry in chosen]
+        finally:
+            self.lock.release()
+
+    def _disseminate(self, update):
+        n = len(self.members) + 1
+        times = self.retransmit_mult * int(math.ceil(math.log(n + 1)))
+        # A newer update about the same member replaces the older ones.
+        self.updates = [entry for entry in self.updates
+                        if entry[0][1] != update[1]]
+        self.updates.append([update, max(1, times)])
+
+    def _merge(self, members):
+        for pid, paddr, status, incarnation in members:
+            self._update(pid, paddr, status, incarnation, gossip=False)
+
+    def _apply(self, updates):
+        for status, pid, paddr, incarnation in updates:
+            self._update(pid, paddr, status, incarnation)
+
+    def _update(self, pid, paddr, status, incarnation, gossip=True):
+        """Apply one membership update, following the SWIM precedence rules.
+
+        A higher incarnation always wins; at equal incarnations a
+        suspicion overrides 'alive', and death overrides everything. Only
+        the member itself brings a dead member back, as 'alive' with a
+        higher incarnation.
+        """
+
+        joined = left = False
+        self.lock.acquire()
+        try:
+            if pid == self.owner.id:
+                if (status == SUSPECT or status == DEAD and self.running) \
+                        and incarnation >= self.incarnation:
+                    # Refute the suspicion (or death) about ourselves.
+                    self.incarnation = incarnation + 1
+                    self._disseminate([ALIVE, pid, list(self.owner.address),
+                                       self.incarnation])
+                return
+            member = self.members.get(pid)
+            if member is None:
+                if status == DEAD or paddr is None:
+                    return
+                member = Member(pid, paddr, status, incarnation)
+                self.members[pid] = member
+                joined = True
+            elif member.status == DEAD:
+                if status != ALIVE or paddr is None or \
+                        incarnation <= member.incarnation:
+                    return
+                member.address = tuple(paddr)
+                member.incarnation = incarnation
+                member.status = ALIVE
+                joined = True
+            else:
+                rank = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+                if incarnation < member.incarnation:
+                    return
+                if incarnation == member.incarnation and \
+                        rank[status] <= rank[member.status]:
+                    return
+                member.incarnation = incarnation
+                member.status = status
+                left = status == DEAD
+            if status == SUSPECT:
+                member.suspected_at = time.monotonic()
+            elif status == DEAD:
+                member.dead_at = time.monotonic()
+            if gossip:
+                self._disseminate([status, pid, list(member.address),
+                                   incarnation])
+        finally:
+            self.lock.release()
+
+        # The owner's hooks may take other locks or make calls, so they
+        # run outside of self.lock.
+        # Dead members are kept in self.members for a while, so that
+        # stale gossip cannot bring them back (see _expire_tombstones).
+        if joined:
+            self.owner.register_peer(pid, member.address)
+        elif left and pid in self.peers:
+            self.owner.unregister_peer(pid)
@@ -0,0 +1,143 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Append-only, memory-mapped log of chat messages.
+
+The file is a sequence of records, each one a 4 byte big endian length
+followed by that many bytes of JSON. It is grown ahead of time (grow
+bytes at a time, doubling) and mapped in memory, so appending is a copy
+into the mapping; the zero bytes after the last record mark its end. The
+payload of a record is written before its length, so a record torn by a
+crash reads as the end of the log.
+
+Records are numbered from 0. An in-memory index of their offsets is
+rebuilt by a single scan when the log is opened; from then on any
+record can be found in constant time, and read() returns the records
+from a given number on in chunks of bounded size, without reading the
+rest of the file.
+"""
+
+import os
+import json
+import mmap
+import struct
+import threading
+from array import array
+
+LENGTH = struct.Struct(">I")
+
+
+class MessageLog(object):
+
+    """Append-only log of JSON records in a memory-mapped file."""
+
+    def __init__(self, path, grow=1 << 20):
+        self.path = path
+        self.grow = grow
+        self.lock = threading.Lock()
+        self.offsets = array("q")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, "r+b")
+        size = os.fstat(fd).st_size
+        if size == 0:
+            size = grow
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.end = self._scan()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Public methods
+
+    def append(self, record):
+        """Append record (anything JSON can encode); returns its number."""
+
+        data = json.dumps(record).encode("utf-8")
+        self.lock.acquire()
+        try:
+            start = self.end
+            stop = start + LENGTH.size + len(data)
+            if stop + LENGTH.size > len(self.map):
+                self._resize(max(2 * len(self.map),
+                                 stop + LENGTH.size + self.grow))
+            self.map[start + LENGTH.size:stop] = data
+            LENGTH.pack_into(self.map, start, len(data))
+            self.offsets.append(start)
+            self.end = stop
+            return len(self.offsets) - 1
+        finally:
+            self.lock.release()
+
+    def read(self, since, max_bytes=65536):
+        """Return the records from number since on, at most max_bytes of
+        them (but at least one).
+
+        A negative since counts from the end. Returns {"next": number of
+        the first record not returned, "end": number of records in the
+        log, "messages": [records]}.
+        """
+
+        self.lock.acquire()
+        try:
+            total = len(self.offsets)
+            if since < 0:
+                since = max(total + since, 0)
+            messages = []
+            used = 0
+            i = since
+            while i < total:
+                start = self.offsets[i] + LENGTH.size
+                size = LENGTH.unpack_from(self.map, self.offsets[i])[0]
+                if messages and used + size > max_bytes:
+                    break
+                messages.append(json.loads(
+                    self.map[start:start + size].decode("utf-8")))
+                used += size
+                i += 1
+            return {"next": i, "end": total, "messages": messages}
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Write the mapped pages back to the file."""
+        self.lock.acquire()
+        try:
+            self.map.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Flush and give the space grown ahead of time back."""
+        self.lock.acquire()
+        try:
+            if self.map.closed:
+                return
+            self.map.flush()
+            self.map.close()
+            self.file.truncate(self.end)
+            self.file.close()
+        finally:
+            self.lock.release()
+
+    # Private methods
+
+    def _scan(self):
+        """Index the records; returns the offset where the next one goes."""
+
+        offset = 0
+        size = len(self.map)
+        while offset + LENGTH.size <= size:
+            length = LENGTH.unpack_from(self.map, offset)[0]
+            if length == 0 or offset + LENGTH.size + length > size:
+                break
+            self.offsets.append(offset)
+            offset += LENGTH.size + length
+        return offset
+
+    def _resize(self, size):
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
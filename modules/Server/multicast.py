@@ -0,0 +1,314 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Causally ordered multicast to the peers of a PeerList.
+
+Every message carries the id of its sender, a per-sender sequence number
+and the vector clock of its sender (the number of messages it had
+delivered from every peer when sending it). A receiver holds a message
+back until it has delivered everything the sender had delivered before
+sending it, and the previous message of that sender:
+
+    deliver m from s once  V(m)[s] = D[s] + 1
+                     and   V(m)[k] <= D[k] for every other peer k,
+
+where D is the vector of the messages delivered so far. Messages are
+never acknowledged: they are queued on an Outbox and sent in batches, so
+a sender never waits for its receivers.
+
+Lost messages show up as gaps in the hold-back queue. A repair thread
+asks their sender (or, if it is gone, any other peer, since everybody
+keeps the last messages it delivered) to send them again. When nothing
+is held back it compares its vector with the one of a random peer, which
+catches a lost last message. A gap nobody can fill any more is skipped
+after give_up seconds so that delivery does not stop for good.
+"""
+
+import time
+import random
+import logging
+import threading
+from collections import deque
+from Server.outbox import Outbox
+
+
+class CausalMulticast(object):
+
+    """Causal multicast for the owner of a PeerList.
+
+    deliver(sender id, payload) is called for every message, ours
+    included, in causal order and with the multicast lock held; it must
+    not block.
+    """
+
+    def __init__(self, owner, peer_list, deliver, history=1000,
+                 interval=1.0, give_up=10.0, **outbox_options):
+        self.owner = owner
+        self.peer_list = peer_list
+        self.deliver = deliver
+        self.interval = interval
+        self.give_up = give_up
+        self.lock = threading.Lock()
+        self.outbox = Outbox(owner, peer_list, method="mcast_receive",
+                             **outbox_options)
+        # Messages delivered so far, by sender.
+        self.delivered = {}
+        # Messages received too early: (sender, seq) -> [message, arrival].
+        self.holdback = {}
+        # The last messages delivered from every sender, kept for the
+        # peers that missed them.
+        self.history = history
+        self.store = {}
+        self.sent = 0
+        self.received = 0
+        self.duplicates = 0
+        self.repaired = 0
+        self.skipped = 0
+        # Where we were behind a random peer at the last repair.
+        self.lagging = {}
+        self.stopped = threading.Event()
+        self.repairer = threading.Thread(target=self._repair_loop)
+        self.repairer.daemon = True
+
+    # Public methods
+
+    def initialize(self):
+        """Start from the vector of a peer already in the group, so that
+        the messages sent before we joined are not waited for."""
+
+        me = self.owner.id
+        peers = self.peer_list.get_peers()
+        for pid in peers:
+            if pid == me:
+                continue
+            try:
+                clock = peers[pid].mcast_clock()
+            except Exception as e:
+                logging.info("Peer {} did not send its clock: {}".format(
+                    pid, e))
+                continue
+            self.lock.acquire()
+            try:
+                for k, n in clock:
+                    self.delivered[k] = max(self.delivered.get(k, 0), n)
+            finally:
+                self.lock.release()
+            break
+        self.repairer.start()
+
+    def destroy(self):
+        self.stopped.set()
+        self.outbox.flush(timeout=5.0)
+        self.outbox.close()
+
+    def multicast(self, payload):
+        """Send payload to the group, us included; returns at once."""
+
+        me = self.owner.id
+        self.lock.acquire()
+        try:
+            seq = self.delivered.get(me, 0) + 1
+            vector = [[pid, n] for pid, n in self._vector() if pid != me]
+            vector.append([me, seq])
+            message = [me, seq, vector, payload]
+            self._deliver(message)
+            self.sent += 1
+        finally:
+            self.lock.release()
+        # Queued in this order, so the messages of a sender reach every
+        # peer in order, unless one is lost.
+        self.outbox.broadcast(message)
+
+    def remote_calls(self):
+        return {
+            "mcast_receive":     self.mcast_receive,
+            "mcast_resend":      self.mcast_resend,
+            "mcast_clock":       self.mcast_clock
+        }
+
+    def mcast_receive(self, from_id, messages):
+        """Receive a batch of messages, sent by from_id (their sender, or
+        a peer answering a repair)."""
+
+        now = time.monotonic()
+        self.lock.acquire()
+        try:
+            for message in messages:
+                sender, seq = message[0], message[1]
+                self.received += 1
+                if seq <= self.delivered.get(sender, 0) or \
+                        (sender, seq) in self.holdback:
+                    self.duplicates += 1
+                    continue
+                self.holdback[(sender, seq)] = [message, now]
+            self._deliver_ready()
+        finally:
+            self.lock.release()
+
+    def mcast_resend(self, sender, after, upto):
+        """Return the messages of sender after seq after, up to upto,
+        that we still keep."""
+
+        self.lock.acquire()
+        try:
+            return [message for message in self.store.get(sender, ())
+                    if after < message[1] <= upto]
+        finally:
+            self.lock.release()
+
+    def mcast_clock(self):
+        self.lock.acquire()
+        try:
+            return self._vector()
+        finally:
+            self.lock.release()
+
+    def repair(self):
+        """Fetch the messages that are missing, skip those that cannot be
+        found any more."""
+
+        me = self.owner.id
+        peers = self.peer_list.get_peers()
+        others = [pid for pid in peers if pid != me]
+        self.lock.acquire()
+        try:
+            missing = self._missing(time.monotonic() - self.interval)
+            idle = not self.holdback
+        finally:
+            self.lock.release()
+        if idle and others:
+            # Nothing is held back: was a last message lost? Only what we
+            # were already behind at the last repair is fetched; the rest
+            # may still be on its way.
+            try:
+                clock = peers[random.choice(others)].mcast_clock()
+            except Exception as e:
+                logging.info("Group clock not received: {}".format(e))
+                clock = []
+            self.lock.acquire()
+            try:
+                lagging = {k: n for k, n in clock
+                           if n > self.delivered.get(k, 0) and k != me}
+                missing = {k: min(n, self.lagging[k])
+                           for k, n in lagging.items()
+                           if self.lagging.get(k, 0) >
+                           self.delivered.get(k, 0)}
+                self.lagging = lagging
+            finally:
+                self.lock.release()
+        for sender in missing:
+            sources = [pid for pid in others if pid != sender]
+            random.shuffle(sources)
+            if sender in peers and sender != me:
+                sources.insert(0, sender)
+            for pid in sources:
+                after = self.delivered.get(sender, 0)
+                if after >= missing[sender]:
+                    break
+                try:
+                    messages = peers[pid].mcast_resend(
+                        sender, after, missing[sender])
+                except Exception as e:
+                    logging.info("Peer {} could not resend: {}".format(
+                        pid, e))
+                    continue
+                if messages:
+                    self.repaired += len(messages)
+                    self.mcast_receive(pid, messages)
+        self.lock.acquire()
+        try:
+            self._skip(time.monotonic() - self.give_up)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {"sent": self.sent, "received": self.received,
+                    "duplicates": self.duplicates,
+                    "repaired": self.repaired, "skipped": self.skipped,
+                    "held_back": len(self.holdback),
+                    "clock": self._vector()}
+        finally:
+            self.lock.release()
+
+    def display(self):
+        stats = self.stats()
+        print("Group   :: clock {clock}".format(**stats))
+        print("           sent: {sent}, received: {received}, duplicates: "
+              "{duplicates}, repaired: {repaired}, skipped: {skipped}, "
+              "held back: {held_back}".format(**stats))
+
+    # Private methods, called with the lock held
+
+    def _vector(self):
+        return [[pid, n] for pid, n in sorted(self.delivered.items())]
+
+    def _deliverable(self, message):
+        sender, seq, vector = message[0], message[1], message[2]
+        if seq != self.delivered.get(sender, 0) + 1:
+            return False
+        for k, n in vector:
+            if k != sender and n > self.delivered.get(k, 0):
+                return False
+        return True
+
+    def _deliver_ready(self):
+        progress = True
+        while progress:
+            progress = False
+            for key in sorted(self.holdback):
+                message = self.holdback[key][0]
+                if self._deliverable(message):
+                    del self.holdback[key]
+                    self._deliver(message)
+                    progress = True
+
+    def _deliver(self, message):
+        sender, seq = message[0], message[1]
+        self.delivered[sender] = seq
+        kept = self.store.get(sender)
+        if kept is None:
+            kept = self.store[sender] = deque(maxlen=self.history)
+        kept.append(message)
+        try:
+            self.deliver(sender, message[3])
+        except Exception:
+            logging.exception("Delivery of a group message failed")
+
+    def _missing(self, before):
+        """The last seq needed from every sender, for the messages held
+        back since before."""
+
+        missing = {}
+        for message, arrival in self.holdback.values():
+            if arrival > before:
+                continue
+            sender, seq, vector = message[0], message[1], message[2]
+            needs = [[sender, seq - 1]] + [
+                [k, n] for k, n in vector if k != sender]
+            for k, n in needs:
+                if n > self.delivered.get(k, 0):
+                    missing[k] = max(missing.get(k, 0), n)
+        return missing
+
+    def _skip(self, before):
+        stuck = [message for message, arrival in self.holdback.values()
+                 if arrival <= before]
+        if not stuck:
+            return
+        for k, n in self._missing(before).items():
+            logging.warning("Group messages {}..{} of peer {} are lost, "
+                            "skipped.".format(
+                                self.delivered.get(k, 0) + 1, n, k))
+            self.skipped += n - self.delivered.get(k, 0)
+            self.delivered[k] = n
+        self._deliver_ready()
+
+    def _repair_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.repair()
+            except Exception:
+                logging.exception("Group repair failed")
@@ -0,0 +1,267 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Asynchronous, batched sending of messages to the peers of a PeerList.
+
+Every destination gets its own bounded queue, drained by a background
+sender thread that delivers the queued messages in batches, with a single
+RMI per batch. A slow or unreachable peer thus only delays its own queue,
+never the caller nor the other destinations.
+
+When a queue is full the policy decides what happens to a new message:
+
+--  drop-oldest ::  the oldest queued message is dropped,
+--  drop-newest ::  the new message is dropped,
+--  block       ::  the caller waits until there is room (backpressure),
+                    or until its timeout expires and the message is
+                    dropped.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+
+POLICIES = [DROP_OLDEST, DROP_NEWEST, BLOCK]
+
+
+class Channel(threading.Thread):
+
+    """The queue of one destination and the thread sending it."""
+
+    def __init__(self, outbox, pid):
+        threading.Thread.__init__(self)
+        self.outbox = outbox
+        self.pid = pid
+        self.lock = threading.Condition()
+        self.queue = deque()
+        self.sending = 0
+        self.closed = False
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.daemon = True
+
+    def put(self, msg, timeout=None):
+        """Queue msg; returns False if it was dropped."""
+
+        outbox = self.outbox
+        self.lock.acquire()
+        try:
+            if self.closed:
+                self.dropped += 1
+                return False
+            if len(self.queue) >= outbox.capacity:
+                if outbox.policy == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif outbox.policy == DROP_NEWEST or not self.lock.wait_for(
+                        lambda: len(self.queue) < outbox.capacity or
+                        self.closed, timeout) or self.closed:
+                    self.dropped += 1
+                    return False
+            self.queue.append(msg)
+            self.lock.notify_all()
+            return True
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Stop sending; the queued messages are dropped."""
+        self.lock.acquire()
+        try:
+            self.closed = True
+            self.dropped += len(self.queue)
+            self.queue.clear()
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def pending(self):
+        return len(self.queue) + self.sending
+
+    def run(self):
+        outbox = self.outbox
+        failures = 0
+        while True:
+            self.lock.acquire()
+            try:
+                self.lock.wait_for(lambda: self.queue or self.closed)
+                if self.closed:
+                    return
+                batch = [self.queue.popleft() for _ in
+                         range(min(len(self.queue), outbox.batch))]
+                self.sending = len(batch)
+                # Room was made for blocked callers.
+                self.lock.notify_all()
+            finally:
+                self.lock.release()
+            try:
+                stub = outbox.peer_list.peer(self.pid)
+                getattr(stub, outbox.method)(outbox.owner.id, batch)
+                failures = 0
+                error = None
+            except KeyError:
+                # The peer left: nothing queued for it can be delivered.
+                outbox.forget(self.pid)
+                error = "left"
+            except Exception as e:
+                failures += 1
+                error = e
+            self.lock.acquire()
+            try:
+                self.sending = 0
+                if error is None:
+                    self.sent += len(batch)
+                    self.batches += 1
+                elif failures and failures <= outbox.retries and \
+                        not self.closed:
+                    # Sent again first, in the same order.
+                    self.queue.extendleft(reversed(batch))
+                    while len(self.queue) > outbox.capacity:
+                        self.queue.pop()
+                        self.dropped += 1
+                    batch = []
+                else:
+                    failures = 0
+                    self.dropped += len(batch)
+                self.lock.notify_all()
+            finally:
+                self.lock.release()
+            if error is not None and batch:
+                outbox.on_drop(self.pid, batch, error)
+            elif error is not None:
+                time.sleep(outbox.backoff * 2 ** (failures - 1))
+
+
+class Outbox(object):
+
+    """Queue messages for the peers of a PeerList and send them in the
+    background.
+
+    The messages for a peer are delivered in order, in batches of at most
+    batch messages, by calling method(sender id, [messages]) on it. A
+    failed batch is tried again up to retries times, with an exponential
+    backoff, then dropped and reported to on_drop(pid, messages, error).
+    """
+
+    def __init__(self, owner, peer_list, method="print_messages",
+                 capacity=1000, batch=64, policy=DROP_OLDEST, retries=3,
+                 backoff=0.2, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy: '{}'".format(policy))
+        self.owner = owner
+        self.peer_list = peer_list
+        self.method = method
+        self.capacity = capacity
+        self.batch = batch
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.on_drop = on_drop or self._log_drop
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    # Public methods
+
+    def send(self, pid, msg, timeout=None):
+        """Queue msg for peer pid.
+
+        Returns False if the message was dropped right away: pid is not
+        in the peer list, or its queue is full (see the policy).
+        """
+
+        if pid not in self.peer_list.get_peers():
+            return False
+        return self._channel(pid).put(msg, timeout)
+
+    def broadcast(self, msg, timeout=None):
+        """Queue msg for every other peer; they are sent in parallel.
+
+        Returns the ids of the peers it was queued for.
+        """
+
+        me = self.owner.id
+        return [pid for pid in sorted(self.peer_list.get_peers())
+                if pid != me and self._channel(pid).put(msg, timeout)]
+
+    def flush(self, timeout=None):
+        """Wait until everything queued was sent (or dropped).
+
+        Returns False if timeout seconds passed first.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for channel in self._channels():
+            channel.lock.acquire()
+            try:
+                left = None if deadline is None \
+                    else max(deadline - time.monotonic(), 0)
+                if not channel.lock.wait_for(
+                        lambda: not channel.pending() or channel.closed,
+                        left):
+                    return False
+            finally:
+                channel.lock.release()
+        return True
+
+    def forget(self, pid):
+        """Stop sending to pid, e.g. because it left."""
+        self.lock.acquire()
+        try:
+            channel = self.channels.pop(pid, None)
+        finally:
+            self.lock.release()
+        if channel is not None:
+            channel.close()
+
+    def close(self):
+        for pid in list(self.channels):
+            self.forget(pid)
+
+    def stats(self):
+        """Queued, sent and dropped messages and batches sent, by peer."""
+        return {channel.pid: {"queued": channel.pending(),
+                              "sent": channel.sent,
+                              "batches": channel.batches,
+                              "dropped": channel.dropped}
+                for channel in self._channels()}
+
+    def display(self):
+        print("Outbox ({}, {} messages per peer, batches of {}):".format(
+            self.policy, self.capacity, self.batch))
+        stats = self.stats()
+        for pid in sorted(stats):
+            print("    id: {:>2}, queued: {queued}, sent: {sent} in "
+                  "{batches} batch(es), dropped: {dropped}".format(
+                      pid, **stats[pid]))
+
+    # Private methods
+
+    def _channel(self, pid):
+        self.lock.acquire()
+        try:
+            channel = self.channels.get(pid)
+            if channel is None:
+                channel = Channel(self, pid)
+                self.channels[pid] = channel
+                channel.start()
+            return channel
+        finally:
+            self.lock.release()
+
+    def _channels(self):
+        self.lock.acquire()
+        try:
+            return list(self.channels.values())
+        finally:
+            self.lock.release()
+
+    def _log_drop(self, pid, messages, error):
+        logging.warning("{} message(s) to peer {} dropped: {}".format(
+            len(messages), pid, error))
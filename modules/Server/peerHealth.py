@@ -0,0 +1,161 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Health tracking and circuit breaking for the peers of a PeerList.
+
+Every stub handed out by the PeerList records the outcome and latency of
+the calls made through it. After a number of consecutive connection
+failures the circuit of that peer is opened: further calls fail at once
+instead of paying for a full connect failure. A background monitor
+probes open circuits with the 'check' call and closes them again as soon
+as the peer answers.
+"""
+
+import threading
+import time
+import logging
+from Common import orb
+
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+
+STATE_NAMES = {CLOSED: "closed", OPEN: "open", HALF_OPEN: "half-open"}
+
+
+class PeerHealth(object):
+
+    """Success/failure counters, latency and circuit state of one peer."""
+
+    def __init__(self, pid, failure_threshold=3, reset_timeout=2.0,
+                 max_reset_timeout=30.0):
+        self.pid = pid
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.state = CLOSED
+        self.reset_timeout = reset_timeout
+        self.opened_at = 0.0
+
+    # Public methods
+
+    def allow(self):
+        """Tell whether a call may be attempted on this peer."""
+        return self.state == CLOSED
+
+    def due_for_probe(self, now):
+        """Tell whether an open circuit should be probed; mark it half-open."""
+        with self.lock:
+            if self.state != OPEN or now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            return True
+
+    def record_success(self, latency):
+        with self.lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            # Exponentially weighted moving average of the call latency.
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if self.state != CLOSED:
+                logging.info("Circuit of peer {} closed.".format(self.pid))
+            self.state = CLOSED
+            self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN:
+                # The probe failed: wait longer before the next one.
+                self.reset_timeout = min(self.reset_timeout * 2,
+                                         self.max_reset_timeout)
+                self._open()
+            elif (self.state == CLOSED and
+                  self.consecutive_failures >= self.failure_threshold):
+                self._open()
+
+    def describe(self):
+        latency = "-" if self.latency is None \
+            else "{:.1f}ms".format(self.latency * 1000)
+        return "{}, ok: {}, failed: {}, latency: {}".format(
+            STATE_NAMES[self.state], self.successes, self.failures, latency)
+
+    # Private methods
+
+    def _open(self):
+        if self.state != OPEN:
+            logging.info("Circuit of peer {} opened.".format(self.pid))
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+
+class MonitoredStub(orb.Stub):
+
+    """Stub that reports every call to the PeerHealth of its peer."""
+
+    def __init__(self, address, health):
+        orb.Stub.__init__(self, address)
+        self.health = health
+
+    def _rmi(self, method, *args):
+        if not self.health.allow():
+            raise orb.ComunicationError(
+                "Peer {} is unavailable (circuit {}).".format(
+                    self.health.pid, STATE_NAMES[self.health.state]))
+        return self._timed_rmi(method, *args)
+
+    def probe(self):
+        """Check the peer, bypassing the circuit breaker."""
+        return self._timed_rmi("check")
+
+    # Private methods
+
+    def _timed_rmi(self, method, *args):
+        start = time.monotonic()
+        try:
+            result = orb.Stub._rmi(self, method, *args)
+        except orb.ExternalError:
+            # The peer answered, the method it ran raised an error.
+            self.health.record_success(time.monotonic() - start)
+            raise
+        except Exception:
+            self.health.record_failure()
+            raise
+        self.health.record_success(time.monotonic() - start)
+        return result
+
+
+class HealthMonitor(threading.Thread):
+
+    """Probe the peers whose circuit is open, in the background."""
+
+    def __init__(self, peer_list, interval=0.5):
+        threading.Thread.__init__(self)
+        self.peer_list = peer_list
+        self.interval = interval
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            peers = self.peer_list.get_peers()
+            for pid in peers:
+                stub = peers[pid]
+                if not isinstance(stub, MonitoredStub) or \
+                        not stub.health.due_for_probe(now):
+                    continue
+                try:
+                    stub.probe()
+                except Exception as e:
+                    logging.debug("Probe of peer {} failed: {}".format(pid, e))
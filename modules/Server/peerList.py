@@ -9,18 +9,91 @@
 
 """Package for handling a list of objects of the same type as a given one."""
 
+import logging
 import threading
-from Common import orb
+from collections.abc import Mapping
+from Server.peerHealth import PeerHealth, MonitoredStub, HealthMonitor
+
+
+class PeerSnapshot(Mapping):
+
+    """Immutable view of the peer list at a given version.
+
+    A new snapshot is built every time the membership changes and is
+    swapped in atomically, so a snapshot can be iterated without holding
+    any lock while peers keep joining and leaving.
+    """
+
+    __slots__ = ("version", "_peers")
+
+    def __init__(self, version=0, peers=None):
+        self.version = version
+        self._peers = dict(peers) if peers else {}
+
+    def __getitem__(self, pid):
+        return self._peers[pid]
+
+    def __iter__(self):
+        return iter(self._peers)
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __repr__(self):
+        return "PeerSnapshot(version={}, peers={})".format(
+            self.version, sorted(self._peers))
+
+    def updated(self, pid, stub):
+        """Return the next version with the given peer added."""
+        peers = dict(self._peers)
+        peers[pid] = stub
+        return PeerSnapshot(self.version + 1, peers)
+
+    def updated_many(self, stubs):
+        """Return the next version with the given peers (id -> stub)
+        added."""
+        peers = dict(self._peers)
+        peers.update(stubs)
+        return PeerSnapshot(self.version + 1, peers)
+
+    def without_many(self, pids):
+        """Return the next version with the given peers removed."""
+        peers = dict(self._peers)
+        for pid in pids:
+            del peers[pid]
+        return PeerSnapshot(self.version + 1, peers)
+
+    def without(self, pid):
+        """Return the next version with the given peer removed."""
+        peers = dict(self._peers)
+        del peers[pid]
+        return PeerSnapshot(self.version + 1, peers)
 
 
 class PeerList(object):
 
-    """Class that builds a list of objects of the same type as this one."""
+    """Class that builds a list of objects of the same type as this one.
+
+    The list itself is published as a PeerSnapshot. Writers serialize on
+    self.lock and replace self.peers with a new snapshot; readers simply
+    grab the current one.
+    """
 
     def __init__(self, owner):
         self.owner = owner
         self.lock = threading.Condition()
-        self.peers = {}
+        self.peers = PeerSnapshot()
+        self.monitor = None
+
+    # Private methods
+
+    def _make_stub(self, pid, paddr):
+        """Build the proxy used to reach the given peer.
+
+        The stub tracks the health of the peer, so calls to a peer known
+        to be down fail fast instead of timing out.
+        """
+        return MonitoredStub(paddr, PeerHealth(pid))
 
     # Public methods
 
@@ -28,51 +101,38 @@ class PeerList(object):
         """Populates the list of existing peers and registers the current
         peer at each of the discovered peers.
 
-        It only adds the peers with lower ids than this one or else
-        deadlocks may occur. This method must be called after the owner
-        object has been registered with the name service.
-
+        The name server does the registering: it tells the peers already
+        there about us, in one call for all the peers joining at the
+        same time, and returns the whole group. This method must be
+        called after the owner object has been registered with the name
+        service. An owner that reclaimed its identity got the group
+        already, and was announced by the name server if need be (see
+        NameServer.reclaim).
         """
 
-        # This isn't just some dumb function,
-        # This should actually handle contacting the nameserver
-        # And receiving the list of peers from it.
+        # We get a list of tuples from the name service
+        # of the format (id, addr), us included.
+        peer_set = self.owner.reclaimed_peers
+        if peer_set is None:
+            peer_set = self.owner.name_service.join(self.owner.type,
+                                                    self.owner.id,
+                                                    self.owner.address)
+        # From now on we leave the group, see destroy.
+        self.owner.joined = True
 
-        try:
-            self.lock.acquire()
-            # Get the owner's access to the name server
-            name_service = self.owner.name_service
-
-            # Get the list of peers from the name service
-            # We get a list of tuples from the name service
-            # of the format (id, addr)
-            peer_set = name_service.get_peers(self.owner.type)
-        except:
-            self.lock.release()
-            raise
-
-        # We need to make sure we release the lock if things go well, too.
-        self.lock.release()
-        
-        # Using the list of tuples, register the peers
-        # Then register itself with each peer registered
-        for peer_tuple in peer_set:
-            peer_id, peer_addr = peer_tuple
-            self.register_peer(peer_id, peer_addr)
-            self.peers[peer_id].register_peer(self.owner.id, self.owner.address)
+        # Recover peers whose circuit has been opened.
+        if self.monitor is None:
+            self.monitor = HealthMonitor(self)
+            self.monitor.start()
+
+        self.register_peers(peer_set)
 
     def destroy(self):
         """Unregister this peer from all others in the list."""
 
-        self.lock.acquire()
-        try:
-            myself = self.owner.id
-            # Ask all the other peers to deregister us
-            for fellowPeer in self.peers.keys():
-                if fellowPeer != myself:
-                    self.peers[fellowPeer].unregister_peer(self.owner.id)
-        finally:
-            self.lock.release()
+        # The name server removes us from the group and tells them, in
+        # one call for all the peers leaving at the same time.
+        self.owner.name_service.leave(self.owner.type, self.owner.id)
 
     def register_peer(self, pid, paddr):
         """Register a new peer joining the network."""
@@ -81,11 +141,57 @@ class PeerList(object):
         # this method in parallel.
         self.lock.acquire()
         try:
-            self.peers[pid] = orb.Stub(paddr)
+            self.peers = self.peers.updated(pid, self._make_stub(pid, paddr))
             print("Peer {} has joined the system.".format(pid))
         finally:
             self.lock.release()
 
+    def register_peers(self, peers):
+        """Register several peers, given as (id, address), at once.
+
+        Returns the ids of those that were not known yet. A known peer
+        at a new address (restarted, see NameServer.reclaim) is only
+        reached there from now on.
+        """
+
+        self.lock.acquire()
+        try:
+            stubs = {}
+            moved = []
+            for pid, paddr in peers:
+                if pid in stubs:
+                    continue
+                if pid not in self.peers:
+                    stubs[pid] = self._make_stub(pid, paddr)
+                elif self.peers[pid].address != tuple(paddr):
+                    stubs[pid] = self._make_stub(pid, paddr)
+                    moved.append(pid)
+            if stubs:
+                self.peers = self.peers.updated_many(stubs)
+            for pid in sorted(stubs):
+                print("Peer {} has {} the system.".format(
+                    pid, "rejoined" if pid in moved else "joined"))
+            return sorted(pid for pid in stubs if pid not in moved)
+        finally:
+            self.lock.release()
+
+    def unregister_peers(self, pids):
+        """Unregister several leaving peers at once.
+
+        Returns the ids of those that were known.
+        """
+
+        self.lock.acquire()
+        try:
+            known = sorted(set(pid for pid in pids if pid in self.peers))
+            if known:
+                self.peers = self.peers.without_many(known)
+            for pid in known:
+                print("Peer {} has left the system.".format(pid))
+            return known
+        finally:
+            self.lock.release()
+
     def unregister_peer(self, pid):
         """Unregister a peer leaving the network."""
         # Synchronize access to the peer list as several peers might call
@@ -94,7 +200,7 @@ class PeerList(object):
         self.lock.acquire()
         try:
             if pid in self.peers:
-                del self.peers[pid]
+                self.peers = self.peers.without(pid)
                 print("Peer {} has left the system.".format(pid))
             else:
                 raise Exception("No peer with id: '{}'".format(pid))
@@ -104,30 +210,41 @@ class PeerList(object):
     def display_peers(self):
         """Display all the peers in the list."""
 
-        self.lock.acquire()
+        peers = self.peers
+        print("List of peers of type '{}' (version {}):".format(
+            self.owner.type, peers.version))
+        for pid in sorted(peers):
+            stub = peers[pid]
+            print("    id: {:>2}, address: {}, health: {}".format(
+                pid, stub.address, stub.health.describe()))
+
+    def suspect(self, pid):
+        """Have the name server check a peer that cannot be reached.
+
+        If it is gone, the name server removes it from the group and from
+        every list (see NameServer.suspect).
+        """
+
         try:
-            pids = sorted(self.peers.keys())
-            print("List of peers of type '{}':".format(self.owner.type))
-            for pid in pids:
-                addr = self.peers[pid].address
-                print("    id: {:>2}, address: {}".format(pid, addr))
-        finally:
-            self.lock.release()
+            self.owner.name_service.suspect(self.owner.type, pid)
+        except Exception as e:
+            logging.info("Peer {} could not be reported: {}".format(pid, e))
 
     def peer(self, pid):
         """Return the object with the given id."""
 
-        self.lock.acquire()
-        try:
-            return self.peers[pid]
-        finally:
-            self.lock.release()
+        return self.peers[pid]
+
+    def health(self, pid):
+        """Return the PeerHealth of the peer with the given id."""
+
+        return self.peers[pid].health
 
     def get_peers(self):
-        """Return all registered objects."""
+        """Return the current snapshot of all registered objects.
 
-        self.lock.acquire()
-        try:
-            return self.peers
-        finally:
-            self.lock.release()
+        The snapshot never changes once returned, so callers may iterate
+        it without taking self.lock.
+        """
+
+        return self.peers
@@ -0,0 +1,172 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Headless runs of the peers: command scripts and synthetic workloads.
+
+A peer run without a terminal either reads the commands of its menu from
+a script, one per line, or generates a workload at given rates. Either
+way every operation is timed by a Results object, which writes one JSON
+record per operation to the results file:
+
+    {"op": "acquire", "start": <unix time>, "duration": <seconds>,
+     "ok": true}
+
+(with "error" when the operation failed) and summarizes them per
+operation at the end.
+
+Besides the commands of the peer, a script may contain:
+
+    # a comment
+    sleep <SECONDS>
+    wait <N>          ::  wait until N peers (us included) are known.
+"""
+
+import json
+import time
+import random
+import logging
+import threading
+
+
+class Results(object):
+
+    """Timing of the operations of a run."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = []
+
+    def time(self, op, call, *args):
+        """Run call(*args) as operation op and record how long it took.
+
+        Errors are recorded, not raised; the result of call is returned
+        (None if it failed).
+        """
+
+        start = time.time()
+        began = time.monotonic()
+        record = {"op": op, "start": start}
+        result = None
+        try:
+            result = call(*args)
+            record["ok"] = True
+        except Exception as e:
+            record["ok"] = False
+            record["error"] = str(e)
+        record["duration"] = time.monotonic() - began
+        self.lock.acquire()
+        try:
+            self.records.append(record)
+        finally:
+            self.lock.release()
+        return result
+
+    def errors(self):
+        return len([r for r in self.records if not r["ok"]])
+
+    def summary(self):
+        """Count, errors and duration statistics, by operation."""
+
+        by_op = {}
+        for record in self.records:
+            by_op.setdefault(record["op"], []).append(record)
+        summary = {}
+        for op, records in by_op.items():
+            durations = sorted(r["duration"] for r in records)
+            n = len(durations)
+            summary[op] = {
+                "count": n,
+                "errors": len([r for r in records if not r["ok"]]),
+                "mean": sum(durations) / n,
+                "p50": durations[int(0.50 * (n - 1))],
+                "p95": durations[int(0.95 * (n - 1))],
+                "p99": durations[int(0.99 * (n - 1))],
+                "max": durations[-1]
+            }
+        return summary
+
+    def write(self):
+        """Write the records to the results file, if there is one."""
+        if self.path is None:
+            return
+        with open(self.path, "w") as f:
+            for record in self.records:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+class Workload(object):
+
+    """Random timing of a synthetic workload.
+
+    The run lasts duration seconds, or operations operations if that is
+    given; pause(mean) sleeps for an exponentially distributed time.
+    """
+
+    def __init__(self, seed=None, duration=60.0, operations=None):
+        self.random = random.Random(seed)
+        self.duration = duration
+        self.operations = operations
+        self.done = 0
+        self.deadline = None
+
+    def running(self):
+        """Tell whether another operation is to be run, and count it."""
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.duration
+        if self.operations is not None:
+            running = self.done < self.operations
+        else:
+            running = time.monotonic() < self.deadline
+        if running:
+            self.done += 1
+        return running
+
+    def pause(self, mean):
+        if mean > 0:
+            time.sleep(self.random.expovariate(1.0 / mean))
+
+
+def read_script(path):
+    """Return the commands of a script, split into words."""
+
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line.split() for line in lines
+            if line and not line.startswith("#")]
+
+
+def wait_for_peers(peer_list, count, timeout=60.0):
+    """Wait until count peers are in peer_list; returns False on timeout."""
+
+    deadline = time.monotonic() + timeout
+    while len(peer_list.get_peers()) < count:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def run_script(commands, execute, results, peer_list=None):
+    """Run the commands of a script, timing each one.
+
+    execute(words) runs one command of the peer.
+    """
+
+    for words in commands:
+        if words[0] == "sleep":
+            time.sleep(float(words[1]))
+        elif words[0] == "wait" and peer_list is not None:
+            if not results.time("wait", wait_for_peers, peer_list,
+                                int(words[1])):
+                logging.warning("Not all the peers were there in time.")
+        else:
+            results.time(words[0], execute, words)
+
+
+def report(results):
+    """Write the results file and print the summary."""
+
+    results.write()
+    print(json.dumps(results.summary(), indent=2, sort_keys=True))